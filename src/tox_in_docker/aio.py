@@ -0,0 +1,304 @@
+"""
+tox_in_docker.aio
+
+Drive containers with asyncio, so that many environments can be run at once
+from one event loop instead of a thread (and a blocked connection) each
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import struct
+import tempfile
+import urllib.parse
+
+import docker.errors
+import docker.types
+import tox
+
+from tox_in_docker import logs
+from tox_in_docker import main
+from tox_in_docker import resources
+from tox_in_docker import timing
+
+API_VERSION = '1.41'
+DEFAULT_SOCKET = '/var/run/docker.sock'
+
+# CPUs are leased and given back on this thread, as that can block (see
+# `resources.lease_cpus`) and a lock file belongs to the thread which took it
+_LEASE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='tox-in-docker-lease')
+
+# The stream types in the header of each frame of a container's multiplexed
+# output
+_STREAMS = {1: logs.STDOUT, 2: logs.STDERR}
+_FRAME_HEADER = struct.Struct('>BxxxL')
+
+
+class AsyncDockerClient:
+    """
+    A minimal client for the parts of the Docker Engine API used to run a
+    container, over a unix socket (or plain TCP), using asyncio streams.
+
+    Each request has a connection of its own, which is cheap for a local
+    daemon and means nothing is shared between concurrent requests. Errors are
+    raised as the `docker.errors` exceptions `docker-py` would raise.
+    """
+
+    def __init__(self, base_url: str = None, version: str = API_VERSION):
+        base_url = base_url or os.getenv('DOCKER_HOST') or f'unix://{DEFAULT_SOCKET}'
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme in ('unix', 'http+unix'):
+            self._address = url.path
+        elif url.scheme in ('tcp', 'http') and os.getenv('DOCKER_TLS_VERIFY') is None:
+            self._address = (url.hostname, url.port or 2375)
+        else:
+            raise docker.errors.DockerException(
+                f'Cannot connect to {base_url} asynchronously, only unix sockets and plain TCP '
+                'are supported')
+        self.version = version
+
+    async def _send(self, method: str, path: str, params: dict = None, body: dict = None,
+                    headers: dict = None):
+        """
+        Send a request, and read the response up to the end of its headers.
+        Returns the connection's `(reader, writer)`, the status and headers.
+        """
+
+        if isinstance(self._address, str):
+            reader, writer = await asyncio.open_unix_connection(self._address)
+        else:
+            reader, writer = await asyncio.open_connection(*self._address)
+
+        query = f'?{urllib.parse.urlencode(params)}' if params else ''
+        data = json.dumps(body).encode() if body is not None else b''
+        request_headers = {
+            'Host': 'docker',
+            'Content-Type': 'application/json',
+            'Content-Length': str(len(data)),
+            **(headers or {'Connection': 'close'}),
+        }
+        writer.write(''.join(
+            [f'{method} /v{self.version}{path}{query} HTTP/1.1\r\n',
+             *(f'{name}: {value}\r\n' for name, value in request_headers.items()),
+             '\r\n']).encode() + data)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            writer.close()
+            raise docker.errors.APIError(f'{method} {path}: the connection was closed')
+        status = int(status_line.split()[1])
+
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        return reader, writer, status, response_headers
+
+    async def request(self, method: str, path: str, params: dict = None, body: dict = None):
+        """
+        Make a request, returning the decoded JSON response (or `None` if it
+        is empty)
+        """
+
+        reader, writer, status, headers = await self._send(method, path, params, body)
+        try:
+            if headers.get('transfer-encoding') == 'chunked':
+                content = b''
+                while True:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    if not size:
+                        break
+                    content += await reader.readexactly(size)
+                    await reader.readline()
+            elif 'content-length' in headers:
+                content = await reader.readexactly(int(headers['content-length']))
+            else:
+                content = await reader.read()
+        finally:
+            writer.close()
+
+        if status >= 400:
+            try:
+                explanation = json.loads(content)['message']
+            except (ValueError, KeyError, TypeError):
+                explanation = content.decode(errors='replace')
+            error = docker.errors.NotFound if status == 404 else docker.errors.APIError
+            raise error(f'{status} {method} {path}', explanation=explanation)
+
+        return json.loads(content) if content else None
+
+    async def create_container(self, config: dict) -> str:
+        return (await self.request('POST', '/containers/create', body=config))['Id']
+
+    async def start(self, container_id: str) -> None:
+        await self.request('POST', f'/containers/{container_id}/start')
+
+    async def wait(self, container_id: str) -> int:
+        return (await self.request('POST', f'/containers/{container_id}/wait'))['StatusCode']
+
+    async def remove(self, container_id: str, v: bool = False, force: bool = False) -> None:
+        await self.request('DELETE', f'/containers/{container_id}',
+                           params={'v': int(v), 'force': int(force)})
+
+    async def attach(self, container_id: str):
+        """
+        Attach to the container's stdout and stderr (including what it has
+        already written). Returns an async iterator of `(stream, chunk)`,
+        once the daemon has accepted the attach, so that a container attached
+        to before it is started doesn't lose any output.
+        """
+
+        reader, writer, status, _headers = await self._send(
+            'POST', f'/containers/{container_id}/attach',
+            params={'logs': 1, 'stream': 1, 'stdout': 1, 'stderr': 1},
+            headers={'Connection': 'Upgrade', 'Upgrade': 'tcp'})
+        if status >= 400:
+            writer.close()
+            raise docker.errors.APIError(f'{status} POST /containers/{container_id}/attach')
+
+        return _read_frames(reader, writer)
+
+
+async def _read_frames(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(_FRAME_HEADER.size)
+            except asyncio.IncompleteReadError:
+                return
+            stream, size = _FRAME_HEADER.unpack(header)
+            yield _STREAMS.get(stream, logs.STDOUT), await reader.readexactly(size)
+    finally:
+        writer.close()
+
+
+def get_create_config(image: str, command: list, user: str = None, environment: dict = None,
+                      labels: dict = None, volumes: dict = None, **host_options) -> dict:
+    """
+    Get the body of a create container request from the keyword arguments
+    `docker_client.containers.run` would take, e.g. those returned by
+    `main.get_container_options`
+    """
+
+    host_config = docker.types.HostConfig(API_VERSION, binds=volumes, **host_options)
+    return docker.types.ContainerConfig(
+        API_VERSION, image, command, user=user, environment=environment, labels=labels,
+        host_config=host_config)
+
+
+async def run_container(client: AsyncDockerClient, config: dict, log_stream: logs.LogStream,
+                        timings: timing.Timings = None) -> tuple:
+    """
+    Create and start a container from `config`, feeding its output to
+    `log_stream` until it exits. Returns its ID and exit status, leaving the
+    container for the caller to remove.
+
+    If anything goes wrong before it exits, or the task is cancelled (e.g. on
+    Ctrl-C), the container is killed and removed before the error is passed
+    on, as the caller never gets its ID.
+    """
+
+    container_id = await client.create_container(config)
+    try:
+        frames = await client.attach(container_id)
+        await client.start(container_id)
+        async for stream, chunk in frames:
+            log_stream.feed(stream, chunk)
+        log_stream.close()
+
+        if timings is not None:
+            timings.start(timing.TEARDOWN)
+        status = await client.wait(container_id)
+    except BaseException as exc:
+        tox.reporter.verbosity1(
+            f'{type(exc).__name__} running container {container_id[:12]}, removing it')
+        try:
+            # Shielded, so that it's removed even when this task is cancelled
+            await asyncio.shield(client.remove(container_id, v=True, force=True))
+        except (docker.errors.APIError, OSError, asyncio.CancelledError):
+            pass
+        raise
+
+    return container_id, status
+
+
+@contextlib.asynccontextmanager
+async def container_options(limits: resources.Limits = None):
+    """
+    Get the keyword arguments for a container which apply `limits`, for the
+    duration of the block, like `resources.container_options`, without
+    blocking the event loop while CPUs are leased
+    """
+
+    loop = asyncio.get_running_loop()
+    stack = contextlib.ExitStack()
+    try:
+        options = await loop.run_in_executor(
+            _LEASE_EXECUTOR, stack.enter_context, resources.container_options(limits))
+    except asyncio.CancelledError:
+        # The lease is still taken, so it's given back once it has been
+        _LEASE_EXECUTOR.submit(stack.close)
+        raise
+
+    try:
+        yield options
+    finally:
+        await asyncio.shield(loop.run_in_executor(_LEASE_EXECUTOR, stack.close))
+
+
+async def run_tests(venv: tox.venv.VirtualEnv, image: str, client: AsyncDockerClient = None,
+                    output=None, extra_volumes: dict = None, environment: dict = None,
+                    timings: timing.Timings = None, scratch: str = main.SCRATCH_BIND,
+                    scratch_size: str = None, artifacts_dir: str = None,
+                    artifacts: list = None, artifacts_dest: str = None,
+                    limits: resources.Limits = None) -> str:
+    """
+    Run the tox environment of `venv` in a container of `image`, like
+    `main.run_tests` (which documents the arguments), without blocking the
+    event loop. Returns the container's ID, and the container is left for
+    the caller to remove. Raises `docker.errors.ContainerError` (with the
+    container's ID as its `container`) if it fails.
+    """
+
+    if client is None:
+        client = AsyncDockerClient()
+
+    if output is None:
+        output = tox.reporter.line
+
+    if timings is None:
+        timings = timing.Timings()
+
+    if artifacts and artifacts_dest is None:
+        artifacts_dest = str(venv.envconfig.config.toxinidir)
+
+    env_name = venv.envconfig.envname
+    command = ['-e', env_name]
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as working_dir:
+        async with container_options(limits) as limit_options:
+            run_options = main.get_container_options(
+                working_dir, extra_volumes, environment, scratch, scratch_size, artifacts)
+            config = get_create_config(
+                image, command, user=main.get_user(), **run_options, **limit_options)
+            main.report(output, f'\nRunning env {env_name} in `{image}`!\n')
+
+            timings.start(timing.START)
+            log_stream = logs.LogStream(timings.output_filter(env_name, output))
+            container_id, status = await run_container(client, config, log_stream, timings)
+
+        main.collect_results(working_dir, artifacts_dir, artifacts, artifacts_dest, output)
+
+    if status != 0:
+        raise docker.errors.ContainerError(
+            container_id, status, command, image, log_stream.tail(logs.STDERR).encode())
+
+    return container_id
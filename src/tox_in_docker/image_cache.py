@@ -0,0 +1,100 @@
+"""
+tox_in_docker.image_cache
+
+Keep built images outside of the docker daemon, keyed by what they were built
+from, so that fresh hosts (e.g. ephemeral CI agents) can load them instead of
+building them again
+"""
+
+import os
+import tempfile
+
+import docker
+import docker.errors
+import tox
+
+# A cache location starting with this is a repository in a registry (e.g.
+# `docker://localhost:5000/tox-in-docker`), anything else is a directory of
+# `docker save` tarballs
+REGISTRY_PREFIX = 'docker://'
+
+# The kinds of images cached, by the key they're found by: testing images by
+# `main.get_content_key` and images built from a `docker_build_dir` by
+# `main.get_context_key`
+CONTENT = 'content'
+CONTEXT = 'context'
+
+
+def _get_reference(cache: str, kind: str, key: str) -> tuple:
+    return cache[len(REGISTRY_PREFIX):], f'{kind}-{key}'
+
+
+def _get_tarball_path(cache: str, kind: str, key: str) -> str:
+    return os.path.join(os.path.abspath(os.path.expanduser(cache)), f'{kind}-{key}.tar')
+
+
+def load(client: docker.client.DockerClient, cache: str, kind: str,
+         key: str) -> docker.models.images.Image:
+    """
+    Load the image of `kind` with `key` from `cache` into the daemon, and
+    return it, or `None` if it isn't cached (or can't be loaded)
+    """
+
+    if not cache:
+        return None
+
+    try:
+        if cache.startswith(REGISTRY_PREFIX):
+            repository, tag = _get_reference(cache, kind, key)
+            image = client.images.pull(repository, tag=tag)
+        else:
+            path = _get_tarball_path(cache, kind, key)
+            if not os.path.isfile(path):
+                return None
+            with open(path, 'rb') as tarball:
+                image, *_others = client.images.load(tarball)
+    except (docker.errors.APIError, OSError, ValueError) as exc:
+        tox.reporter.verbosity1(f'No cached {kind} image {key} in `{cache}`: {exc}')
+        return None
+
+    tox.reporter.verbosity1(f'Loaded cached {kind} image {key} from `{cache}`')
+    return image
+
+
+def save(client: docker.client.DockerClient, cache: str, kind: str, key: str,
+         image: docker.models.images.Image) -> None:
+    """
+    Save `image`, of `kind` with `key`, to `cache`. Failing to is only a
+    warning, the image has been built anyway.
+    """
+
+    if not cache:
+        return
+
+    try:
+        if cache.startswith(REGISTRY_PREFIX):
+            repository, tag = _get_reference(cache, kind, key)
+            image.tag(repository, tag=tag)
+            for line in client.api.push(repository, tag=tag, stream=True, decode=True):
+                if 'error' in line:
+                    raise docker.errors.APIError(line['error'])
+        else:
+            path = _get_tarball_path(cache, kind, key)
+            if os.path.isfile(path):
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written alongside and then moved into place, so that concurrent
+            # runs never load half a tarball
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as tarball:
+                try:
+                    for chunk in image.save():
+                        tarball.write(chunk)
+                except BaseException:
+                    os.unlink(tarball.name)
+                    raise
+            os.replace(tarball.name, path)
+    except (docker.errors.APIError, OSError) as exc:
+        tox.reporter.warning(f'Could not save {kind} image {key} to `{cache}`: {exc}')
+        return
+
+    tox.reporter.verbosity1(f'Saved {kind} image {key} to `{cache}`')
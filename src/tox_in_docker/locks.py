@@ -0,0 +1,36 @@
+"""
+tox_in_docker.locks
+
+Lock files shared by the user's tox processes on the host
+"""
+
+import os
+import stat
+import tempfile
+
+import filelock
+
+# Where the lock files are, which only the user may write to, so that nobody
+# else can delete the lock files or swap them for links to other files
+LOCK_DIR = os.path.join(tempfile.gettempdir(), f'tox-in-docker-locks-{os.getuid()}')
+
+
+def file_lock(name: str, timeout: float = -1) -> filelock.FileLock:
+    """
+    Get the lock file called `name`. Raises `PermissionError` if `LOCK_DIR`
+    can't be used safely (i.e. it isn't a dir of the user's that only they may
+    write to), in which case callers should carry on without the lock file.
+    """
+
+    try:
+        os.mkdir(LOCK_DIR, 0o700)
+    except FileExistsError:
+        pass
+
+    # Not followed if it is a link, which someone else could have made
+    info = os.lstat(LOCK_DIR)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+            or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise PermissionError(f'{LOCK_DIR} is not a private dir of this user')
+
+    return filelock.FileLock(os.path.join(LOCK_DIR, name), timeout=timeout)
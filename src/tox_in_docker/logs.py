@@ -0,0 +1,118 @@
+"""
+tox_in_docker.logs
+
+Turn the output streamed from containers into lines
+"""
+
+import codecs
+import collections
+import io
+import json
+import tempfile
+import threading
+
+STDOUT = 'stdout'
+STDERR = 'stderr'
+
+# The number of lines of each stream kept for reporting failures
+DEFAULT_TAIL_LINES = 200
+
+# How much (in bytes) of the output held back to be shown later is kept in
+# memory, the rest goes to a temporary file
+DEFAULT_SPOOL_SIZE = 1024 * 1024
+
+
+class LogStream:
+    """
+    Split the raw chunks of a container's stdout and stderr into lines, and pass
+    each line to `output` as soon as it is complete.
+
+    Chunks aren't aligned to lines (or even to characters), so each stream is
+    decoded incrementally and incomplete lines are held back until the rest
+    arrives. Only the last `tail_lines` lines of each stream are kept, so that
+    failures can be reported without fetching the logs again, while memory
+    use stays bounded however much a container writes.
+    """
+
+    def __init__(self, output, tail_lines: int = DEFAULT_TAIL_LINES):
+        self.output = output
+        self._decoders = {}
+        self._pending = {}
+        self._tails = {}
+        for stream in (STDOUT, STDERR):
+            self._decoders[stream] = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            self._pending[stream] = ''
+            self._tails[stream] = collections.deque(maxlen=tail_lines)
+
+    def feed(self, stream: str, data: bytes) -> None:
+        """
+        Add a chunk of `stream`'s output
+        """
+
+        if not data:
+            return
+
+        text = self._pending[stream] + self._decoders[stream].decode(data)
+        *lines, self._pending[stream] = text.split('\n')
+        for line in lines:
+            self._emit(stream, line)
+
+    def feed_demuxed(self, chunks) -> None:
+        """
+        Add the `(stdout, stderr)` chunks `docker-py` streams with `demux=True`
+        """
+
+        for stdout, stderr in chunks:
+            self.feed(STDOUT, stdout)
+            self.feed(STDERR, stderr)
+
+    def close(self) -> None:
+        """
+        Pass on whatever is left of each stream, even if it isn't a whole line
+        """
+
+        for stream in (STDOUT, STDERR):
+            text = self._pending[stream] + self._decoders[stream].decode(b'', final=True)
+            self._pending[stream] = ''
+            if text:
+                self._emit(stream, text)
+
+    def tail(self, stream: str = STDERR) -> str:
+        """
+        Get the last lines of `stream`
+        """
+
+        return '\n'.join(self._tails[stream])
+
+    def _emit(self, stream: str, line: str) -> None:
+        line = line.rstrip('\r')
+        self._tails[stream].append(line)
+        self.output(line)
+
+
+class SpooledLines:
+    """
+    Lines of output held back to be shown later (e.g. once an environment run
+    alongside others has finished), kept in memory up to `max_size` bytes and
+    in a temporary file beyond that, so that memory use stays bounded however
+    much is written. Lines are added with `append`, from any thread, and read
+    back in order by iterating once they have all been added.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_SPOOL_SIZE):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+')
+        self._lock = threading.Lock()
+
+    def append(self, line: str) -> None:
+        # Encoded, so that each takes one line of the file whatever it holds
+        with self._lock:
+            self._file.seek(0, io.SEEK_END)
+            self._file.write(json.dumps(line) + '\n')
+
+    def __iter__(self):
+        self._file.seek(0)
+        for record in self._file:
+            yield json.loads(record)
+
+    def close(self) -> None:
+        self._file.close()
@@ -1,17 +1,29 @@
 
+import collections
+import contextlib
 import docker
 import docker.errors
-from functools import cache
-from io import BytesIO
+import docker.types
+import docker.utils.build
+import hashlib
+import json
 import os
 import os.path
 import pathlib
 import shutil
 import socket
 import stat
+import subprocess
 import tempfile
+import threading
 import tox
 
+from tox_in_docker import __version__
+from tox_in_docker import image_cache as cache
+from tox_in_docker import locks
+from tox_in_docker import logs
+from tox_in_docker import resources
+from tox_in_docker import timing
 from tox_in_docker import util
 
 BREAK_BEFORE_RUN_ENV = "PDB_BREAK_BEFORE_RUN"
@@ -19,8 +31,59 @@ BREAK_BEFORE_RUN_ENV = "PDB_BREAK_BEFORE_RUN"
 MOUNTED_WORKING_DIR = '/working_dir'
 ENTRYPOINT_FILENAME = 'entrypoint'
 ENTRYPOINT_PATH = os.path.join(MOUNTED_WORKING_DIR, ENTRYPOINT_FILENAME)
+IMAGE_ENTRYPOINT_DIR = '/entrypoint'
+IMAGE_ENTRYPOINT_PATH = os.path.join(IMAGE_ENTRYPOINT_DIR, ENTRYPOINT_FILENAME)
 MOUNT_POINT = '/testing-ro'
 TEST_DIR = '/testing'
+# Where the working dir is kept: `bind` is a host directory, `tmpfs` is in
+# memory and `volume` is an anonymous docker volume. For the last two, only the
+# artifacts (e.g. the log) are written to the host, through a (small) mount.
+SCRATCH_BIND = 'bind'
+SCRATCH_TMPFS = 'tmpfs'
+SCRATCH_VOLUME = 'volume'
+SCRATCH_MODES = (SCRATCH_BIND, SCRATCH_TMPFS, SCRATCH_VOLUME)
+ARTIFACTS_MOUNT = '/artifacts'
+LOG_FILENAME = 'out.log'
+# The glob patterns (one per line) of the artifacts the entrypoint copies from
+# the working dir to the artifacts mount, when it isn't on the host already
+ARTIFACTS_ENV = 'TID_ARTIFACTS'
+
+# The positional arguments (one per line) for tox, instead of the tests dir,
+# e.g. a shard's share of the tests
+POSARGS_ENV = 'TID_POSARGS'
+# The (zero based) index of a shard, and the number of shards, for the tests
+# (e.g. to name coverage data files)
+SHARD_ENV = 'TID_SHARD'
+SHARDS_ENV = 'TID_SHARDS'
+
+# The pip cache (which includes the wheels pip builds) shared between containers
+PIP_CACHE_MOUNT = '/pip-cache'
+PIP_CACHE_VOLUME = 'volume'
+PIP_CACHE_VOLUME_PREFIX = 'tox-in-docker-pip-'
+PIP_CACHE_MAX_KB_ENV = 'TID_PIP_CACHE_MAX_KB'
+
+# Volumes keeping tox's work dir (and so its virtualenvs) between runs
+ENVDIR_VOLUME_PREFIX = 'tox-in-docker-envdir-'
+PROJECT_LABEL = 'tox-in-docker.project'
+ENV_LABEL = 'tox-in-docker.env'
+SHARED_ENV = 'shared'
+
+# Snapshots of containers after tox has set an environment up, keyed by what
+# went into the setup. tox's work dir is moved out of the mounted working dir
+# (to `SNAPSHOT_WORKDIR`) for them, as mounts aren't included in a snapshot.
+SNAPSHOT_KEY_LABEL = 'tox-in-docker.snapshot-key'
+SNAPSHOT_WORKDIR = '/tox-work'
+WORKDIR_ENV = 'TID_WORKDIR'
+
+# The name the host user is given in containers, which are run as their UID
+USER_NAME = 'tox'
+
+# Images built by this plugin are labelled with a key derived from everything
+# that goes into them, so identical builds can be found again by later runs
+CONTENT_KEY_LABEL = 'tox-in-docker.content-key'
+# Likewise, images built from a `docker_build_dir` are labelled with a key
+# derived from the build context and build args
+CONTEXT_KEY_LABEL = 'tox-in-docker.context-key'
 
 HERE_MOUNT = {
     os.getcwd(): {
@@ -29,27 +92,39 @@ HERE_MOUNT = {
     }
 }
 
-# I'm not sure if keeping these to single statements in the try statements
-# is a foolish consistency (could combine them all in one and that _should_
-# work identically.)
-
-try:
-    MY_UID = os.getuid()
-except OSError:
-    MY_UID = pathlib.Path().stat().st_uid
-
-try:
-    MY_GID = os.getgid()
-except OSError:
-    MY_GID = pathlib.Path().stat().st_gid
-
-try:
-    MY_USERNAME = os.getlogin()
-except OSError:
-    MY_USERNAME = pathlib.Path().owner()
-
 ENTRYPOINT_PERMS = stat.S_IWUSR | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
 
+# Arguments understood by the entrypoint (as the first argument) which switch
+# it from running a single environment to serving several with `docker exec`
+IDLE_ARG = '--tid-idle'
+EXEC_ARG = '--tid-exec'
+# How the entrypoint syncs the source into the working dir. By default it is
+# copied afresh; the warm modes update a copy kept in a volume between runs
+SYNC_ENV = 'TID_SYNC'
+SYNC_WARM = 'warm'
+SYNC_WARM_CHECKSUM = 'warm-checksum'
+SYNC_MODES = (SYNC_WARM, SYNC_WARM_CHECKSUM)
+SOURCE_VOLUME_PREFIX = 'tox-in-docker-src-'
+# Printed by the entrypoint once an idle container is ready for `docker exec`
+READY_MARKER = 'tox-in-docker: ready'
+# Arguments for the containers kept warm between runs (see `pool`): the first
+# starts one, which exits after being unused for a while, the second brings
+# the working dir of one up to date with the source before it is reused
+POOL_ARG = '--tid-pool'
+RESYNC_ARG = '--tid-resync'
+# A warm container is claimed by a run by creating this directory, which only
+# one run can do, once the ready file exists. The last used file is touched
+# whenever it is claimed or released, which keeps it alive.
+POOL_READY_PATH = '/tmp/tox-in-docker.ready'
+POOL_CLAIM_PATH = '/tmp/tox-in-docker.claimed'
+POOL_LAST_USED_PATH = '/tmp/tox-in-docker.last-used'
+# Holds a file for each environment being run with `docker exec`, so that an
+# idle container (see `SharedContainer`) doesn't exit under it. The last used
+# file is touched once each has finished.
+EXEC_BUSY_PATH = '/tmp/tox-in-docker.busy'
+# How long (in seconds) an idle or warm container is kept once unused, by default
+DEFAULT_IDLE_TTL = 30 * 60
+
 # use `.format(env_name=env_name)` to complete this
 # ToDo diff state of cwd so that local diffs are copied over
 ENTRYPOINT_SCRIPT_TEMPL = f"""#!/bin/bash
@@ -57,96 +132,606 @@ set -e
 # `set -x` will print all commands as they are being run
 #set -x
 
-sudo chmod -R 1777 {MOUNTED_WORKING_DIR}
-
-if test -d {MOUNT_POINT}/.git ; then
-    cd {MOUNT_POINT}
-    # Create a local git remote and push to it. This is _much_ faster than copying
-    # the whole directory, and avoids colliding temp files
-    # ToDo: handle this for non-git cases, and replace git if the new method is
-    # performant
-    BRANCH=$(git branch --show-current)
-    # Get a diff to patch the working copy
-    git diff > /tmp/git.patch
-    git init {MOUNTED_WORKING_DIR} 2> /dev/null
-    git push {MOUNTED_WORKING_DIR}
+sync_source() {{
+    echo "{timing.PHASE_MARKER} {timing.SYNC}"
+    case "${{{SYNC_ENV}:-}}" in
+        {SYNC_WARM}|{SYNC_WARM_CHECKSUM})
+            sync_warm
+            ;;
+        *)
+            sync_fresh
+            ;;
+    esac
+}}
+
+sync_warm() {{
+    # The working dir is a volume kept between runs, so only copy what changed,
+    # going by modification time and size (or content, if asked to)
+    checksum=''
+    if test "${{{SYNC_ENV}}}" = "{SYNC_WARM_CHECKSUM}" ; then
+        checksum='--checksum'
+    fi
+
+    rsync -rlt --delete $checksum --exclude /.tox --exclude /.venv {MOUNT_POINT}/ {MOUNTED_WORKING_DIR}
     cd {MOUNTED_WORKING_DIR}
-    git checkout "${{BRANCH}}" 2> /dev/null
-    test -s /tmp/git.patch && git apply /tmp/git.patch
-elif test -n "$(ls -A {MOUNT_POINT} 2> /dev/null)" ; then
-    sudo rsync -avzO --no-perms {MOUNT_POINT}/ --exclude .venv --exclude .tox {MOUNTED_WORKING_DIR}
-    sudo chown -R {MY_UID}:{MY_GID} {MOUNTED_WORKING_DIR}
+}}
+
+sync_fresh() {{
+    # A repo without commits has no HEAD to fetch or diff against, so it is
+    # copied like any other dir
+    if test -d {MOUNT_POINT}/.git \\
+            && git -C {MOUNT_POINT} rev-parse -q --verify HEAD > /dev/null ; then
+        cd {MOUNT_POINT}
+        # Create a local git repo and fetch into it. This is _much_ faster than copying
+        # the whole directory, and avoids colliding temp files
+        # (falling back to a branch of our own if HEAD is detached)
+        BRANCH=$(git branch --show-current)
+        BRANCH=${{BRANCH:-tox-in-docker}}
+        # Get a diff (of staged and unstaged changes) to patch the working copy
+        git diff --binary HEAD > /tmp/git.patch
+        # Neither the fetch nor the diff include untracked files, so copy those
+        # (leaving out ignored ones, and virtualenvs like rsync below) as they are
+        git ls-files -z --others --exclude-standard --exclude .venv --exclude .tox \
+            > /tmp/git.untracked
+        git init -q {MOUNTED_WORKING_DIR}
+        cd {MOUNTED_WORKING_DIR}
+        git fetch -q {MOUNT_POINT} HEAD
+        git checkout -q -B "${{BRANCH}}" FETCH_HEAD
+        if test -s /tmp/git.patch ; then
+            git apply /tmp/git.patch
+        fi
+        tar -C {MOUNT_POINT} --null -T /tmp/git.untracked -cf - | tar -xf -
+    elif test -n "$(ls -A {MOUNT_POINT} 2> /dev/null)" ; then
+        rsync -rlt {MOUNT_POINT}/ --exclude .venv --exclude .tox {MOUNTED_WORKING_DIR}
+        cd {MOUNTED_WORKING_DIR}
+    fi
+}}
+
+# The image isn't built for any one user, and the container runs as the host
+# user's UID and GID, so add them to the passwd and group files if they aren't
+# there, for anything that looks the user up (like sudo, or `~`)
+add_user() {{
+    uid=$(id -u)
+    gid=$(id -g)
+
+    if ! getent group "${{gid}}" > /dev/null ; then
+        name={USER_NAME}
+        if getent group "${{name}}" > /dev/null ; then
+            name="{USER_NAME}-${{gid}}"
+        fi
+        echo "${{name}}:x:${{gid}}:" >> /etc/group
+    fi
+
+    if ! getent passwd "${{uid}}" > /dev/null ; then
+        name={USER_NAME}
+        if getent passwd "${{name}}" > /dev/null ; then
+            name="{USER_NAME}-${{uid}}"
+        fi
+        echo "${{name}}:x:${{uid}}:${{gid}}::/home/${{name}}:/bin/bash" >> /etc/passwd
+    fi
+
+    HOME=$(getent passwd "${{uid}}" | cut -d: -f6)
+    USER=$(getent passwd "${{uid}}" | cut -d: -f1)
+    export HOME USER
+    mkdir -p "${{HOME}}" 2> /dev/null || true
+}}
+
+# The container runs as the host user, which owns the working dir it is
+# given, so nothing in it needs its ownership or permissions changed. Only the
+# top of a new named volume, which is owned by root, needs fixing.
+prepare_mounts() {{
+    for dir in {MOUNTED_WORKING_DIR} {MOUNTED_WORKING_DIR}/.tox ; do
+        if test -d "${{dir}}" && ! test -w "${{dir}}" ; then
+            sudo chown "$(id -u):$(id -g)" "${{dir}}"
+        fi
+    done
+
+    # tox's work dir, when it is kept out of the working dir
+    if test -n "${{{WORKDIR_ENV}:-}}" && ! test -w "${{{WORKDIR_ENV}}}" ; then
+        sudo mkdir -p "${{{WORKDIR_ENV}}}"
+        sudo chown "$(id -u):$(id -g)" "${{{WORKDIR_ENV}}}"
+    fi
+
+    # The pip cache may be shared with other users
+    if test -n "${{PIP_CACHE_DIR:-}}" && ! test -w "${{PIP_CACHE_DIR}}" ; then
+        sudo chmod 1777 "${{PIP_CACHE_DIR}}"
+    fi
+}}
+
+# pip doesn't say which cache entries it used, so those read since `$1` was
+# made (where the filesystem keeps access times, which `touch` keeps equal to
+# the modification time so that `relatime` updates them) and the wheels of
+# the packages installed in the tox work dir `$2` are touched, and the cache
+# is trimmed by modification time
+touch_pip_cache() {{
+    if test -z "${{{PIP_CACHE_MAX_KB_ENV}:-}}" || ! test -d "${{PIP_CACHE_DIR:-}}" ; then
+        return 0
+    fi
+
+    find "${{PIP_CACHE_DIR}}" -type f -anewer "$1" -exec touch {{}} +
+    if test -d "$2" ; then
+        find "$2" -name '*.dist-info' -type d -printf '/%f\\n' | sed 's/\\.dist-info$/-/' > "$1"
+        find "${{PIP_CACHE_DIR}}" -type f -name '*.whl' | grep -F -f "$1" | xargs -r -d '\\n' touch
+    fi
+    return 0
+}}
+
+trim_pip_cache() {{
+    if test -z "${{{PIP_CACHE_MAX_KB_ENV}:-}}" || ! test -d "${{PIP_CACHE_DIR:-}}" ; then
+        return 0
+    fi
+
+    used=$(du -sk "${{PIP_CACHE_DIR}}" | cut -f1)
+    if test "${{used}}" -le "${{{PIP_CACHE_MAX_KB_ENV}}}" ; then
+        return 0
+    fi
+
+    # Remove the least recently used files until the cache fits
+    find "${{PIP_CACHE_DIR}}" -type f -printf '%T@ %k %p\\n' | sort -n | while read -r _ size path ; do
+        test "${{used}}" -le "${{{PIP_CACHE_MAX_KB_ENV}}}" && break
+        rm -f "${{path}}" && used=$((used - size))
+    done
+    return 0
+}}
+
+collect_artifacts() {{
+    if test -z "${{{ARTIFACTS_ENV}:-}}" || ! test -d {ARTIFACTS_MOUNT} ; then
+        return 0
+    fi
+
     cd {MOUNTED_WORKING_DIR}
-fi
+    shopt -s globstar nullglob dotglob
+    while IFS= read -r pattern ; do
+        for path in $pattern ; do
+            # Nothing outside the working dir, even through a link
+            case "$(realpath -- "${{path}}")" in
+                {MOUNTED_WORKING_DIR}/*) cp -R --parents "${{path}}" {ARTIFACTS_MOUNT}/ ;;
+                *) echo "Not copying artifact ${{path}}, it is outside {MOUNTED_WORKING_DIR}" >&2 ;;
+            esac
+        done
+    done <<< "${{{ARTIFACTS_ENV}}}"
+    shopt -u globstar nullglob dotglob
+    cd - > /dev/null
+}}
 
-if pip show tox-in-docker 2> /dev/null; then
-    ignore_me='--no_tox_in_docker'
-fi
+run_tox() {{
+    if pip show tox-in-docker 2> /dev/null; then
+        ignore_me='--no_tox_in_docker'
+    fi
 
-LOG_DIR=$(test -d {MOUNTED_WORKING_DIR} && echo "{MOUNTED_WORKING_DIR}" || echo "/var/log")
+    if test -n "${{{WORKDIR_ENV}:-}}" ; then
+        workdir="--workdir=${{{WORKDIR_ENV}}}"
+    fi
 
-# Don't immediately fail if tox fails, we want to cleanup (fix perms)
-set +e
+    if test -d {ARTIFACTS_MOUNT} ; then
+        LOG_DIR={ARTIFACTS_MOUNT}
+    elif test -d {MOUNTED_WORKING_DIR} ; then
+        LOG_DIR={MOUNTED_WORKING_DIR}
+    else
+        LOG_DIR=/var/log
+    fi
 
-set -o pipefail
-tox $ignore_me "$@" ./tests | tee "${{LOG_DIR}}/out.log"
-res=$?
-set +o pipefail
+    if test -n "${{{POSARGS_ENV}:-}}" ; then
+        mapfile -t posargs <<< "${{{POSARGS_ENV}}}"
+        posargs=(-- "${{posargs[@]}}")
+    else
+        posargs=(./tests)
+    fi
 
-sudo chown -R 0:0 {MOUNTED_WORKING_DIR}
-sudo chmod -R 1777 {MOUNTED_WORKING_DIR}
+    # Don't immediately fail if tox fails, we want to clean up (trim the cache)
+    set +e
 
-exit $res
+    pip_cache_marker=$(mktemp)
 
-"""
+    echo "{timing.PHASE_MARKER} {timing.SETUP}"
+    set -o pipefail
+    tox $ignore_me $workdir "$@" "${{posargs[@]}}" | tee "${{LOG_DIR}}/{LOG_FILENAME}"
+    res=$?
+    set +o pipefail
+
+    collect_artifacts
+    touch_pip_cache "${{pip_cache_marker}}" "${{{WORKDIR_ENV}:-.tox}}"
+    trim_pip_cache
+    rm -f "${{pip_cache_marker}}"
+
+    return $res
+}}
 
+add_user
+prepare_mounts
 
-DOCKERFILE_TEMPL = f"""FROM {{base}}
+case "$1" in
+    {IDLE_ARG})
+        # Sync once, then wait for environments to be run with `docker exec`,
+        # until none has been for the number of seconds given
+        sync_source
+        touch {POOL_LAST_USED_PATH}
+        echo "{READY_MARKER}"
+        while test -n "$(ls -A {EXEC_BUSY_PATH} 2> /dev/null)" \
+                || test $(( $(date +%s) - $(stat -c %Y {POOL_LAST_USED_PATH}) )) -lt "$2" ; do
+            sleep 5
+        done
+        ;;
+    {POOL_ARG})
+        # Sync once, then wait to be claimed, until unclaimed and unused for
+        # the number of seconds given
+        sync_source
+        touch {POOL_LAST_USED_PATH} {POOL_READY_PATH}
+        echo "{READY_MARKER}"
+        while test -d {POOL_CLAIM_PATH} \
+                || test $(( $(date +%s) - $(stat -c %Y {POOL_LAST_USED_PATH}) )) -lt "$2" ; do
+            sleep 5
+        done
+        ;;
+    {RESYNC_ARG})
+        sync_warm
+        ;;
+    {EXEC_ARG})
+        shift
+        mkdir -p {EXEC_BUSY_PATH}
+        busy="$(mktemp -p {EXEC_BUSY_PATH})"
+        trap 'rm -f "${{busy}}" ; touch {POOL_LAST_USED_PATH}' EXIT
+        if test -n "$(ls -A {MOUNTED_WORKING_DIR} 2> /dev/null)" ; then
+            cd {MOUNTED_WORKING_DIR}
+        fi
+        run_tox "$@"
+        ;;
+    *)
+        sync_source
+        run_tox "$@"
+        ;;
+esac
+
+"""
 
-ARG UNAME={MY_USERNAME}
-ARG UID={MY_UID}
-ARG GID={MY_GID}
 
-RUN groupadd -g $GID -o $UNAME
-RUN useradd -m -u $UID -g $GID -o -s /bin/bash $UNAME
+# The tooling stage only depends on the base image, so its layers stay cached
+# whatever changes in the stage for the entrypoint, which is kept as thin as
+# possible. Nothing in the image is specific to a user, so one image serves
+# everybody on a host. Use `render_dockerfile` to complete this.
+DOCKERFILE_TEMPL = f"""{{syntax}}FROM {{base}} AS tooling
 
-RUN pip install --no-input --disable-pip-version-check tox
-RUN apt update && apt install -y git sudo rsync
+RUN {{apt_cache}}apt-get update \\
+    && apt-get install -y --no-install-recommends git sudo rsync{{apt_cleanup}}
+RUN {{pip_cache}}pip install --no-input --disable-pip-version-check tox
 
-# Remove secure path from sudoers so we can get pythons and such
-RUN sed '/^Defaults[[:space:]]\\+secure_path/d' /etc/sudoers > /tmp/sudoers
-RUN echo "$UNAME ALL=(ALL:ALL) NOPASSWD:ALL" >> /tmp/sudoers
-# ensure sudoers is valid
-RUN visudo -cf /tmp/sudoers && cp /tmp/sudoers /etc/sudoers
+# Remove secure path from sudoers so we can get pythons and such (and ensure
+# sudoers is still valid)
+RUN sed '/^Defaults[[:space:]]\\+secure_path/d' /etc/sudoers > /tmp/sudoers \\
+    && visudo -cf /tmp/sudoers && cp /tmp/sudoers /etc/sudoers && rm /tmp/sudoers
 
-RUN mkdir {MOUNTED_WORKING_DIR} {MOUNT_POINT} /entrypoint
-COPY {ENTRYPOINT_FILENAME} /entrypoint/{ENTRYPOINT_FILENAME}
-RUN chown  -R {MY_UID}:{MY_GID} {MOUNTED_WORKING_DIR} {MOUNT_POINT} /entrypoint
-RUN chmod -R 1775 {MOUNTED_WORKING_DIR} {MOUNT_POINT} /entrypoint
+FROM tooling
 
-USER $UNAME
+# Containers run as the host user, whoever that is, and the entrypoint adds
+# them to the passwd and group files (so anyone may write to those). Everyone
+# may use sudo, and the dirs they need are shared like `/tmp`.
+RUN echo "ALL ALL=(ALL:ALL) NOPASSWD:ALL" > /tmp/sudoers \\
+    && visudo -cf /tmp/sudoers && cat /tmp/sudoers >> /etc/sudoers && rm /tmp/sudoers \\
+    && chmod a+w /etc/passwd /etc/group \\
+    && mkdir {MOUNTED_WORKING_DIR} {MOUNT_POINT} {IMAGE_ENTRYPOINT_DIR} \\
+    && chmod 1777 /home {MOUNTED_WORKING_DIR} {MOUNT_POINT} {IMAGE_ENTRYPOINT_DIR}
+
+COPY {ENTRYPOINT_FILENAME} {IMAGE_ENTRYPOINT_PATH}
 
 WORKDIR {MOUNT_POINT}
-ENTRYPOINT ["/entrypoint/entrypoint"]
+ENTRYPOINT ["{IMAGE_ENTRYPOINT_PATH}"]
 
 """
 
 
-@cache
+def render_dockerfile(base: str, buildkit: bool = False) -> str:
+    """
+    Render the Dockerfile for the testing image based on `base`.
+
+    With `buildkit`, apt and pip downloads are kept in BuildKit cache mounts,
+    so they're shared between builds (including builds for other bases).
+    Otherwise, apt's lists are removed to keep the image small.
+    """
+
+    if buildkit:
+        return DOCKERFILE_TEMPL.format(
+            syntax='# syntax=docker/dockerfile:1\n',
+            base=base,
+            apt_cache=' '.join([
+                '--mount=type=cache,target=/var/cache/apt,sharing=locked',
+                '--mount=type=cache,target=/var/lib/apt/lists,sharing=locked',
+                # The debian images delete downloaded packages unless told not to
+                'rm -f /etc/apt/apt.conf.d/docker-clean && ']),
+            apt_cleanup='',
+            pip_cache='--mount=type=cache,target=/root/.cache/pip ')
+
+    return DOCKERFILE_TEMPL.format(
+        syntax='',
+        base=base,
+        apt_cache='',
+        apt_cleanup=' \\\n    && rm -rf /var/lib/apt/lists/*',
+        pip_cache='')
+
+
+def get_user() -> str:
+    """
+    Get the `user:group` containers are run as, the host user's UID and GID,
+    so that what they write to mounted dirs is owned by them. The entrypoint
+    names them inside the container, the image doesn't know who they are.
+    """
+
+    return f'{os.getuid()}:{os.getgid()}'
+
+
+def get_content_key(base: str, base_image_id: str, buildkit: bool = False) -> str:
+    """
+    Get a key identifying the testing image built on top of `base`.
+
+    The key covers the rendered Dockerfile and entrypoint, the ID of the base
+    image and the plugin version, so it only changes when the resulting image
+    would. It doesn't depend on the user, as the image doesn't.
+    """
+
+    hasher = hashlib.sha256()
+    for part in (render_dockerfile(base, buildkit),
+                 ENTRYPOINT_SCRIPT_TEMPL,
+                 base_image_id,
+                 __version__):
+        hasher.update(part.encode())
+        # separate the parts so that they can't run into each other
+        hasher.update(b'\0')
+
+    return hasher.hexdigest()
+
+
+def find_labelled_image(
+        client: docker.client.DockerClient, label: str, value: str
+    ) -> docker.models.images.Image:
+    """
+    Return a local image with `label` set to `value`, or `None` if there isn't
+    one.
+    """
+
+    images = client.images.list(filters={'label': f'{label}={value}'})
+    return images[0] if images else None
+
+
+def build_with_buildkit(
+        client: docker.client.DockerClient, path: str, tag: str, labels: dict = None
+    ) -> docker.models.images.Image:
+    """
+    Build the image in `path` with the docker CLI and BuildKit, which the API
+    (and so `docker-py`) can't use, and return it.
+
+    Raises `docker.errors.BuildError` if the build fails, as `docker-py` would.
+    """
+
+    command = ['docker', 'build', '--tag', tag]
+    for name, value in (labels or {}).items():
+        command.extend(['--label', f'{name}={value}'])
+    command.append(path)
+
+    try:
+        subprocess.run(
+            command, check=True, capture_output=True, text=True,
+            env={**os.environ, 'DOCKER_BUILDKIT': '1'})
+    except subprocess.CalledProcessError as exc:
+        raise docker.errors.BuildError(exc.stderr, exc.stderr.splitlines())
+
+    return client.images.get(tag)
+
+
+def read_dockerignore(path: str) -> list:
+    """
+    Get the patterns in the `.dockerignore` of the build context `path`, as
+    `docker-py` reads them
+    """
+
+    dockerignore = os.path.join(path, '.dockerignore')
+    if not os.path.exists(dockerignore):
+        return []
+
+    with open(dockerignore) as dockerignore_file:
+        return [line.strip() for line in dockerignore_file.read().splitlines()
+                if line.strip() and not line.strip().startswith('#')]
+
+
+def get_context_key(path: str, buildargs: dict = None) -> str:
+    """
+    Get a key identifying the image built from the build context `path` with
+    `buildargs`. It covers the path, type, permissions and content of every
+    file in the context which `.dockerignore` doesn't exclude (i.e. what would
+    be sent to the daemon), and the build args.
+    """
+
+    root = os.path.abspath(path)
+    hasher = hashlib.sha256()
+    hasher.update(repr(sorted((buildargs or {}).items())).encode())
+
+    for name in sorted(docker.utils.build.exclude_paths(root, read_dockerignore(root))):
+        full_path = os.path.join(root, name)
+        info = os.lstat(full_path)
+        hasher.update(b'\0' + name.encode() + b'\0' + oct(info.st_mode).encode() + b'\0')
+
+        if stat.S_ISLNK(info.st_mode):
+            hasher.update(os.readlink(full_path).encode())
+        elif stat.S_ISREG(info.st_mode):
+            with open(full_path, 'rb') as context_file:
+                for chunk in iter(lambda: context_file.read(1024 * 1024), b''):
+                    hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def build_context(
+        client: docker.client.DockerClient, path: str, tag: str, buildargs: dict = None,
+        image_cache: str = None
+    ) -> docker.models.images.Image:
+    """
+    Build the image in the build context `path` with `buildargs`, tagged `tag`.
+
+    If an image has already been built from the same context and build args
+    (see `get_context_key`), it is tagged and reused instead, so that the
+    context isn't uploaded to the daemon again. With an `image_cache` (see
+    `image_cache`), the image is loaded from it if it isn't in the daemon,
+    and saved to it once it's built.
+    """
+
+    context_key = get_context_key(path, buildargs)
+    existing = (find_labelled_image(client, CONTEXT_KEY_LABEL, context_key)
+                or cache.load(client, image_cache, cache.CONTEXT, context_key))
+    if existing is not None:
+        tox.reporter.verbosity1(f'Reusing image {existing.id} built from `{path}`')
+        if tag not in existing.tags:
+            existing.tag(tag)
+        return existing
+
+    image, _logs = client.images.build(
+        buildargs=buildargs,
+        path=path,
+        labels={CONTEXT_KEY_LABEL: context_key},
+        tag=tag)
+    cache.save(client, image_cache, cache.CONTEXT, context_key, image)
+    return image
+
+
+def is_testing_image(image: docker.models.images.Image) -> bool:
+    """
+    Return `True` if `image` is a testing image built by this plugin (which
+    has tox and the entrypoint), going by its labels, so no containers are
+    run to find out
+    """
+
+    return CONTENT_KEY_LABEL in (image.labels or {})
+
+
+def _get_base_image(client: docker.client.DockerClient, base: str) -> docker.models.images.Image:
+    try:
+        return client.images.get(base)
+    except docker.errors.ImageNotFound:
+        return client.images.pull(base)
+
+
+# The docker client shared by everything in a tox session, see `get_client`
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+DEFAULT_POOL_SIZE = 10
+
+
+def get_client(pool_size: int = None) -> docker.client.DockerClient:
+    """
+    Get the docker client shared by all of the plugin's hooks, creating it the
+    first time this is called. Its connection pool holds up to `pool_size`
+    connections (only used when it is created), which should be at least the
+    number of environments run at once.
+
+    Creating a client sets up a new session with the daemon, which is
+    noticeably slow for a remote `DOCKER_HOST` (e.g. over SSH).
+    """
+
+    global _CLIENT
+
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = docker.client.from_env(max_pool_size=pool_size or DEFAULT_POOL_SIZE)
+        return _CLIENT
+
+
+def close_client() -> None:
+    """
+    Close the shared docker client, if there is one
+    """
+
+    global _CLIENT
+
+    with _CLIENT_LOCK:
+        if _CLIENT is not None:
+            _CLIENT.close()
+            _CLIENT = None
+
+
+# Testing images already built (or found) by this process, keyed by base
+_BUILT_IMAGES = {}
+_BUILD_LOCKS = collections.defaultdict(threading.Lock)
+_BUILD_LOCKS_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def build_lock(key: str):
+    """
+    Hold the lock for building `key`. The lock is shared between threads and,
+    through a lock file, between the user's processes (e.g. the ones `tox -p`
+    starts), so that the same image is only built once at a time. If the lock
+    file can't be used, only the thread lock is held.
+    """
+
+    with _BUILD_LOCKS_LOCK:
+        lock = _BUILD_LOCKS[key]
+
+    with lock, contextlib.ExitStack() as stack:
+        try:
+            stack.enter_context(locks.file_lock(
+                f'build-{hashlib.sha256(key.encode()).hexdigest()[:16]}.lock'))
+        except PermissionError as exc:
+            tox.reporter.verbosity1(f'Could not take the lock file to build {key}: {exc}')
+        yield
+
+
+def clear_build_cache() -> None:
+    """
+    Forget the testing images built by this process
+    """
+
+    _BUILT_IMAGES.clear()
+
+
 def build_testing_image(
-        base: str, client:docker.client.DockerClient = None
+        base: str, client:docker.client.DockerClient = None, buildkit: bool = False,
+        image_cache: str = None
     ) -> docker.models.images.Image:
     """
     Build the testing image for a given version of Python
+
+    If an image has already been built from the same inputs (see
+    `get_content_key`), it is reused instead of being built again. This is
+    safe to call from several threads at once; concurrent calls for the same
+    `base` wait for a single build.
+
+    With `buildkit`, the image is built by the docker CLI using BuildKit, which
+    lets apt and pip keep their downloads in cache mounts between builds.
+
+    With an `image_cache` (see `image_cache`), the image is loaded from it if
+    it isn't in the daemon, and saved to it once it's built, so that hosts
+    which start empty needn't build it.
     """
 
+    with build_lock(base):
+        if base not in _BUILT_IMAGES:
+            _BUILT_IMAGES[base] = _build_testing_image(base, client, buildkit, image_cache)
+    return _BUILT_IMAGES[base]
+
+
+def _build_testing_image(
+        base: str, client:docker.client.DockerClient = None, buildkit: bool = False,
+        image_cache: str = None
+    ) -> docker.models.images.Image:
+
     tag = f'{base}-{socket.gethostname()}-tox-in-docker'
 
     if client is None:
-        client = docker.client.from_env()
+        client = get_client()
+
+    base_image = _get_base_image(client, base)
+    if is_testing_image(base_image):
+        # e.g. an image from `--docker_image_cache` given as `docker_image`
+        tox.reporter.verbosity1(f'`{base}` is already a testing image')
+        return base_image
+
+    content_key = get_content_key(base, base_image.id, buildkit)
+    existing = (find_labelled_image(client, CONTENT_KEY_LABEL, content_key)
+                or cache.load(client, image_cache, cache.CONTENT, content_key))
+    if existing is not None:
+        tox.reporter.verbosity1(f'Reusing testing image {existing.id} for `{base}`')
+        if tag not in existing.tags:
+            existing.tag(tag)
+        return existing
 
     original_cwd = os.getcwd()
-    dockerfile = BytesIO(DOCKERFILE_TEMPL.format(base=base).encode())
     # ToDo revisit ignore cleanup errors
     with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as build_dir:
         try:
@@ -155,20 +740,405 @@ def build_testing_image(
             entrypoint_path.chmod(ENTRYPOINT_PERMS)
 
             dockerfile_path = pathlib.Path(build_dir).joinpath('Dockerfile')
-            dockerfile_path.write_text(DOCKERFILE_TEMPL.format(base=base))
-            built, _logs = client.images.build(
-                path=build_dir,
-                tag=tag)
+            dockerfile_path.write_text(render_dockerfile(base, buildkit))
+            if buildkit:
+                built = build_with_buildkit(
+                    client, build_dir, tag, labels={CONTENT_KEY_LABEL: content_key})
+            else:
+                built, _logs = client.images.build(
+                    path=build_dir,
+                    labels={CONTENT_KEY_LABEL: content_key},
+                    tag=tag)
         finally:
             os.chdir(original_cwd)
+
+    cache.save(client, image_cache, cache.CONTENT, content_key, built)
     return built
 
 
+def _get_volumes(working_dir: str, extra_volumes: dict = None) -> dict:
+    # Without a `working_dir`, the image's own (empty) working dir is used
+    volumes = {}
+    if working_dir is not None:
+        volumes[working_dir] = {
+            'bind': MOUNTED_WORKING_DIR,
+            'mode': 'rw'
+        }
+
+    volumes.update(HERE_MOUNT)
+
+    extra_volumes = extra_volumes or {}
+    if any(mount['bind'] == MOUNTED_WORKING_DIR for mount in extra_volumes.values()):
+        # The working dir is replaced (e.g. by a warm source volume)
+        volumes.pop(working_dir, None)
+
+    volumes.update(extra_volumes)
+    return volumes
+
+
+# Prints the most specific wheel tag the image's Python accepts, e.g.
+# `cp311-cp311-manylinux_2_36_x86_64` (or `musllinux_1_2_x86_64` on alpine)
+WHEEL_TAG_SCRIPT = 'from pip._vendor.packaging import tags; print(next(iter(tags.sys_tags())))'
+
+# Wheel tags of the images already looked at, by image ID, kept between runs
+# (for the most recent `WHEEL_TAGS_LIMIT` images) in `WHEEL_TAGS_PATH`
+_WHEEL_TAGS = {}
+WHEEL_TAGS_PATH = os.path.join(
+    os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'tox-in-docker', 'wheel-tags.json')
+WHEEL_TAGS_LIMIT = 256
+
+
+def _load_wheel_tags() -> dict:
+    try:
+        with open(WHEEL_TAGS_PATH) as tags_file:
+            tags = json.load(tags_file)
+    except (OSError, ValueError):
+        return {}
+    return tags if isinstance(tags, dict) else {}
+
+
+def _save_wheel_tag(image_id: str, tag: str) -> None:
+    """
+    Add the wheel tag of `image_id` to `WHEEL_TAGS_PATH`, alongside those
+    other tox processes have saved. Failing to is fine, it's only looked up
+    again next time.
+    """
+
+    tags = _load_wheel_tags()
+    tags.pop(image_id, None)
+    tags[image_id] = tag
+    tags = dict(list(tags.items())[-WHEEL_TAGS_LIMIT:])
+
+    try:
+        os.makedirs(os.path.dirname(WHEEL_TAGS_PATH), exist_ok=True)
+        # Replaced in one go, so other processes never read half of it
+        with tempfile.NamedTemporaryFile(
+                'w', dir=os.path.dirname(WHEEL_TAGS_PATH), delete=False) as tags_file:
+            json.dump(tags, tags_file, indent=2)
+        os.replace(tags_file.name, WHEEL_TAGS_PATH)
+    except OSError as exc:
+        tox.reporter.verbosity1(f'Could not save the wheel tag of {image_id}: {exc}')
+
+
+def get_wheel_tag(image: docker.models.images.Image, client: docker.client.DockerClient) -> str:
+    """
+    Get the ABI and platform containers of `image` build wheels for (e.g.
+    `cp311-manylinux_2_36_x86_64`), which covers their libc and architecture.
+    Falls back to the image's OS and architecture if its Python can't say.
+
+    Finding out takes a container, so it's only done once per image, and
+    remembered by later tox runs too.
+    """
+
+    if image.id not in _WHEEL_TAGS:
+        saved = _load_wheel_tags().get(image.id)
+        if saved is not None:
+            _WHEEL_TAGS[image.id] = saved
+
+    if image.id not in _WHEEL_TAGS:
+        try:
+            output = client.containers.run(
+                image.id, ['-c', WHEEL_TAG_SCRIPT], entrypoint='python', user=get_user(),
+                remove=True)
+            _interpreter, abi, platform = output.decode().strip().split('-', 2)
+            _WHEEL_TAGS[image.id] = f'{abi}-{platform}'
+            _save_wheel_tag(image.id, _WHEEL_TAGS[image.id])
+        except (docker.errors.DockerException, ValueError) as exc:
+            tox.reporter.verbosity1(f'Could not get the wheel tag of {image.id}: {exc}')
+            _WHEEL_TAGS[image.id] = '-'.join(filter(None, (
+                image.attrs.get(attr) for attr in ('Os', 'Architecture', 'Variant'))))
+
+    return _WHEEL_TAGS[image.id]
+
+
+def get_pip_cache_key(
+        image: docker.models.images.Image, client: docker.client.DockerClient
+    ) -> str:
+    """
+    Get the key for the pip cache used by containers of `image`.
+
+    Wheels are only reusable by the same Python on the same platform, so the
+    key is the Python implementation and version the image was built with
+    (which the official `python` and `pypy` images set in their environment)
+    and its wheel tag (see `get_wheel_tag`), falling back to the image itself.
+    """
+
+    env = dict(var.split('=', 1) for var in image.attrs.get('Config', {}).get('Env') or [])
+
+    for implementation, var in (('pypy', 'PYPY_VERSION'), ('cpython', 'PYTHON_VERSION')):
+        if var in env:
+            major_minor = '.'.join(env[var].split('.')[:2])
+            return f'{implementation}-{major_minor}-{get_wheel_tag(image, client)}'
+
+    return image.id.split(':')[-1][:12]
+
+
+def get_pip_cache_volumes(
+        image_id: str, pip_cache: str, client: docker.client.DockerClient
+    ) -> dict:
+    """
+    Get the volume to mount as the pip cache for containers of `image_id`.
+
+    If `pip_cache` is `volume` a named docker volume is used, otherwise it is
+    the path of a host directory in which the cache is kept.
+    """
+
+    key = get_pip_cache_key(client.images.get(image_id), client)
+
+    if pip_cache == PIP_CACHE_VOLUME:
+        source = util.docker_safe_name(f'{PIP_CACHE_VOLUME_PREFIX}{key}')
+    else:
+        source = os.path.join(os.path.expanduser(pip_cache), key)
+        os.makedirs(source, exist_ok=True)
+
+    return {source: {'bind': PIP_CACHE_MOUNT, 'mode': 'rw'}}
+
+
+def get_project_key() -> str:
+    """
+    Get a key identifying the project (i.e. the current directory), which is
+    readable but unique between projects with the same directory name
+    """
+
+    cwd = os.getcwd()
+    return f'{pathlib.Path(cwd).name}-{hashlib.sha256(cwd.encode()).hexdigest()[:8]}'
+
+
+def get_envdir_volumes(
+        image_id: str, client: docker.client.DockerClient, env_name: str = None
+    ) -> dict:
+    """
+    Get the volume to mount as tox's work dir, so that the virtualenvs in it
+    can be reused by later runs of `env_name` in `image_id`. tox decides
+    whether they need to be recreated, as it would locally.
+
+    There is a volume per project, environment and image; volumes for older
+    images of the same project and environment are removed. If `env_name` is
+    `None`, the volume is for a container shared between environments.
+    """
+
+    project = get_project_key()
+    env_name = env_name or SHARED_ENV
+    name = util.docker_safe_name(
+        f'{ENVDIR_VOLUME_PREFIX}{project}-{env_name}-{image_id.split(":")[-1][:12]}')
+    labels = {PROJECT_LABEL: project, ENV_LABEL: env_name}
+
+    for volume in client.volumes.list(filters={'label': [f'{k}={v}' for k, v in labels.items()]}):
+        if volume.name != name:
+            try:
+                volume.remove()
+            except docker.errors.APIError:
+                # Still in use, e.g. by a concurrent run
+                pass
+
+    client.volumes.create(name=name, labels=labels)
+    return {name: {'bind': os.path.join(MOUNTED_WORKING_DIR, '.tox'), 'mode': 'rw'}}
+
+
+def get_snapshot_key(image_id: str, env_name: str, setup: list) -> str:
+    """
+    Get a key identifying the snapshot of `env_name` set up in `image_id`,
+    where `setup` is everything (e.g. deps, extras and the content of
+    requirements files) which goes into setting it up
+    """
+
+    return hashlib.sha256(repr([image_id, env_name, *setup]).encode()).hexdigest()
+
+
+def commit_snapshot(
+        client: docker.client.DockerClient, container, key: str, env_name: str
+    ) -> docker.models.images.Image:
+    """
+    Commit `container`, in which `env_name` has been set up, as the snapshot
+    for `key`. The project's older snapshots of `env_name` are removed.
+    """
+
+    project = get_project_key()
+    labels = {
+        SNAPSHOT_KEY_LABEL: key,
+        PROJECT_LABEL: project,
+        ENV_LABEL: env_name,
+        # The image's labels are kept, but a snapshot isn't the testing image
+        CONTENT_KEY_LABEL: '',
+    }
+
+    tox.reporter.verbosity1(f'Committing snapshot of {env_name}')
+    snapshot = container.commit(conf={'Labels': labels})
+
+    stale_filters = {'label': [f'{PROJECT_LABEL}={project}', f'{ENV_LABEL}={env_name}', SNAPSHOT_KEY_LABEL]}
+    for image in client.images.list(filters=stale_filters):
+        if image.id != snapshot.id:
+            try:
+                client.images.remove(image.id)
+            except docker.errors.APIError:
+                # Still in use, e.g. by a concurrent run
+                pass
+
+    return snapshot
+
+
+def get_source_volumes(client: docker.client.DockerClient, env_name: str = None) -> dict:
+    """
+    Get the volume to mount as the working dir for the warm sync modes, which
+    keeps a copy of the source between runs of `env_name` (or of a container
+    shared between environments, if `env_name` is `None`), so that only
+    changed files need to be copied.
+    """
+
+    project = get_project_key()
+    env_name = env_name or SHARED_ENV
+    name = util.docker_safe_name(f'{SOURCE_VOLUME_PREFIX}{project}-{env_name}')
+
+    client.volumes.create(name=name, labels={PROJECT_LABEL: project, ENV_LABEL: env_name})
+    return {name: {'bind': MOUNTED_WORKING_DIR, 'mode': 'rw'}}
+
+
+def get_scratch_options(scratch: str = SCRATCH_BIND, size: str = None) -> dict:
+    """
+    Get the options for `containers.run` which put the working dir in a
+    `tmpfs` or an anonymous `volume`, limited to `size` (e.g. `2g`) for a
+    `tmpfs`. A `bind` working dir is mounted with the other volumes instead.
+    """
+
+    if scratch not in SCRATCH_MODES:
+        raise ValueError(f'unknown scratch space {scratch!r}, expected one of {", ".join(SCRATCH_MODES)}')
+
+    if scratch == SCRATCH_TMPFS:
+        # tmpfs mounts are `noexec` by default, which virtualenvs can't be
+        options = 'rw,exec,mode=1777'
+        if size:
+            options += f',size={util.parse_size(size)}'
+        return {'tmpfs': {MOUNTED_WORKING_DIR: options}}
+
+    if scratch == SCRATCH_VOLUME:
+        if size:
+            tox.reporter.warning('The size of a volume scratch space can\'t be limited, ignoring it')
+        return {'mounts': [docker.types.Mount(MOUNTED_WORKING_DIR, None, type='volume')]}
+
+    return {}
+
+
+def copy_artifacts(source_dir: str, patterns: list, dest_dir: str) -> list:
+    """
+    Copy the files and directories in `source_dir` matching the glob
+    `patterns` (relative to it, and which may use `**`) to the same paths in
+    `dest_dir`, returning their relative paths. Matches which are (or link to)
+    anything outside `source_dir` are skipped.
+    """
+
+    copied = []
+    source = pathlib.Path(source_dir)
+    resolved_source = source.resolve()
+    for pattern in patterns:
+        for path in sorted(source.glob(pattern)):
+            relative = path.relative_to(source)
+            try:
+                path.resolve().relative_to(resolved_source)
+            except ValueError:
+                tox.reporter.warning(f'Not copying artifact {relative}, it is outside {source}')
+                continue
+            dest = pathlib.Path(dest_dir, relative)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            if path.is_dir():
+                shutil.copytree(path, dest, symlinks=True, dirs_exist_ok=True)
+            else:
+                shutil.copy2(path, dest)
+            copied.append(str(relative))
+    return copied
+
+
+def get_pip_cache_environment(max_size: str = None) -> dict:
+    """
+    Get the environment variables pointing pip at the cache, and limiting its
+    size to `max_size` (e.g. `2G`), if given
+    """
+
+    environment = {'PIP_CACHE_DIR': PIP_CACHE_MOUNT}
+    if max_size:
+        environment[PIP_CACHE_MAX_KB_ENV] = str(util.parse_size(max_size) // 1024)
+    return environment
+
+
+def get_container_options(
+        working_dir: str, extra_volumes: dict = None, environment: dict = None,
+        scratch: str = SCRATCH_BIND, scratch_size: str = None, artifacts: list = None
+    ) -> dict:
+    """
+    Get the volumes, environment and scratch space options (as keyword
+    arguments for `docker_client.containers.run`) of a container running an
+    environment, whose host working dir is `working_dir`. See `run_tests`.
+    """
+
+    # The working dir may be replaced by a volume (e.g. a warm source volume)
+    # as well as by the scratch space
+    on_host = scratch == SCRATCH_BIND and not any(
+        mount['bind'] == MOUNTED_WORKING_DIR for mount in (extra_volumes or {}).values())
+
+    if on_host:
+        volumes = _get_volumes(working_dir, extra_volumes)
+    else:
+        # The host directory only gets the log and artifacts
+        volumes = _get_volumes(None, extra_volumes)
+        volumes[working_dir] = {'bind': ARTIFACTS_MOUNT, 'mode': 'rw'}
+
+    environment = environment or {}
+    if artifacts and not on_host:
+        environment = {**environment, ARTIFACTS_ENV: '\n'.join(artifacts)}
+
+    return {'volumes': volumes, 'environment': environment,
+            **get_scratch_options(scratch, scratch_size)}
+
+
+def report(output, message: str, level: int = tox.reporter.Verbosity.INFO) -> None:
+    """
+    Pass `message` to `output` if tox is at least as verbose as `level`, so
+    that it's kept in order with the environment's output (which may be
+    buffered) rather than going straight to the reporter
+    """
+
+    if tox.reporter.verbosity() >= level:
+        output(message)
+
+
+def collect_results(working_dir: str, artifacts_dir: str = None, artifacts: list = None,
+                    artifacts_dest: str = None, output=None) -> None:
+    """
+    Copy the log and `artifacts` (to `artifacts_dest`) of a finished
+    container from its host `working_dir`, see `run_tests`
+    """
+
+    if output is None:
+        output = tox.reporter.line
+
+    log_path = os.path.join(working_dir, LOG_FILENAME)
+    if artifacts_dir is not None and os.path.isfile(log_path):
+        os.makedirs(artifacts_dir, exist_ok=True)
+        shutil.copy2(log_path, artifacts_dir)
+
+    if artifacts:
+        # The artifacts are in the working dir if it's on the host,
+        # otherwise the entrypoint has copied them to the artifacts mount
+        for path in copy_artifacts(working_dir, artifacts, artifacts_dest or os.getcwd()):
+            report(output, f'Copied artifact {path}')
+
+
 def run_tests(venv: tox.venv.VirtualEnv, /,
               image=None,
               docker_client=None,
               break_before_run: bool = os.getenv(BREAK_BEFORE_RUN_ENV) is not None,
-              remove_container=True):
+              remove_container=True,
+              output=None,
+              extra_volumes=None,
+              environment=None,
+              timings=None,
+              scratch=SCRATCH_BIND,
+              scratch_size=None,
+              artifacts_dir=None,
+              artifacts=None,
+              artifacts_dest=None,
+              tox_args=None,
+              limits=None):
     """
     run tests for the tox environment `env_name`. this will run tests in the
     image `python:latest` if no image is provided.
@@ -178,45 +1148,77 @@ def run_tests(venv: tox.venv.VirtualEnv, /,
         `image` (`str`, optional): The image in which to run tox. defaults to
             `None`, in which case `python:latest: is used.
         `docker_client` (`docker.client.DockerClient`, optional): A docker
-            client to use for managing the test run. If none is provided, one
-            will be created.
+            client to use for managing the test run. If none is provided, the
+            shared client (see `get_client`) is used.
+        `output` (callable, optional): Called with each line of the
+            container's output. Defaults to `tox.reporter.line`
+        `extra_volumes` (`dict`, optional): Volumes to mount in the
+            container in addition to the source and working dir, in the form
+            `docker-py` takes them
+        `environment` (`dict`, optional): Environment variables to set in the
+            container
+        `timings` (`timing.Timings`, optional): Where to record the time each
+            phase of the run takes. The `teardown` phase is left running, for
+            the caller to stop once it has removed the container
+        `scratch` (`str`, optional): Where to keep the working dir, one of
+            `SCRATCH_MODES`, see `get_scratch_options`
+        `scratch_size` (`str`, optional): The size limit of a `tmpfs`
+            scratch space
+        `artifacts_dir` (`str`, optional): A host directory to copy the
+            container's log to, once it has finished. Anonymous volumes
+            (used by a `volume` scratch space) are only removed with the
+            container if `remove_container` is `True`, or by passing `v=True`
+            when removing it
+        `artifacts` (`list`, optional): Glob patterns of files to copy from
+            the working dir to `artifacts_dest` once the container has
+            finished. Nothing else in the working dir is copied back
+        `artifacts_dest` (`str`, optional): Where to copy the `artifacts`
+            to, defaults to the project's root (the dir of its `tox.ini`)
+        `tox_args` (`list`, optional): Extra arguments for tox, e.g.
+            `['--notest']` to only set the environment up
+        `limits` (`resources.Limits`, optional): The CPUs, memory, etc. the
+            container may use
 
-    ToDo:
-        * Make it so that environments which share containers can be batched
-            together (especially the python:latest ones)
-        * Possibly investigate using one container per image
-            - Using dockerfile instead of pulled image may negate this
+    See `SharedContainer` for running several environments which share an
+    image in one container.
     """
 
     if docker_client is None:
-        docker_client = docker.client.from_env()
+        docker_client = get_client()
+
+    if output is None:
+        output = tox.reporter.line
+
+    if timings is None:
+        timings = timing.Timings()
 
     env_name = venv.envconfig.envname
 
     if image is None:
         image = util.get_default_image(env_name)
 
-    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as working_dir:
+    if artifacts and artifacts_dest is None:
+        artifacts_dest = str(venv.envconfig.config.toxinidir)
 
-        volumes = {
-            working_dir: {
-                'bind': MOUNTED_WORKING_DIR,
-                'mode': 'rw'
-            }
-        }
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as working_dir, \
+            resources.container_options(limits) as limit_options:
 
-        volumes.update(HERE_MOUNT)
-        tox.reporter.verbosity1(f'\nRunning env {env_name} in `{image}`!\n')
+        run_options = get_container_options(
+            working_dir, extra_volumes, environment, scratch, scratch_size, artifacts)
+        volumes = run_options['volumes']
+        environment = run_options['environment']
+        report(output, f'\nRunning env {env_name} in `{image}`!\n')
 
         # For debugging. Having trouble? Throw a breakpoint in here and this
         # var should have a CLI command to drop into bash on the image
         run_cmd = ' '.join([
-            f'docker run -it --entrypoint /bin/bash -u {os.getuid()} -v ',
+            f'docker run -it --entrypoint /bin/bash -u {get_user()} -v ',
             ' -v '.join([f'\'{src}:{mount["bind"]}:{mount["mode"]}\''
                 for  src, mount in volumes.items()]),
+            ''.join([f' -e \'{name}={value}\'' for name, value in environment.items()]),
             f' {image}'])
 
-        tox.reporter.info(f"docker run command: `{run_cmd}`")
+        report(output, f'docker run command: `{run_cmd}`', tox.reporter.Verbosity.DEBUG)
 
         # If you don't have your IDE/PDB set up for doing breakpoints for you,
         # This snippet below will break
@@ -224,29 +1226,187 @@ def run_tests(venv: tox.venv.VirtualEnv, /,
             import pdb
             pdb.set_trace()
 
-        command = ['-e', env_name]
+        command = ['-e', env_name, *(tox_args or [])]
 
+        timings.start(timing.START)
         # Detatch makes it possible to keep the container around so that the plugin can
         # interact with it
         container = docker_client.containers.run(
                 image=image,
-                volumes=volumes,
                 stream=True,
                 stderr=True,
                 stdout=True,
                 command=command,
-                user=os.getuid(),
+                user=get_user(),
                 remove=remove_container,
-                detach=True)
-
-        for line in container.attach(logs=True, stdout=True, stderr=True, stream=True):
+                detach=True,
+                **run_options,
+                **limit_options)
 
-            tox.reporter.line(line.decode().strip())
+        log_stream = logs.LogStream(timings.output_filter(env_name, output))
+        log_stream.feed_demuxed(
+            container.attach(logs=True, stdout=True, stderr=True, stream=True, demux=True))
+        log_stream.close()
 
+        timings.start(timing.TEARDOWN)
         result = container.wait()
         status = result['StatusCode']
+
+        collect_results(working_dir, artifacts_dir, artifacts, artifacts_dest, output)
+
         if status != 0:
+            # The stderr is the tail kept by the log stream, as the logs can be
+            # far too big to fetch again
             raise docker.errors.ContainerError(
-                container, status, command, image, container.logs(stdout=False, stderr=True))
+                container, status, command, image, log_stream.tail(logs.STDERR).encode())
 
     return container
+
+
+def wait_until_ready(container, image: str, command: list) -> None:
+    """
+    Wait until the entrypoint of `container` (started with `command`) prints
+    that it is ready for `docker exec`, showing what it prints before then at
+    verbosity 1. Raises `docker.errors.ContainerError` if it stops first.
+    """
+
+    lines = []
+    log_stream = logs.LogStream(lines.append)
+    for chunk in container.logs(stream=True, follow=True):
+        log_stream.feed(logs.STDOUT, chunk)
+        while lines:
+            line = lines.pop(0)
+            if line.strip() == READY_MARKER:
+                return
+            if not line.startswith(timing.PHASE_MARKER):
+                tox.reporter.verbosity1(line)
+
+    # The log stream only ends if the container stopped before it was ready
+    log_stream.close()
+    try:
+        status = container.wait()['StatusCode']
+    except docker.errors.NotFound:
+        # Removed as soon as it stopped
+        status = -1
+    raise docker.errors.ContainerError(
+        container, status, command, image, log_stream.tail(logs.STDOUT).encode())
+
+
+def exec_env(client: docker.client.DockerClient, container, image: str, env_name: str,
+             environment: dict, output, timings: timing.Timings = None) -> None:
+    """
+    Run the tox environment `env_name` in the running `container` (of `image`)
+    with `docker exec`, passing each line of output to `output` and recording
+    the phases seen in it in `timings`. Raises `docker.errors.ContainerError`
+    if it fails.
+    """
+
+    if timings is None:
+        timings = timing.Timings()
+
+    command = [IMAGE_ENTRYPOINT_PATH, EXEC_ARG, '-e', env_name]
+    api = client.api
+
+    exec_id = api.exec_create(
+        container.id, command, user=get_user(), environment=environment)['Id']
+
+    log_stream = logs.LogStream(timings.output_filter(env_name, output))
+    log_stream.feed_demuxed(api.exec_start(exec_id, stream=True, demux=True))
+    log_stream.close()
+
+    status = api.exec_inspect(exec_id)['ExitCode']
+    if status != 0:
+        raise docker.errors.ContainerError(
+            container, status, command, image, log_stream.tail(logs.STDERR).encode())
+
+
+class SharedContainer:
+    """
+    A long-lived container in which several tox environments using the same
+    image are run, one `docker exec` per environment.
+
+    The source is synced into the container once, when it is started, so
+    environments after the first don't pay for container startup or syncing.
+    The container is labelled with the project, and removes itself once no
+    environment has run in it for `ttl` seconds, in case tox is killed
+    before it can be closed.
+    """
+
+    def __init__(self, image: str, docker_client: docker.client.DockerClient = None,
+                 extra_volumes: dict = None, environment: dict = None,
+                 ttl: int = DEFAULT_IDLE_TTL):
+        if docker_client is None:
+            docker_client = get_client()
+
+        self.image = image
+        self.docker_client = docker_client
+        self.extra_volumes = extra_volumes
+        self.environment = environment or {}
+        self.ttl = ttl
+        self.container = None
+        self._working_dir = None
+        # Environments are run one at a time, as they share a working dir
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Start the container and wait until the source has been synced into it.
+        If it doesn't get that far, it is removed (so that the next
+        environment starts another), and the error is raised.
+        """
+
+        self._working_dir = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
+        tox.reporter.verbosity1(f'\nStarting shared container for `{self.image}`\n')
+
+        command = [IDLE_ARG, str(self.ttl)]
+        try:
+            self.container = self.docker_client.containers.run(
+                image=self.image,
+                volumes=_get_volumes(self._working_dir.name, self.extra_volumes),
+                command=command,
+                environment=self.environment,
+                labels={PROJECT_LABEL: get_project_key(), ENV_LABEL: SHARED_ENV},
+                user=get_user(),
+                auto_remove=True,
+                detach=True)
+
+            wait_until_ready(self.container, self.image, command)
+        except BaseException:
+            self.close()
+            raise
+
+    def run_env(self, env_name: str, output=None, timings: timing.Timings = None) -> None:
+        """
+        Run the tox environment `env_name` in the container, raising
+        `docker.errors.ContainerError` if it fails. Each line of output is
+        passed to `output`, which defaults to `tox.reporter.line`, and the
+        time each phase takes is recorded in `timings`.
+        """
+
+        with self._lock:
+            if self.container is None:
+                self.start()
+            self._run_env(env_name, output or tox.reporter.line, timings)
+
+    def _run_env(self, env_name: str, output, timings: timing.Timings = None) -> None:
+
+        report(output, f'\nRunning env {env_name} in shared container for `{self.image}`!\n')
+        exec_env(self.docker_client, self.container, self.image, env_name, self.environment, output,
+                 timings)
+
+    def close(self) -> None:
+        """
+        Remove the container and its working directory
+        """
+
+        if self.container is not None:
+            try:
+                self.container.remove(force=True)
+            except docker.errors.APIError:
+                # Already gone, as it removes itself once stopped
+                pass
+            self.container = None
+
+        if self._working_dir is not None:
+            self._working_dir.cleanup()
+            self._working_dir = None
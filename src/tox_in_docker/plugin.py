@@ -3,11 +3,16 @@ tox_in_docker.plugin
 
 Tox plugin hooks
 """
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import logging
 import pathlib
 import os
 import os.path
 import shutil
+import threading
 
 import docker
 from pathlib import Path
@@ -17,13 +22,36 @@ import toml
 import tox
 import tox.exception
 
+from tox_in_docker import aio
+from tox_in_docker import image_cache
+from tox_in_docker import logs
 from tox_in_docker import main
+from tox_in_docker import pool
+from tox_in_docker import resources
+from tox_in_docker import scheduler
+from tox_in_docker import shards
+from tox_in_docker import timing
 from tox_in_docker import util
 
 hookimpl = pluggy.HookimplMarker("tox")
 
 DEFAULT_DOCKER_IMAGE = 'default'
 
+# Whether an environment is run in docker, and why, see `get_run_decision`
+RunDecision = collections.namedtuple('RunDecision', ['in_docker', 'reason'])
+RUN_DECISION_ATTR = 'docker_run_decision'
+
+# The time each phase of running an environment in docker took, see `get_timings`
+TIMINGS_ATTR = 'docker_timings'
+
+# Containers shared between environments when batching, keyed by image
+_SHARED_CONTAINERS = {}
+_SHARED_CONTAINERS_LOCK = threading.Lock()
+
+# Runs in-docker environments concurrently when `--docker_workers` or
+# `--docker_async` is set
+_SCHEDULER = None
+
 USER_CONF_FILE = pathlib.Path().home().joinpath(
     '.config', 'tox', 'tox-in-docker.toml')
 
@@ -53,6 +81,28 @@ def tox_addoption(parser: tox.config.Parser):
 
     in_docker_default = user_config.get('global', {}).get('in_docker')
     always_default = user_config.get('global', {}).get('always_in_docker')
+    batch_default = user_config.get('global', {}).get('docker_batch')
+    workers_default = user_config.get('global', {}).get('docker_workers')
+    async_default = user_config.get('global', {}).get('docker_async')
+    pool_size_default = user_config.get('global', {}).get('docker_pool_size')
+    buildkit_default = user_config.get('global', {}).get('docker_buildkit')
+    warm_pool_default = user_config.get('global', {}).get('docker_warm_pool')
+    warm_pool_ttl_default = user_config.get('global', {}).get('docker_warm_pool_ttl')
+    timings_json_default = user_config.get('global', {}).get('docker_timings_json')
+    image_cache_default = user_config.get('global', {}).get('docker_image_cache')
+    pip_cache_default = user_config.get('global', {}).get('docker_pip_cache')
+    pip_cache_size_default = user_config.get('global', {}).get('docker_pip_cache_size')
+    reuse_envdir_default = user_config.get('global', {}).get('docker_reuse_envdir')
+    sync_default = user_config.get('global', {}).get('docker_sync')
+    snapshot_default = user_config.get('global', {}).get('docker_snapshot')
+    scratch_default = user_config.get('global', {}).get('docker_scratch')
+    scratch_size_default = user_config.get('global', {}).get('docker_scratch_size')
+    shards_default = user_config.get('global', {}).get('docker_shards')
+    cpus_default = user_config.get('global', {}).get('docker_cpus')
+    cpuset_default = user_config.get('global', {}).get('docker_cpuset')
+    memory_default = user_config.get('global', {}).get('docker_memory')
+    shm_size_default = user_config.get('global', {}).get('docker_shm_size')
+    ulimits_default = user_config.get('global', {}).get('docker_ulimits')
 
     tox.reporter.info(f'Tox in docker user defaults: {user_config.get("global")}')
 
@@ -61,6 +111,53 @@ def tox_addoption(parser: tox.config.Parser):
 
     parser.add_argument('--in_docker', action='store_true', default=in_docker_default, dest='in_docker')
     parser.add_argument('--always_in_docker', action='store_true', default=always_default, dest='always_in_docker')
+    parser.add_argument('--docker_batch', action='store_true', default=batch_default, dest='docker_batch',
+                        help=' '.join((
+                            'run environments which use the same image in one shared container,',
+                            'instead of starting a container per environment')))
+    parser.add_argument('--docker_workers', type=int, default=workers_default, dest='docker_workers',
+                        metavar='N',
+                        help=' '.join((
+                            'run up to N in-docker environments at once. Output is buffered and',
+                            'shown per environment, in order')))
+    parser.add_argument('--docker_async', action='store_true', default=async_default, dest='docker_async',
+                        help=' '.join((
+                            'run in-docker environments at once from one event loop, rather than a',
+                            'thread each. `--docker_workers` limits how many run at once')))
+    parser.add_argument('--docker_pool_size', type=int, default=pool_size_default, dest='docker_pool_size',
+                        metavar='N',
+                        help=' '.join((
+                            'the number of connections to the docker daemon to keep open. Defaults',
+                            f'to the larger of {main.DEFAULT_POOL_SIZE} and `--docker_workers`')))
+    parser.add_argument('--docker_buildkit', action='store_true', default=buildkit_default, dest='docker_buildkit',
+                        help=' '.join((
+                            'build testing images with BuildKit (through the docker CLI), so that apt',
+                            'and pip downloads are cached between builds')))
+    parser.add_argument('--docker_warm_pool', type=int, default=warm_pool_default,
+                        dest='docker_warm_pool', metavar='N',
+                        help=' '.join((
+                            'run each environment in a warm container kept from earlier runs,',
+                            'keeping N more ready for the next run')))
+    parser.add_argument('--docker_warm_pool_ttl', type=int, default=warm_pool_ttl_default,
+                        dest='docker_warm_pool_ttl', metavar='SECONDS',
+                        help=' '.join((
+                            'remove warm (and --docker_batch) containers after they have been',
+                            'unused for SECONDS.',
+                            f'Defaults to {pool.DEFAULT_TTL}')))
+    parser.add_argument('--docker_timings_json', default=timings_json_default, dest='docker_timings_json',
+                        metavar='PATH',
+                        help=' '.join((
+                            'add the time each phase of each in-docker environment took to the JSON',
+                            'report at PATH')))
+    parser.add_argument('--docker_image_cache', default=image_cache_default, dest='docker_image_cache',
+                        metavar='LOCATION',
+                        help=' '.join((
+                            'load built images from, and save them to, LOCATION: a directory of',
+                            f'`docker save` tarballs, or a registry repository (`{image_cache.REGISTRY_PREFIX}host/repo`)')))
+    parser.add_argument('--docker_prepare', action='store_true', default=False, dest='docker_prepare',
+                        help=' '.join((
+                            'pull and build the images for all in-docker environments at once, then',
+                            'exit without running any of them')))
     parser.add_testenv_attribute(
         name="in_docker",
         type="bool",
@@ -99,6 +196,121 @@ def tox_addoption(parser: tox.config.Parser):
         help="the name of the build arg in your dockerfile which accepts the base image. Requires docker_build_dir",
         default=None)
 
+    parser.add_testenv_attribute(
+        name="docker_pip_cache",
+        type="string",
+        default=pip_cache_default,
+        help=' '.join((
+            f'set `{main.PIP_CACHE_VOLUME}` to keep the pip cache in a docker volume shared by',
+            'containers with the same Python, or to a host directory to keep it there'))
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_pip_cache_size",
+        type="string",
+        default=pip_cache_size_default,
+        help='the size (e.g. `2g`) above which the least recently used pip cache files are removed'
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_reuse_envdir",
+        type="bool",
+        default=reuse_envdir_default or False,
+        help=' '.join((
+            "set `true` to keep the environment's virtualenv in a docker volume, so",
+            "that later runs in the same image can reuse it"))
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_sync",
+        type="string",
+        default=sync_default,
+        help=' '.join((
+            f'set `{main.SYNC_WARM}` to keep a copy of the source in a docker volume and only copy',
+            'files whose modification time or size changed into it, or',
+            f'`{main.SYNC_WARM_CHECKSUM}` to compare their content instead'))
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_snapshot",
+        type="bool",
+        default=snapshot_default or False,
+        help=' '.join((
+            "set `true` to snapshot the container once tox has set the environment up, and",
+            "start later runs with the same deps from the snapshot"))
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_scratch",
+        type="string",
+        default=scratch_default,
+        help=' '.join((
+            f'where to keep the working dir: `{main.SCRATCH_BIND}` (a host directory, the default),',
+            f'`{main.SCRATCH_TMPFS}` (in memory) or `{main.SCRATCH_VOLUME}` (an anonymous docker volume)'))
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_scratch_size",
+        type="string",
+        default=scratch_size_default,
+        help=f'the size (e.g. `2g`) of a `{main.SCRATCH_TMPFS}` working dir'
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_shards",
+        type="string",
+        default=shards_default,
+        help=' '.join((
+            'split the tests between this many containers, started from a snapshot of',
+            'the environment once it is set up'))
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_cpus",
+        type="string",
+        default=cpus_default,
+        help='the number of CPUs (e.g. `1.5`) the container may use'
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_cpuset",
+        type="string",
+        default=cpuset_default,
+        help=' '.join((
+            'the CPUs (e.g. `0-3`) the container may run on, or',
+            f'`{resources.CPUSET_AUTO}` for `docker_cpus` CPUs no other container has'))
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_memory",
+        type="string",
+        default=memory_default,
+        help='the memory (e.g. `2g`) the container may use, including swap'
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_shm_size",
+        type="string",
+        default=shm_size_default,
+        help='the size (e.g. `512m`) of the container\'s `/dev/shm`'
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_ulimits",
+        type="line-list",
+        # Line lists don't have defaults
+        postprocess=lambda testenv_config, value: value or list(ulimits_default or []),
+        help='ulimits for the container, one per line, e.g. `nofile=1024:2048`'
+    )
+
+    parser.add_testenv_attribute(
+        name="docker_artifacts",
+        type="line-list",
+        help=' '.join((
+            'glob patterns, relative to the repo root, of files and folders to copy back',
+            'from the container to the source workspace once the environment has run'))
+    )
+
     parser.add_testenv_attribute(
         name="cleanup_built_container",
         type="bool",
@@ -106,11 +318,15 @@ def tox_addoption(parser: tox.config.Parser):
         default=False)
 
 
-def do_run_in_docker(venv=None, envconfig=None, config=None):
+def get_run_decision(venv=None, envconfig=None, config=None) -> RunDecision:
     """
-    Return `True` if this test env should be run in a docker container
+    Decide whether this test env should be run in a docker container, and why.
 
     `config` is from cli, `envconfig` is from `tox.ini` etc., more or less, I think.
+
+    The decision is made once per environment (looking for a local Python can
+    be slow), and kept on the envconfig as `docker_run_decision`, where other
+    hooks (and reporting) can read it.
     """
 
     if envconfig is None:
@@ -121,13 +337,29 @@ def do_run_in_docker(venv=None, envconfig=None, config=None):
         if envconfig is not None:
             config = envconfig.config
 
+    if envconfig is not None:
+        decision = getattr(envconfig, RUN_DECISION_ATTR, None)
+        if isinstance(decision, RunDecision):
+            return decision
+
+    decision = _decide(envconfig, config)
+    if decision.in_docker:
+        tox.reporter.info(f'Tox in docker reason: {decision.reason}')
+    else:
+        tox.reporter.verbosity1(f'Not in docker reason: {decision.reason}')
+
+    if envconfig is not None:
+        setattr(envconfig, RUN_DECISION_ATTR, decision)
+    return decision
+
+
+def _decide(envconfig, config) -> RunDecision:
+
     if config.option.always_in_docker:
-        tox.reporter.info('Tox in docker reason: option.always_in_docker (CLI) is True-y')
-        return True
+        return RunDecision(True, 'option.always_in_docker (CLI) is True-y')
 
     elif envconfig is not None and envconfig.always_in_docker:
-        tox.reporter.info('Tox in docker reason: envconfig.always_in_docker (ini or toml file) is True-y')
-        return True
+        return RunDecision(True, 'envconfig.always_in_docker (ini or toml file) is True-y')
 
     # config.option
     elif (envconfig is not None and envconfig.in_docker) or config.option.in_docker:
@@ -136,32 +368,20 @@ def do_run_in_docker(venv=None, envconfig=None, config=None):
         executable = config.pluginmanager.subset_hook_caller(hook, [plugin])(envconfig=envconfig, skip_tid=True)
 
         if executable is None:
-            return True
+            return RunDecision(True, 'in_docker is True-y and no local Python was found')
+        return RunDecision(False, f'in_docker is True-y, but a local Python was found at {executable}')
 
-    return False
+    return RunDecision(False, 'neither in_docker nor always_in_docker is True-y')
 
 
-def _ensure_tox_installed(client, docker_image: str) -> str:
-    """
-    Ensure tox in image
-     - try to run image with --entrypoint tox and --version
-        + if status != 0, build new image based off of previous image with
-          tox installed
+def do_run_in_docker(venv=None, envconfig=None, config=None) -> bool:
     """
+    Return `True` if this test env should be run in a docker container
 
-    try:
-        client.containers.run(image=docker_image, entrypoint='tox', command=['--version'])
-    except docker.errors.APIError:
-        # [re-] build image with tox
-
-        built_image = main.build_testing_image(base=docker_image)
-        docker_image = built_image.tags[0] if built_image.tags else built_image.id
+    See `get_run_decision`, which also gives the reason.
+    """
 
-    # TODO: Raise specific exception
-    # ensure that built image is set up for tox
-
-    client.containers.run(image=docker_image, command=['--version'], remove=True)
-    return docker_image
+    return get_run_decision(venv=venv, envconfig=envconfig, config=config).in_docker
 
 
 @hookimpl
@@ -195,26 +415,62 @@ def tox_get_python_executable(envconfig, skip_tid: bool=False):
         return shutil.which('python')
 
 
+def get_timings(envconfig) -> timing.Timings:
+    """
+    Get the timings of the phases of running `envconfig`'s environment in
+    docker. They're kept on the envconfig as `docker_timings`, as the phases
+    may be run by several hooks, or by a scheduler worker.
+    """
+
+    timings = getattr(envconfig, TIMINGS_ATTR, None)
+    if not isinstance(timings, timing.Timings):
+        timings = timing.Timings()
+        setattr(envconfig, TIMINGS_ATTR, timings)
+    return timings
+
+
 @hookimpl
 def tox_runtest_post(venv: tox.venv.VirtualEnv):
     # Options (like `config.option` in `tox_configure`) are at
     # `venv.envconfig.config.option`
 
     if venv.run_image is not None:
-        # Add (in docker) to the env name for display in results
-        venv.envconfig.envname += ' (in docker)'
+        env_name = venv.envconfig.envname
+        timings = get_timings(venv.envconfig)
+        timings.stop()
+        timings.emit_spans(env_name)
 
+        timings_json = venv.envconfig.config.option.docker_timings_json
+        if timings_json:
+            timing.write_json(timings_json, {env_name: timings})
 
-@hookimpl
-def tox_runtest_pre(venv: tox.venv.VirtualEnv):
+        # Add (in docker) and the time each phase took to the env name for
+        # display in results
+        if timings.durations:
+            venv.envconfig.envname += f' (in docker: {timings.summary()})'
+        else:
+            venv.envconfig.envname += ' (in docker)'
 
-    # Set property on virtualenv
-    venv.run_image = None
 
-    if not do_run_in_docker(venv=venv):
-        return None
+def get_client(config: tox.config.Config) -> docker.client.DockerClient:
+    """
+    Get the docker client shared by the hooks for this tox session
+    """
+
+    pool_size = config.option.docker_pool_size
+    if not pool_size:
+        pool_size = max(config.option.docker_workers or 0, main.DEFAULT_POOL_SIZE)
 
-    client = docker.client.from_env()
+    return main.get_client(pool_size)
+
+
+def prepare_image(venv: tox.venv.VirtualEnv, client: docker.client.DockerClient) -> str:
+    """
+    Build (or find) the image `venv` will be run in, and return its ID
+    """
+
+    timings = get_timings(venv.envconfig)
+    cache = venv.envconfig.config.option.docker_image_cache
 
     if venv.envconfig.docker_build_dir:
         docker_build_dir = venv.envconfig.docker_build_dir
@@ -233,20 +489,209 @@ def tox_runtest_pre(venv: tox.venv.VirtualEnv):
             build_base_image = util.get_default_image(venv.envconfig.envname)
             build_args['BASE'] = build_base_image
 
-        # Build the image
-        image, _output = client.images.build(
-            buildargs=build_args,
-            path=docker_build_dir,
-            tag=tag)
+        # Build the image, unless it has been built from the same context
+        with timings.phase(timing.BUILD), main.build_lock(tag):
+            main.build_context(client, docker_build_dir, tag, build_args, image_cache=cache)
         base_image = tag
 
     else:
         # use a pulled/available image:
-        base_image = get_base_image(venv)
+        with timings.phase(timing.RESOLVE):
+            base_image = get_base_image(venv)
+
+    buildkit = bool(venv.envconfig.config.option.docker_buildkit)
+    with timings.phase(timing.BUILD):
+        return main.build_testing_image(base_image, client, buildkit, image_cache=cache).id
+
+
+@hookimpl
+def tox_runtest_pre(venv: tox.venv.VirtualEnv):
+
+    # Set property on virtualenv
+    venv.run_image = None
+
+    if not do_run_in_docker(venv=venv):
+        return None
+
+    config = venv.envconfig.config
+    if config.option.docker_workers or config.option.docker_async:
+        _start_scheduler(config)
+        if venv.envconfig.envname in _SCHEDULER:
+            # The image is prepared by the scheduled job
+            return None
+
+    client = get_client(config)
+    venv.envconfig.docker_image = prepare_image(venv, client)
+
+
+def prepare_images(config: tox.config.Config) -> int:
+    """
+    Prepare (pull and build) the images for every in-docker environment that
+    would be run, concurrently, reporting on each one as it is done. Returns
+    the number of environments whose image couldn't be prepared.
+    """
+
+    envconfigs = [config.envconfigs[envname] for envname in config.envlist
+                  if do_run_in_docker(envconfig=config.envconfigs[envname])]
+    if not envconfigs:
+        tox.reporter.info('No in-docker environments to prepare images for')
+        return 0
+
+    client = get_client(config)
+    workers = config.option.docker_workers or len(envconfigs)
+    failures = 0
+
+    tox.reporter.separator("=", f"Preparing images for {len(envconfigs)} environments",
+                           tox.reporter.Verbosity.QUIET)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='tox-in-docker') as executor:
+        futures = {
+            executor.submit(prepare_image, tox.venv.VirtualEnv(envconfig=envconfig), client): envconfig.envname
+            for envconfig in envconfigs}
+
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            progress = f'[{done}/{len(futures)}] {futures[future]}'
+            try:
+                image = future.result()
+            except (docker.errors.DockerException, ValueError) as exc:
+                failures += 1
+                tox.reporter.error(f'{progress}: {exc}')
+            else:
+                tox.reporter.good(f'{progress}: {image}')
+
+    return failures
+
+
+@hookimpl
+def tox_configure(config: tox.config.Config):
+    if config.option.docker_prepare:
+        failures = prepare_images(config)
+        main.close_client()
+        raise SystemExit(1 if failures else 0)
+
+
+def get_run_options(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        shared: bool = False
+    ) -> dict:
+    """
+    Get the extra volumes and environment to run `venv` in `docker_image` with,
+    as keyword arguments for `main.run_tests`. If `shared`, they are for a
+    container shared by all environments using `docker_image`.
+    """
+
+    extra_volumes = {}
+    environment = {}
+
+    env_name = None if shared else venv.envconfig.envname
+
+    if (venv.envconfig.docker_snapshot or get_shard_count(venv.envconfig) > 1) and not shared:
+        # tox's work dir has to be in the container to be in its snapshot
+        environment[main.WORKDIR_ENV] = main.SNAPSHOT_WORKDIR
+    elif venv.envconfig.docker_reuse_envdir:
+        extra_volumes.update(main.get_envdir_volumes(docker_image, client, env_name))
+
+    sync = venv.envconfig.docker_sync
+    pooled = bool(venv.envconfig.config.option.docker_warm_pool)
+    if sync and sync.lower() in main.SYNC_MODES:
+        scratch = (venv.envconfig.docker_scratch or main.SCRATCH_BIND).lower()
+        if scratch != main.SCRATCH_BIND and not (shared or pooled):
+            # Both would be mounted as the working dir
+            raise tox.exception.ConfigError(
+                f'docker_sync = {sync} keeps the working dir in a volume of its own, so it '
+                f'can\'t be combined with docker_scratch = {scratch}')
+        if get_shard_count(venv.envconfig) > 1 and not (shared or pooled):
+            # The shards would all sync into (and run in) the same volume at once
+            raise tox.exception.ConfigError(
+                f'docker_sync = {sync} keeps the working dir in one volume per environment, '
+                f'so it can\'t be combined with docker_shards')
+        # Each warm container of a pool keeps a copy of the source of its own,
+        # rather than syncing into the volume while another runs tests in it
+        if not pooled:
+            extra_volumes.update(main.get_source_volumes(client, env_name))
+        environment[main.SYNC_ENV] = sync.lower()
+
+    pip_cache = venv.envconfig.docker_pip_cache
+    if pip_cache and pip_cache.lower() not in ['false', 'none']:
+        if pip_cache.lower() == 'true':
+            pip_cache = main.PIP_CACHE_VOLUME
+        extra_volumes.update(main.get_pip_cache_volumes(docker_image, pip_cache, client))
+        environment.update(main.get_pip_cache_environment(venv.envconfig.docker_pip_cache_size))
+
+    return {'extra_volumes': extra_volumes, 'environment': environment}
+
+
+def _start_scheduler(config: tox.config.Config) -> None:
+    """
+    Schedule every in-docker environment that is going to be run, the first
+    time this is called
+    """
+
+    global _SCHEDULER
+
+    if _SCHEDULER is not None:
+        return
+
+    client = get_client(config)
+    if config.option.docker_async:
+        _SCHEDULER = scheduler.AsyncScheduler(config.option.docker_workers)
+        run_scheduled = _run_scheduled_async
+    else:
+        _SCHEDULER = scheduler.Scheduler(config.option.docker_workers)
+        run_scheduled = _run_scheduled
+
+    for envname in config.envlist:
+        envconfig = config.envconfigs[envname]
+        if do_run_in_docker(envconfig=envconfig):
+            _SCHEDULER.submit(envname, run_scheduled, tox.venv.VirtualEnv(envconfig=envconfig), client)
+
+
+def _run_scheduled(venv: tox.venv.VirtualEnv, client: docker.client.DockerClient, output) -> str:
+    """
+    Prepare the image for and run `venv`, returning the image's ID. This runs in
+    a scheduler worker, so its output goes to `output`, not the reporter.
+    """
 
+    docker_image = prepare_image(venv, client)
+    config = venv.envconfig.config
+    batch = config.option.docker_batch and not config.option.docker_warm_pool
+    run_options = get_run_options(venv, docker_image, client, shared=batch)
 
-    docker_image = main.build_testing_image(base_image, client)
-    venv.envconfig.docker_image = docker_image.id
+    timings = get_timings(venv.envconfig)
+
+    if config.option.docker_warm_pool:
+        _get_pool(venv, docker_image, client, run_options).run_env(output, timings)
+    elif batch:
+        shared = _get_shared_container(venv, docker_image, client, **run_options)
+        with timings.phase(timing.START):
+            shared.run_env(venv.envconfig.envname, output, timings)
+    else:
+        _run_in_container(venv, docker_image, client, run_options, output)
+
+    return docker_image
+
+
+async def _run_scheduled_async(
+        venv: tox.venv.VirtualEnv, client: docker.client.DockerClient, output) -> str:
+    """
+    Like `_run_scheduled`, on the `AsyncScheduler`'s event loop. The container
+    is run with `aio`, while preparing the image (and anything else which
+    only `docker-py` does) runs in the loop's default executor.
+    """
+
+    loop = asyncio.get_running_loop()
+    config = venv.envconfig.config
+    if (config.option.docker_batch or config.option.docker_warm_pool
+            or get_shard_count(venv.envconfig) > 1):
+        # Shared and pooled containers are driven with `docker exec`, and
+        # shards each have a thread
+        return await loop.run_in_executor(
+            None, functools.partial(_run_scheduled, venv, client, output))
+
+    docker_image = await loop.run_in_executor(None, prepare_image, venv, client)
+    run_options = await loop.run_in_executor(None, get_run_options, venv, docker_image, client)
+    await _run_in_container_async(venv, docker_image, client, run_options, output)
+    return docker_image
 
 
 @hookimpl
@@ -260,35 +705,533 @@ def tox_runtest(venv: tox.venv.VirtualEnv, redirect: bool):
         output from the container
     """
 
-    tox.reporter.verbosity1(f'{"" if do_run_in_docker(venv=venv) else "Not "}doing run in docker.')
+    decision = get_run_decision(venv=venv)
+    tox.reporter.verbosity1(
+        f'{"" if decision.in_docker else "Not "}doing run in docker: {decision.reason}.')
 
     if util.is_in_docker():
         tox.reporter.info(f"\nAlready in docker\n{'=' * 13}n")
     else:
         tox.reporter.info(f"\nNot in docker (yet?)\n{'=' * 13}\n")
 
-    if not do_run_in_docker(venv=venv):
+    if not decision.in_docker:
         return None
 
+    tox.reporter.separator("=", "In Docker", tox.reporter.Verbosity.QUIET)
+
+    if _SCHEDULER is not None and venv.envconfig.envname in _SCHEDULER:
+        return _collect_scheduled(venv)
+
     docker_image = venv.envconfig.docker_image
     venv.run_image = docker_image
-    tox.reporter.separator("=", "In Docker", tox.reporter.Verbosity.QUIET)
+
+    config = venv.envconfig.config
+    client = get_client(config)
+    batch = config.option.docker_batch and not config.option.docker_warm_pool
+    run_options = get_run_options(venv, docker_image, client, shared=batch)
+
+    if config.option.docker_warm_pool:
+        return _run_in_pool(venv, docker_image, client, run_options)
+    elif batch:
+        return _run_in_shared_container(venv, docker_image, client, run_options)
+
+    try:
+        _run_in_container(venv, docker_image, client, run_options)
+    except docker.errors.ContainerError as exc:
+        _report_failure(venv, exc)
+        return False
+    return True
+
+
+def get_snapshot_setup(venv: tox.venv.VirtualEnv, run_options: dict = None) -> list:
+    """
+    Get what goes into setting `venv` up, for its snapshot's key: its deps
+    (with the content of the requirements and constraints files they refer
+    to), extras, base Python, install command and `setenv`, and the
+    environment of its container from `run_options` (which the snapshot
+    keeps). The project itself is reinstalled by every run anyway.
+    """
+
+    envconfig = venv.envconfig
+    deps = [str(dep) for dep in envconfig.deps]
+    setup = list(deps)
+
+    for dep in deps:
+        # e.g. `-r requirements.txt` or `-cconstraints.txt`
+        if dep.startswith(('-r', '-c')):
+            full_path = os.path.join(str(envconfig.config.toxinidir), dep[2:].strip())
+            if os.path.isfile(full_path):
+                setup.append(pathlib.Path(full_path).read_text())
+
+    setup.append(sorted(envconfig.extras or []))
+    setup.append(envconfig.basepython)
+    setup.append(list(envconfig.install_command))
+    # tox picks a new hash seed every run, unless told not to
+    setup.append(sorted((name, value) for name, value in envconfig.setenv.definitions.items()
+                        if name != 'PYTHONHASHSEED'))
+    setup.append(sorted((run_options or {}).get('environment', {}).items()))
+    return setup
+
+
+def _run_in_container(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        run_options: dict, output=None
+    ) -> None:
+    """
+    Run `venv` in a container of its own, which is removed afterwards, raising
+    `docker.errors.ContainerError` if it fails.
+
+    With `docker_snapshot`, the container is started from the snapshot of the
+    environment's setup, which is taken first if there isn't one yet (see
+    `_take_snapshot`).
+    """
+
+    shard_count = get_shard_count(venv.envconfig)
+    if shard_count > 1:
+        return _run_sharded(venv, docker_image, client, run_options, shard_count, output)
+
+    timings = get_timings(venv.envconfig)
+    container_options = _get_container_run_options(venv)
+    docker_image, snapshot_key = _find_snapshot(venv, docker_image, client, run_options)
+
+    try:
+        # Which removes its own container
+        if snapshot_key is not None:
+            docker_image = _take_snapshot(
+                venv, docker_image, client, snapshot_key, run_options, container_options,
+                timings, output)
+
+        container = None
+        try:
+            container = main.run_tests(
+                venv, docker_image, docker_client=client, remove_container=False,
+                output=output, timings=timings, **container_options, **run_options)
+        except docker.errors.ContainerError as exc:
+            container = exc.container
+            raise
+        finally:
+            if container is not None:
+                # Remove the scratch space too, if it is a volume
+                container.remove(v=True)
+    finally:
+        timings.stop()
+
+
+async def _run_in_container_async(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        run_options: dict, output=None
+    ) -> None:
+    """
+    Like `_run_in_container`, with the container run by `aio.run_tests`. A
+    snapshot which has to be taken first is taken in the executor.
+    """
+
+    loop = asyncio.get_running_loop()
+    timings = get_timings(venv.envconfig)
+    container_options = _get_container_run_options(venv)
+    docker_image, snapshot_key = await loop.run_in_executor(
+        None, _find_snapshot, venv, docker_image, client, run_options)
+
+    aio_client = aio.AsyncDockerClient()
+    try:
+        # Which removes its own container
+        if snapshot_key is not None:
+            docker_image = await loop.run_in_executor(None, functools.partial(
+                _take_snapshot, venv, docker_image, client, snapshot_key, run_options,
+                container_options, timings, output))
+
+        container_id = None
+        try:
+            container_id = await aio.run_tests(
+                venv, docker_image, aio_client, output=output, timings=timings,
+                **container_options, **run_options)
+        except docker.errors.ContainerError as exc:
+            # The container's ID, unlike `main.run_tests`'s errors
+            container_id = exc.container
+            raise
+        finally:
+            if container_id is not None:
+                await aio_client.remove(container_id, v=True)
+    finally:
+        timings.stop()
+
+
+def _take_snapshot(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        snapshot_key: str, run_options: dict, container_options: dict,
+        timings: timing.Timings, output=None
+    ) -> str:
+    """
+    Set `venv` up in a container of `docker_image` without running its
+    commands (or copying back its artifacts), so that nothing they do ends up
+    in the snapshot, and commit it as the snapshot for `snapshot_key`. Returns
+    the image to run the commands in, which is `docker_image` if the snapshot
+    couldn't be committed. Raises `docker.errors.ContainerError` if setting
+    the environment up fails.
+    """
+
+    env_name = venv.envconfig.envname
+    container = None
     try:
-        container = main.run_tests(venv, docker_image, remove_container=False)
+        container = main.run_tests(
+            venv, docker_image, docker_client=client, remove_container=False, output=output,
+            timings=timings, tox_args=['--notest'],
+            **{**container_options, 'artifacts': None}, **run_options)
+        try:
+            return main.commit_snapshot(client, container, snapshot_key, env_name).id
+        except docker.errors.APIError as exc:
+            tox.reporter.warning(f'Could not snapshot {env_name}, running it without: {exc}')
+            return docker_image
     except docker.errors.ContainerError as exc:
+        container = exc.container
+        raise
+    finally:
+        if container is not None:
+            container.remove(v=True)
 
-        # This bit here is copied from `tox.venv.test()`, more or less
-        venv.status = "commands failed"
 
-        # ToDo find stderr lines in logs and color them, instead of repeating
+def get_shard_count(envconfig) -> int:
+    """
+    Get the number of containers to split `envconfig`'s tests between
+    """
 
-        exc.stderr = exc.stderr.decode()
-        tox.reporter.separator("-", "Container Logs (stdout + stderr)", tox.reporter.Verbosity.QUIET)
-        tox.reporter.line(exc.container.logs().decode())
-        tox.reporter.separator("-", "Container Stderr", tox.reporter.Verbosity.QUIET)
-        tox.reporter.error('\n' + exc.stderr)
-        exc.container.remove()
+    try:
+        count = int(envconfig.docker_shards or 1)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise tox.exception.ConfigError(
+            f'docker_shards must be a positive number, not `{envconfig.docker_shards}`')
+    return count
+
+
+def uses_posargs(envconfig) -> bool:
+    """
+    Whether `envconfig`'s commands take the positional arguments (`{posargs}`,
+    or the older `[]`), which the tests of each shard are passed as
+    """
+
+    commands = envconfig._reader.getstring('commands', '', replace=False)
+    return '{posargs' in commands or '[]' in commands
+
+
+def _run_sharded(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        run_options: dict, shard_count: int, output=None
+    ) -> None:
+    """
+    Set `venv` up once (or find the snapshot of its setup), then split its
+    tests (see `shards.get_test_items`) between up to `shard_count`
+    containers started from the snapshot, which are run at once. Each shard's
+    output is shown once they have all finished, its log and artifacts are
+    copied to its own dir in the log dir, and the time each took is recorded,
+    to split the tests more evenly next time. Unless `venv` is to be
+    snapshotted anyway, the snapshot taken for the shards is removed
+    afterwards. Raises the `docker.errors.ContainerError` of the first shard
+    that fails, if any do.
+    """
+
+    if output is None:
+        output = tox.reporter.line
+
+    timings = get_timings(venv.envconfig)
+    envconfig = venv.envconfig
+    env_name = envconfig.envname
+    container_options = _get_container_run_options(venv)
+
+    if not uses_posargs(envconfig):
+        tox.reporter.warning(
+            f'The commands of {env_name} don\'t take {{posargs}}, '
+            'so each shard runs all of its tests')
+
+    base_image = docker_image
+    docker_image, snapshot_key = _find_snapshot(
+        venv, docker_image, client, run_options, always=True)
+    if snapshot_key is not None:
+        try:
+            docker_image = _take_snapshot(
+                venv, docker_image, client, snapshot_key, run_options, container_options,
+                timings, output)
+        finally:
+            timings.stop()
+    # Only kept for later runs if it was asked for
+    temporary_snapshot = (
+        snapshot_key is not None and docker_image != base_image and not envconfig.docker_snapshot)
+
+    try:
+        _run_shards(venv, docker_image, client, run_options, container_options, shard_count,
+                    timings, output)
+    finally:
+        if temporary_snapshot:
+            try:
+                client.images.remove(docker_image)
+            except docker.errors.APIError as exc:
+                tox.reporter.verbosity1(f'Could not remove the snapshot of {env_name}: {exc}')
+
+
+def _run_shards(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        run_options: dict, container_options: dict, shard_count: int,
+        timings: timing.Timings, output
+    ) -> None:
+    """
+    Run `venv`'s commands in up to `shard_count` containers of
+    `docker_image`, in which it's set up, see `_run_sharded`
+    """
+
+    envconfig = venv.envconfig
+    env_name = envconfig.envname
+    durations_path = os.path.join(str(envconfig.envlogdir), shards.DURATIONS_FILENAME)
+    items = shards.get_test_items(str(envconfig.config.toxinidir), envconfig.config.option.args)
+    split = shards.split(items, shard_count, shards.load_durations(durations_path))
+    if not split:
+        raise tox.exception.ConfigError(f'No tests found to split between shards of {env_name}')
+
+    def run_shard(idx: int) -> tuple:
+        lines = logs.SpooledLines()
+        environment = {
+            **run_options['environment'],
+            main.POSARGS_ENV: '\n'.join(split[idx]),
+            main.SHARD_ENV: str(idx),
+            main.SHARDS_ENV: str(len(split)),
+        }
+        shard_timings = timing.Timings()
+        # Otherwise the shards' artifacts (e.g. coverage data) overwrite each other
+        shard_dir = os.path.join(container_options['artifacts_dir'], f'shard-{idx}')
+        container = error = None
+        try:
+            container = main.run_tests(
+                venv, docker_image, docker_client=client, remove_container=False,
+                output=lines.append, timings=shard_timings,
+                **{**container_options, 'artifacts_dir': shard_dir}, artifacts_dest=shard_dir,
+                extra_volumes=run_options['extra_volumes'], environment=environment)
+        except docker.errors.ContainerError as exc:
+            container, error = exc.container, exc
+        finally:
+            if container is not None:
+                container.remove(v=True)
+            shard_timings.stop()
+        return lines, error, shard_timings.total
+
+    tox.reporter.verbosity1(
+        f'Splitting {len(items)} test items of {env_name} between {len(split)} shards')
+    with timings.phase(timing.COMMANDS):
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(split), thread_name_prefix='tox-in-docker-shard') as executor:
+            results = list(executor.map(run_shard, range(len(split))))
+
+    errors = []
+    for idx, (lines, error, _seconds) in enumerate(results):
+        output(f'{env_name} shard {idx + 1}/{len(split)}: {len(split[idx])} test items')
+        for line in lines:
+            output(line)
+        lines.close()
+        if error is not None:
+            errors.append(error)
+            output(f'{env_name} shard {idx + 1}/{len(split)} exited with status '
+                   f'{error.exit_status}')
+
+    shards.save_durations(durations_path, split, [seconds for _, _, seconds in results])
+
+    if errors:
+        raise errors[0]
+
+
+def _find_snapshot(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        run_options: dict = None, always: bool = False
+    ) -> tuple:
+    """
+    Get the image to start `venv` (run with `run_options`) from, and the key
+    to snapshot it with once it's set up (or `None` if it needn't be). With
+    `docker_snapshot` (or if `always`), that's the snapshot of its setup if
+    there is one, otherwise `docker_image`.
+    """
+
+    if not (venv.envconfig.docker_snapshot or always):
+        return docker_image, None
+
+    env_name = venv.envconfig.envname
+    key = main.get_snapshot_key(docker_image, env_name, get_snapshot_setup(venv, run_options))
+    snapshot = main.find_labelled_image(client, main.SNAPSHOT_KEY_LABEL, key)
+    if snapshot is None:
+        return docker_image, key
+
+    tox.reporter.verbosity1(f'Starting {env_name} from snapshot {snapshot.id}')
+    return snapshot.id, None
+
+
+def _get_container_run_options(venv: tox.venv.VirtualEnv) -> dict:
+    """
+    Get the options for the scratch space, artifacts and resource limits of
+    `venv`'s container, as keyword arguments for `main.run_tests`
+    """
+
+    envconfig = venv.envconfig
+    return {
+        'scratch': (envconfig.docker_scratch or main.SCRATCH_BIND).lower(),
+        'scratch_size': envconfig.docker_scratch_size,
+        'artifacts_dir': str(envconfig.envlogdir),
+        'artifacts': get_artifacts(envconfig),
+        'limits': get_limits(envconfig),
+    }
+
+
+def get_artifacts(envconfig) -> list:
+    """
+    Get the glob patterns of `envconfig`'s artifacts, checking that they can
+    only match files in the working dir
+    """
+
+    artifacts = envconfig.docker_artifacts or []
+    for pattern in artifacts:
+        if (not pattern.strip() or os.path.isabs(pattern)
+                or '..' in pathlib.PurePosixPath(pattern).parts):
+            raise tox.exception.ConfigError(
+                f'{envconfig.envname}: docker_artifacts must be relative to the working dir '
+                f'(and not go up out of it), not `{pattern}`')
+    return artifacts
+
+
+def get_limits(envconfig) -> resources.Limits:
+    """
+    Get the resource limits of `envconfig`'s container, checking that they
+    can be applied
+    """
+
+    limits = resources.Limits(
+        envconfig.docker_cpus, envconfig.docker_cpuset, envconfig.docker_memory,
+        envconfig.docker_shm_size, envconfig.docker_ulimits)
+    try:
+        if limits.cpus:
+            resources.parse_cpus(limits.cpus)
+        for ulimit in limits.ulimits or []:
+            resources.parse_ulimit(ulimit)
+    except ValueError as exc:
+        raise tox.exception.ConfigError(f'{envconfig.envname}: {exc}') from None
+    return limits
+
+
+def _run_in_shared_container(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        run_options: dict
+    ) -> bool:
+    """
+    Run `venv` in the container shared by all environments using
+    `docker_image`, starting it if this is the first such environment
+    """
+
+    timings = get_timings(venv.envconfig)
+    try:
+        # Until its output shows otherwise, the environment is waiting for
+        # the container to start (or for other environments to finish in it)
+        with timings.phase(timing.START):
+            _get_shared_container(venv, docker_image, client, **run_options).run_env(
+                venv.envconfig.envname, timings=timings)
+    except docker.errors.ContainerError as exc:
+        _report_failure(venv, exc)
         return False
-    else:
-        container.remove()
     return True
+
+
+def _get_pool(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        run_options: dict
+    ) -> pool.ContainerPool:
+    """
+    Get the pool of warm containers to run `venv` in
+    """
+
+    option = venv.envconfig.config.option
+    return pool.ContainerPool(
+        docker_image, venv.envconfig.envname, client, size=option.docker_warm_pool,
+        ttl=option.docker_warm_pool_ttl or pool.DEFAULT_TTL, **run_options)
+
+
+def _run_in_pool(
+        venv: tox.venv.VirtualEnv, docker_image: str, client: docker.client.DockerClient,
+        run_options: dict
+    ) -> bool:
+    """
+    Run `venv` in a warm container, see `pool.ContainerPool`
+    """
+
+    try:
+        _get_pool(venv, docker_image, client, run_options).run_env(
+            timings=get_timings(venv.envconfig))
+    except docker.errors.ContainerError as exc:
+        _report_failure(venv, exc)
+        return False
+    return True
+
+
+def _report_failure(venv: tox.venv.VirtualEnv, exc: docker.errors.ContainerError) -> None:
+    """
+    Mark `venv` as failed, and show the end of the container's stderr.
+
+    The container's output has already been shown as it ran, so only the tail
+    kept while streaming it is repeated; the logs aren't fetched again.
+    """
+
+    # This bit here is copied from `tox.venv.test()`, more or less
+    venv.status = "commands failed"
+
+    stderr = exc.stderr.decode() if isinstance(exc.stderr, bytes) else exc.stderr
+    tox.reporter.separator("-", "Container Stderr (last lines)", tox.reporter.Verbosity.QUIET)
+    tox.reporter.error('\n' + (stderr or ''))
+    tox.reporter.error(f'{venv.envconfig.envname} exited with status {exc.exit_status}')
+
+
+def _get_shared_container(
+        venv: tox.venv.VirtualEnv, docker_image: str, client=None, **run_options
+    ) -> main.SharedContainer:
+    """
+    Get the container shared by environments using `docker_image`. It is
+    created with the `run_options` of the first environment to use it, and
+    removes itself after it has been unused for `--docker_warm_pool_ttl`.
+    """
+
+    with _SHARED_CONTAINERS_LOCK:
+        if docker_image not in _SHARED_CONTAINERS:
+            ttl = venv.envconfig.config.option.docker_warm_pool_ttl or main.DEFAULT_IDLE_TTL
+            _SHARED_CONTAINERS[docker_image] = main.SharedContainer(
+                docker_image, client, ttl=ttl, **run_options)
+        return _SHARED_CONTAINERS[docker_image]
+
+
+def _collect_scheduled(venv: tox.venv.VirtualEnv) -> bool:
+    """
+    Wait for the scheduled run of `venv`, then show its output and result
+    """
+
+    job = _SCHEDULER.wait(venv.envconfig.envname)
+
+    for line in job.output:
+        tox.reporter.line(line)
+    job.output.close()
+
+    exc = job.future.exception()
+    if exc is None:
+        venv.envconfig.docker_image = venv.run_image = job.future.result()
+        return True
+    elif isinstance(exc, docker.errors.ContainerError):
+        venv.envconfig.docker_image = venv.run_image = exc.image
+        _report_failure(venv, exc)
+        return False
+
+    raise exc
+
+
+@hookimpl
+def tox_cleanup(session):
+    global _SCHEDULER
+
+    if _SCHEDULER is not None:
+        _SCHEDULER.shutdown()
+        _SCHEDULER = None
+
+    while _SHARED_CONTAINERS:
+        _image, shared = _SHARED_CONTAINERS.popitem()
+        shared.close()
+
+    main.close_client()
@@ -0,0 +1,215 @@
+"""
+tox_in_docker.pool
+
+Keep warm containers around between tox runs, so that repeat runs of an
+environment don't pay for starting a container and syncing the source into it
+"""
+
+import hashlib
+import json
+
+import docker
+import docker.errors
+import tox
+
+from tox_in_docker import main
+from tox_in_docker import timing
+
+# Identifies the image and options a pooled container was started with, so
+# that containers started with anything else aren't reused
+POOL_KEY_LABEL = 'tox-in-docker.pool-key'
+
+# How long (in seconds) an unused container is kept for, by default
+DEFAULT_TTL = main.DEFAULT_IDLE_TTL
+
+
+def get_pool_key(image: str, extra_volumes: dict = None, environment: dict = None) -> str:
+    """
+    Get the key for containers of `image` started with `extra_volumes` and
+    `environment`
+    """
+
+    key = json.dumps([image, extra_volumes or {}, environment or {}], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class ContainerPool:
+    """
+    Warm containers of `image` for the tox environment `env_name`, which are
+    kept running between tox runs (there is no daemon, the containers are the
+    pool), and used by one run at a time.
+
+    Each container syncs the source when it is started, and is brought up to
+    date (only copying what changed) whenever it is claimed, keeping its `.tox`
+    and so its virtualenvs. Runs keep `size` unclaimed containers ready for
+    the next one. Containers remove themselves once they have been unused for
+    `ttl` seconds, and containers for the same project and environment started
+    from another image (or with other options) are removed when they're found.
+    """
+
+    def __init__(self, image: str, env_name: str, docker_client: docker.client.DockerClient = None,
+                 size: int = 1, ttl: int = DEFAULT_TTL, extra_volumes: dict = None,
+                 environment: dict = None):
+        if docker_client is None:
+            docker_client = main.get_client()
+
+        self.image = image
+        self.env_name = env_name
+        self.docker_client = docker_client
+        self.size = size
+        self.ttl = ttl
+        self.extra_volumes = extra_volumes
+        # A pooled container's working dir is only ever updated
+        self.environment = {main.SYNC_ENV: main.SYNC_WARM, **(environment or {})}
+        self.labels = {
+            main.PROJECT_LABEL: main.get_project_key(),
+            main.ENV_LABEL: env_name,
+            POOL_KEY_LABEL: get_pool_key(image, extra_volumes, self.environment),
+        }
+
+    def run_env(self, output=None, timings: timing.Timings = None) -> None:
+        """
+        Run the environment in a warm container, raising
+        `docker.errors.ContainerError` if it fails. Each line of output is
+        passed to `output`, which defaults to `tox.reporter.line`, and the
+        time each phase takes is recorded in `timings`.
+        """
+
+        if timings is None:
+            timings = timing.Timings()
+
+        with timings.phase(timing.START):
+            container = self.claim()
+        try:
+            with timings.phase(timing.SYNC):
+                self._exec(container, [main.IMAGE_ENTRYPOINT_PATH, main.RESYNC_ARG])
+            main.exec_env(self.docker_client, container, self.image, self.env_name,
+                          self.environment, output or tox.reporter.line, timings)
+        finally:
+            timings.start(timing.TEARDOWN)
+            self.release(container)
+            timings.stop()
+
+    def claim(self):
+        """
+        Claim a warm container, starting one if none are ready, and top up the
+        pool for the next run
+        """
+
+        candidates = self.reap()
+
+        claimed = None
+        while candidates and claimed is None:
+            container = candidates.pop(0)
+            if self._try_claim(container):
+                claimed = container
+
+        started = None
+        if claimed is None:
+            started = self.start()
+        else:
+            tox.reporter.verbosity1(f'Reusing warm container {claimed.short_id} for {self.env_name}')
+
+        # The untried candidates are (most likely) still unclaimed
+        for _ in range(self.size - len(candidates)):
+            self.start()
+
+        if started is not None:
+            main.wait_until_ready(started, self.image, self._command)
+            if not self._try_claim(started):
+                raise docker.errors.APIError(f'Could not claim new container {started.id}')
+            claimed = started
+
+        return claimed
+
+    def release(self, container) -> None:
+        """
+        Release `container` for use by another run. Failing to is only a
+        warning, so that it doesn't hide how the run went, and the container
+        is removed, as a claimed container would never stop.
+        """
+
+        try:
+            self._exec(container, [
+                'sh', '-c', f'rmdir {main.POOL_CLAIM_PATH} && touch {main.POOL_LAST_USED_PATH}'])
+        except docker.errors.DockerException as exc:
+            tox.reporter.warning(f'Could not release warm container {container.short_id}: {exc}')
+            try:
+                container.remove(force=True)
+            except docker.errors.APIError:
+                # Already gone
+                pass
+
+    def reap(self) -> list:
+        """
+        Remove the project's containers for the environment which were started
+        from another image or with other options, and return the running ones
+        which weren't
+        """
+
+        project_labels = {
+            main.PROJECT_LABEL: self.labels[main.PROJECT_LABEL],
+            main.ENV_LABEL: self.env_name,
+        }
+        containers = self.docker_client.containers.list(
+            all=True, filters={'label': [f'{k}={v}' for k, v in project_labels.items()]})
+
+        current = []
+        for container in containers:
+            if container.labels.get(POOL_KEY_LABEL) == self.labels[POOL_KEY_LABEL]:
+                if container.status == 'running':
+                    current.append(container)
+                continue
+
+            tox.reporter.verbosity1(f'Removing stale warm container {container.short_id}')
+            try:
+                container.remove(force=True)
+            except docker.errors.APIError:
+                # Already being removed, e.g. by a concurrent run
+                pass
+
+        return current
+
+    def start(self):
+        """
+        Start a new container for the pool, without waiting for it to be ready
+        """
+
+        tox.reporter.verbosity1(f'Starting warm container for {self.env_name} in `{self.image}`')
+        return self.docker_client.containers.run(
+            image=self.image,
+            volumes=main._get_volumes(None, self.extra_volumes),
+            command=self._command,
+            environment=self.environment,
+            labels=self.labels,
+            user=main.get_user(),
+            auto_remove=True,
+            detach=True)
+
+    @property
+    def _command(self) -> list:
+        return [main.POOL_ARG, str(self.ttl)]
+
+    def _try_claim(self, container) -> bool:
+        try:
+            return self._exec(container, [
+                'sh', '-c',
+                ' && '.join((
+                    f'test -e {main.POOL_READY_PATH}',
+                    f'mkdir {main.POOL_CLAIM_PATH} 2> /dev/null',
+                    f'touch {main.POOL_LAST_USED_PATH}')),
+            ], check=False) == 0
+        except docker.errors.APIError:
+            # e.g. it stopped since it was listed
+            return False
+
+    def _exec(self, container, command: list, check: bool = True) -> int:
+        api = self.docker_client.api
+        exec_id = api.exec_create(
+            container.id, command, user=main.get_user(), environment=self.environment)['Id']
+        output = api.exec_start(exec_id)
+
+        status = api.exec_inspect(exec_id)['ExitCode']
+        if check and status != 0:
+            raise docker.errors.ContainerError(container, status, command, self.image, output)
+        return status
@@ -0,0 +1,143 @@
+"""
+tox_in_docker.resources
+
+Limit the CPUs, memory and other resources of an environment's container
+"""
+
+import collections
+import contextlib
+import math
+import os
+
+import docker.types
+import filelock
+import tox
+
+from tox_in_docker import locks
+
+# Give each container CPUs of its own, see `lease_cpus`
+CPUSET_AUTO = 'auto'
+
+# The limits of an environment's container, as they are configured: `cpus`
+# (e.g. `1.5`), `cpuset` (e.g. `0-3`, or `CPUSET_AUTO`), `memory` and
+# `shm_size` (e.g. `2g`), and `ulimits` (e.g. `['nofile=1024:2048']`)
+Limits = collections.namedtuple(
+    'Limits', ['cpus', 'cpuset', 'memory', 'shm_size', 'ulimits'], defaults=(None,) * 5)
+
+
+def parse_ulimit(ulimit: str) -> docker.types.Ulimit:
+    """
+    Parse a ulimit in the form `docker run --ulimit` takes, `name=soft[:hard]`
+    """
+
+    try:
+        name, _, limits = ulimit.partition('=')
+        soft, _, hard = limits.partition(':')
+        return docker.types.Ulimit(name=name.strip(), soft=int(soft), hard=int(hard or soft))
+    except ValueError:
+        raise ValueError(f'Invalid ulimit `{ulimit}`, it should be `name=soft[:hard]`') from None
+
+
+def parse_cpus(cpus: str) -> float:
+    """
+    Parse a number of CPUs in the form `docker run --cpus` takes, e.g. `1.5`
+    """
+
+    try:
+        value = float(cpus)
+    except ValueError:
+        value = 0
+    if not value > 0:
+        raise ValueError(f'Invalid number of CPUs `{cpus}`, it should be a positive number')
+    return value
+
+
+def get_cpus() -> list:
+    """
+    Get the CPUs tox may use, which containers are spread across
+    """
+
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+@contextlib.contextmanager
+def lease_cpus(count: int):
+    """
+    Lease `count` CPUs which no other container started by tox-in-docker (in
+    this or any other of the user's tox processes) has, for the duration of
+    the block. Yields them in the form `cpuset_cpus` takes (e.g.
+    `2,3`), or `None` if there aren't enough free (or they can't be leased),
+    in which case the container shouldn't be pinned. Blocks while another
+    container's CPUs are being leased.
+    """
+
+    leased = []
+    try:
+        try:
+            # Leases are taken one at a time, so that two containers can't
+            # both end up with some of the CPUs they need
+            with locks.file_lock('cpus.lock'):
+                for cpu in get_cpus():
+                    if len(leased) == count:
+                        break
+                    lock = locks.file_lock(f'cpu-{cpu}.lock', timeout=0)
+                    try:
+                        lock.acquire()
+                    except filelock.Timeout:
+                        continue
+                    leased.append((cpu, lock))
+        except PermissionError as exc:
+            tox.reporter.verbosity1(f'Could not lease CPUs for the container: {exc}')
+        else:
+            if len(leased) < count:
+                tox.reporter.verbosity1(f'Not enough free CPUs to pin {count} for the container')
+
+        if len(leased) < count:
+            for _cpu, lock in leased:
+                lock.release()
+            leased = []
+            yield None
+        else:
+            yield ','.join(str(cpu) for cpu, _lock in leased)
+    finally:
+        for _cpu, lock in leased:
+            lock.release()
+
+
+@contextlib.contextmanager
+def container_options(limits: Limits = None):
+    """
+    Get the keyword arguments for `docker_client.containers.run` which apply
+    `limits`, for the duration of the block, as CPUs are leased for the block
+    if `limits.cpuset` is `CPUSET_AUTO`.
+
+    Memory can't be swapped beyond the limit, so that a container which leaks
+    is killed rather than slowing the whole host down.
+    """
+
+    limits = limits or Limits()
+    options = {}
+
+    if limits.cpus:
+        options['nano_cpus'] = int(parse_cpus(limits.cpus) * 1e9)
+    if limits.memory:
+        options['mem_limit'] = options['memswap_limit'] = limits.memory
+    if limits.shm_size:
+        options['shm_size'] = limits.shm_size
+    if limits.ulimits:
+        options['ulimits'] = [parse_ulimit(ulimit) for ulimit in limits.ulimits]
+
+    if limits.cpuset and limits.cpuset.lower() == CPUSET_AUTO:
+        # As many CPUs as the container may use, and at least one
+        count = min(max(math.ceil(parse_cpus(limits.cpus or 1)), 1), len(get_cpus()))
+        with lease_cpus(count) as cpuset:
+            if cpuset is not None:
+                options['cpuset_cpus'] = cpuset
+            yield options
+        return
+
+    if limits.cpuset:
+        options['cpuset_cpus'] = limits.cpuset
+    yield options
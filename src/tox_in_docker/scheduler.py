@@ -0,0 +1,127 @@
+"""
+tox_in_docker.scheduler
+
+Run in-docker environments concurrently on a bounded pool of workers
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import threading
+
+from tox_in_docker import logs
+
+# `output` holds the lines the job has written so far (a `logs.SpooledLines`,
+# so they needn't all be in memory), so that they can be shown together once
+# the job is done
+Job = collections.namedtuple('Job', ['future', 'output'])
+
+
+class Scheduler:
+    """
+    Run jobs, one per environment, on at most `workers` threads at once.
+
+    Each job's output is buffered rather than written as it arrives, so that
+    the output of several environments isn't interleaved; the caller shows it
+    when it waits for the job, in whatever order it waits for them.
+    """
+
+    def __init__(self, workers: int):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='tox-in-docker')
+        self._jobs = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._jobs
+
+    def submit(self, name: str, fn, *args, **kwargs) -> Job:
+        """
+        Schedule `fn(*args, output=..., **kwargs)` as the job for `name`.
+        `output` is a callable which buffers a line of the job's output.
+        """
+
+        output = logs.SpooledLines()
+        future = self._executor.submit(fn, *args, output=output.append, **kwargs)
+        self._jobs[name] = job = Job(future, output)
+        return job
+
+    def wait(self, name: str) -> Job:
+        """
+        Wait for the job for `name` to finish, and return it
+        """
+
+        job = self._jobs[name]
+        concurrent.futures.wait([job.future])
+        return job
+
+    def shutdown(self) -> None:
+        """
+        Cancel jobs which haven't started, and wait for the others to finish
+        """
+
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class AsyncScheduler(Scheduler):
+    """
+    Run jobs, which are coroutine functions, on one event loop (in a thread of
+    its own), with at most `workers` of them running at once, or any number
+    if `workers` is `None`.
+
+    Waiting on the daemon doesn't tie up a thread per job, so many more jobs
+    can run at once than with `Scheduler`. Shutting down cancels the jobs
+    which are still running, so that they can clean up (e.g. remove their
+    containers) before it returns.
+    """
+
+    def __init__(self, workers: int = None):
+        self._workers = workers
+        self._semaphore = None
+        self._jobs = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name='tox-in-docker-aio', daemon=True)
+        self._thread.start()
+
+    def submit(self, name: str, fn, *args, **kwargs) -> Job:
+        """
+        Schedule `await fn(*args, output=..., **kwargs)` as the job for
+        `name`. `output` is a callable which buffers a line of the job's
+        output.
+        """
+
+        output = logs.SpooledLines()
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(fn(*args, output=output.append, **kwargs)), self._loop)
+        self._jobs[name] = job = Job(future, output)
+        return job
+
+    async def _run(self, coroutine):
+        if self._workers is None:
+            return await coroutine
+
+        # Made here, so that it belongs to the scheduler's event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._workers)
+        async with self._semaphore:
+            return await coroutine
+
+    def shutdown(self) -> None:
+        """
+        Cancel the jobs which haven't finished, wait for them to clean up,
+        and stop the event loop
+        """
+
+        if not self._loop.is_running():
+            return
+
+        asyncio.run_coroutine_threadsafe(self._cancel_all(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _cancel_all(self) -> None:
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,87 @@
+"""
+tox_in_docker.shards
+
+Split an environment's tests between several containers, by how long they
+took before
+"""
+
+import json
+import os
+import pathlib
+
+# Where the time each test item took is kept, in the environment's log dir
+DURATIONS_FILENAME = 'shard-durations.json'
+
+# The tests run when no positional arguments are given (see the entrypoint)
+DEFAULT_TESTS_DIR = 'tests'
+TEST_FILE_PATTERNS = ('test_*.py', '*_test.py')
+
+
+def get_test_items(root: str, posargs: list = None) -> list:
+    """
+    Get the items to split between shards: the positional arguments given to
+    tox (test paths or pytest node IDs) if there are any, otherwise the test
+    files in the tests dir of `root`, relative to it
+    """
+
+    if posargs:
+        return list(posargs)
+
+    tests_dir = pathlib.Path(root, DEFAULT_TESTS_DIR)
+    return sorted({
+        str(path.relative_to(root))
+        for pattern in TEST_FILE_PATTERNS
+        for path in tests_dir.glob(f'**/{pattern}')})
+
+
+def split(items: list, count: int, durations: dict = None) -> list:
+    """
+    Split `items` into (at most) `count` shards which should take about as
+    long as each other, going by `durations` (seconds by item). Items without
+    a duration are taken to take as long as the average one.
+
+    The longest items are placed first, each in the shard with the least
+    to do so far.
+    """
+
+    durations = durations or {}
+    known = [durations[item] for item in items if item in durations]
+    default = sum(known) / len(known) if known else 1.0
+
+    shards = [[] for _ in range(min(count, len(items)))]
+    loads = [0.0] * len(shards)
+    for item in sorted(items, key=lambda item: durations.get(item, default), reverse=True):
+        idx = loads.index(min(loads))
+        shards[idx].append(item)
+        loads[idx] += durations.get(item, default)
+
+    return shards
+
+
+def load_durations(path: str) -> dict:
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path) as durations_file:
+        try:
+            return json.load(durations_file)
+        except json.JSONDecodeError:
+            return {}
+
+
+def save_durations(path: str, shards: list, seconds: list) -> None:
+    """
+    Record how long the items of each of `shards` took, given the `seconds`
+    each shard took. A shard's time is shared evenly between its items, so
+    it's only an estimate, which improves as items move between shards from
+    one run to the next.
+    """
+
+    durations = load_durations(path)
+    for items, shard_seconds in zip(shards, seconds):
+        for item in items:
+            durations[item] = shard_seconds / len(items)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as durations_file:
+        json.dump(durations, durations_file, indent=2, sort_keys=True)
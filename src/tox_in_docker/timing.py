@@ -0,0 +1,180 @@
+"""
+tox_in_docker.timing
+
+Time the phases of running an environment in docker
+"""
+
+import contextlib
+import json
+import os
+import re
+import time
+
+import filelock
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# Printed by the entrypoint (on a line of its own) as it starts each phase
+PHASE_MARKER = 'tox-in-docker: phase'
+
+# The phases, in the order they happen. `resolve` finds the image to use,
+# `build` builds (or finds) the testing image, `start` starts the container,
+# `sync` copies the source into it, `setup` is tox creating and installing
+# the virtualenv, `commands` is the test commands, and `teardown` waits for
+# and removes the container.
+RESOLVE = 'resolve'
+BUILD = 'build'
+START = 'start'
+SYNC = 'sync'
+SETUP = 'setup'
+COMMANDS = 'commands'
+TEARDOWN = 'teardown'
+PHASES = (RESOLVE, BUILD, START, SYNC, SETUP, COMMANDS, TEARDOWN)
+
+# tox's reports of the actions it runs, e.g. `py39 installdeps: pytest`
+TOX_ACTION_RE = re.compile(r'^(?P<env>\S+) (?P<action>[a-z-]+): ')
+TOX_ACTION_PHASES = {
+    'create': SETUP,
+    'installdeps': SETUP,
+    'inst': SETUP,
+    'inst-nodeps': SETUP,
+    'develop-inst': SETUP,
+    'develop-inst-nodeps': SETUP,
+    'installed': SETUP,
+    'run-test-pre': COMMANDS,
+    'run-test': COMMANDS,
+}
+
+
+class Timings:
+    """
+    The time spent in each phase of running an environment in docker.
+
+    Phases are either timed around a block with `phase`, or, for the ones
+    which can only be seen in the container's output, from when one `start`s
+    to when the next does (or `stop` is called). Time spent in a phase more
+    than once is added up.
+    """
+
+    def __init__(self):
+        # Phase name to seconds spent in it, in the order they were started
+        self.durations = {}
+        # (phase name, start, end) in nanoseconds since the epoch, for spans
+        self.spans = []
+        self._current = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Time the phase `name` for the duration of the block
+        """
+
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def start(self, name: str) -> None:
+        """
+        Start timing the phase `name`, stopping the current one
+        """
+
+        self.stop()
+        self._current = (name, time.perf_counter(), time.time_ns())
+
+    def stop(self) -> None:
+        """
+        Stop timing the current phase, if there is one
+        """
+
+        if self._current is None:
+            return
+
+        name, started, started_ns = self._current
+        self._current = None
+        self.durations[name] = self.durations.get(name, 0.0) + time.perf_counter() - started
+        self.spans.append((name, started_ns, time.time_ns()))
+
+    @property
+    def total(self) -> float:
+        return sum(self.durations.values())
+
+    def summary(self) -> str:
+        """
+        Get the time of each phase, e.g. `build 1.2s, start 0.4s`
+        """
+
+        return ', '.join(f'{name} {seconds:.1f}s' for name, seconds in self.durations.items())
+
+    def as_dict(self) -> dict:
+        return {**{name: round(seconds, 3) for name, seconds in self.durations.items()},
+                'total': round(self.total, 3)}
+
+    def output_filter(self, env_name: str, output):
+        """
+        Wrap the callable `output`, which is passed each line of a container's
+        output, to start phases as the entrypoint's phase markers and tox's
+        actions for `env_name` are seen. The markers aren't passed on.
+        """
+
+        def filtered(line: str) -> None:
+            if line.startswith(PHASE_MARKER):
+                self.start(line[len(PHASE_MARKER):].strip())
+                return
+
+            match = TOX_ACTION_RE.match(line)
+            if match is not None and match['env'] == env_name:
+                phase = TOX_ACTION_PHASES.get(match['action'])
+                if phase is not None and (self._current is None or self._current[0] != phase):
+                    self.start(phase)
+
+            output(line)
+
+        return filtered
+
+    def emit_spans(self, env_name: str) -> None:
+        """
+        Record the phases as OpenTelemetry spans (under one for the
+        environment), if `opentelemetry-api` is installed. They only go
+        anywhere if an SDK has been configured, e.g. with
+        `opentelemetry-instrument`.
+        """
+
+        if trace is None or not self.spans:
+            return
+
+        tracer = trace.get_tracer('tox_in_docker')
+        parent = tracer.start_span(
+            f'tox-in-docker {env_name}', start_time=min(start for _, start, _ in self.spans),
+            attributes={'tox.env': env_name})
+        context = trace.set_span_in_context(parent)
+        for name, start, end in self.spans:
+            tracer.start_span(name, context=context, start_time=start).end(end_time=end)
+        parent.end(end_time=max(end for _, _, end in self.spans))
+
+
+def write_json(path: str, timings: dict) -> None:
+    """
+    Add the `Timings` of each environment in `timings` (keyed by environment
+    name) to the JSON report at `path`. Each `tox -p` process adds its own
+    environments, so the report is updated under a lock.
+    """
+
+    path = os.path.abspath(path)
+    with filelock.FileLock(f'{path}.lock'):
+        report = {}
+        if os.path.isfile(path):
+            with open(path) as report_file:
+                try:
+                    report = json.load(report_file)
+                except json.JSONDecodeError:
+                    report = {}
+
+        report.update({env_name: env_timings.as_dict() for env_name, env_timings in timings.items()})
+
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
@@ -10,6 +10,9 @@ import re
 
 LATEST = 'python:latest'
 
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$', re.IGNORECASE)
+
 Match = collections.namedtuple('Match', ['regex', 'image'])
 
 
@@ -39,6 +42,30 @@ def is_in_docker():
 
     return os.path.exists('/.dockerenv')
 
+def parse_size(size: str) -> int:
+    """
+    Get the number of bytes in a size like docker's, e.g. `512m` or `2G`
+    """
+
+    match = SIZE_RE.match(str(size))
+    if match is None:
+        raise ValueError(f'could not parse size {size!r}, expected something like `512m` or `2g`')
+
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.lower()])
+
+
+def docker_safe_name(name: str) -> str:
+    """
+    Make `name` usable as the name of a docker volume or container
+    """
+
+    name = re.sub(r'[^a-zA-Z0-9_.-]', '-', name)
+    if not name[:1].isalnum():
+        name = f'x{name}'
+    return name
+
+
 def _get_version_tag(env_version: str):
     """
     Get the docker tag to use given the python environment name
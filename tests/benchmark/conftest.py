@@ -0,0 +1,32 @@
+import pytest
+
+from tox_in_docker import main
+
+from .fake_docker import FakeDocker
+
+
+@pytest.fixture(scope='module')
+def fake_docker():
+    """
+    A fake docker daemon, which `DOCKER_HOST` points the plugin's shared client
+    at. Each test starts with no images or containers.
+    """
+
+    server = FakeDocker()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def docker_host(fake_docker, monkeypatch):
+    monkeypatch.setenv('DOCKER_HOST', fake_docker.base_url)
+    monkeypatch.delenv('DOCKER_TLS_VERIFY', raising=False)
+    main.close_client()
+    main.clear_build_cache()
+    fake_docker.reset()
+
+    yield fake_docker
+
+    main.close_client()
+    main.clear_build_cache()
@@ -0,0 +1,297 @@
+"""
+A stand-in for the Docker Engine API, for benchmarking the plugin without a
+docker daemon.
+
+Only the endpoints the plugin uses are implemented, and only as far as
+`docker-py` needs. Every request takes `latency` seconds, builds take
+`build_latency` seconds more, and containers write `log_lines` lines of
+`line_size` bytes (one in `stderr_every` of them to stderr) when attached to,
+`attach_delay` seconds after the response's headers.
+"""
+
+import hashlib
+import http.server
+import itertools
+import json
+import re
+import struct
+import threading
+import time
+import urllib.parse
+
+STDOUT = 1
+STDERR = 2
+
+
+class FakeDocker(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, build_latency: float = 0.0, log_lines: int = 100,
+                 line_size: int = 80, stderr_every: int = 10, exit_code: int = 0,
+                 attach_delay: float = 0.005):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.latency = latency
+        self.build_latency = build_latency
+        self.log_lines = log_lines
+        self.line_size = line_size
+        self.stderr_every = stderr_every
+        self.exit_code = exit_code
+        self.attach_delay = attach_delay
+
+        self.lock = threading.Lock()
+        self._ids = itertools.count()
+        self.reset()
+
+    @property
+    def base_url(self) -> str:
+        return f'tcp://127.0.0.1:{self.server_address[1]}'
+
+    def reset(self) -> None:
+        """
+        Forget every image and container, apart from the base images, which
+        are always there
+        """
+
+        with self.lock:
+            self.images = {}
+            self.containers = {}
+            # The number of requests for each endpoint, e.g. `POST /build`
+            self.requests = {}
+
+    def start(self) -> None:
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def new_id(self) -> str:
+        return hashlib.sha256(str(next(self._ids)).encode()).hexdigest()
+
+    def get_image(self, name: str) -> dict:
+        """
+        Get an image by ID, short ID or tag. Any other tag is taken to be a
+        base image, which exists without being pulled.
+        """
+
+        name = urllib.parse.unquote(name)
+        with self.lock:
+            is_id = re.fullmatch(r'(sha256:)?[0-9a-f]{12,64}', name) is not None
+            for image in self.images.values():
+                if name in image['RepoTags'] or (
+                        is_id and image['Id'].split(':')[-1].startswith(name.split(':')[-1])):
+                    return image
+
+            image = self._add_image([name], {}, env=['PYTHON_VERSION=3.11.4'])
+        return image
+
+    def add_image(self, tags: list, labels: dict) -> dict:
+        with self.lock:
+            return self._add_image(tags, labels)
+
+    def _add_image(self, tags: list, labels: dict, env: list = None) -> dict:
+        image_id = f'sha256:{self.new_id()}'
+        self.images[image_id] = image = {
+            'Id': image_id,
+            'RepoTags': list(tags),
+            'Config': {'Labels': labels, 'Env': env or []},
+            'Labels': labels,
+        }
+        return image
+
+    def log_frames(self):
+        """
+        Yield the multiplexed frames a container writes when attached to
+        """
+
+        line = b'x' * (self.line_size - 1) + b'\n'
+        for i in range(self.log_lines):
+            stream = STDERR if self.stderr_every and i % self.stderr_every == 0 else STDOUT
+            yield struct.pack('>BxxxL', stream, len(line)) + line
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Otherwise small responses can wait for delayed ACKs, which would dwarf
+    # what is being measured
+    disable_nagle_algorithm = True
+
+    # (method, path pattern, handler name), the path without the API version
+    ROUTES = [
+        ('GET', r'/version', 'version'),
+        ('GET', r'/_ping', 'ping'),
+        ('GET', r'/images/json', 'list_images'),
+        ('GET', r'/images/(?P<name>.+)/json', 'inspect_image'),
+        ('POST', r'/images/create', 'pull'),
+        ('POST', r'/images/(?P<name>.+)/tag', 'tag'),
+        ('POST', r'/build', 'build'),
+        ('POST', r'/containers/create', 'create'),
+        ('GET', r'/containers/(?P<id>[^/]+)/json', 'inspect_container'),
+        ('POST', r'/containers/(?P<id>[^/]+)/start', 'start'),
+        ('POST', r'/containers/(?P<id>[^/]+)/attach', 'attach'),
+        ('POST', r'/containers/(?P<id>[^/]+)/wait', 'wait'),
+        ('DELETE', r'/containers/(?P<id>[^/]+)', 'remove'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method: str) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        path = re.sub(r'^/v[\d.]+', '', url.path)
+        self.query = urllib.parse.parse_qs(url.query)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            self.body = self._read_chunked()
+
+        time.sleep(self.server.latency)
+
+        for route_method, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                with self.server.lock:
+                    key = f'{method} {pattern}'
+                    self.server.requests[key] = self.server.requests.get(key, 0) + 1
+                getattr(self, name)(**match.groupdict())
+                return
+
+        self._json({'message': f'{method} {path} is not implemented'}, status=404)
+
+    def _read_chunked(self) -> bytes:
+        body = b''
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return body
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def _json(self, data, status: int = 200) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _empty(self, status: int = 204) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def version(self):
+        self._json({'ApiVersion': '1.41', 'Version': '20.10.0', 'MinAPIVersion': '1.12'})
+
+    def ping(self):
+        body = b'OK'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def list_images(self):
+        filters = json.loads(self.query.get('filters', ['{}'])[0])
+        wanted = [label.split('=', 1) for label in filters.get('label', [])]
+        with self.server.lock:
+            images = [image for image in self.server.images.values()
+                      if all(image['Labels'].get(name) == value for name, value in wanted)]
+        self._json(images)
+
+    def inspect_image(self, name):
+        self._json(self.server.get_image(name))
+
+    def pull(self):
+        image = self.query['fromImage'][0]
+        tag = self.query.get('tag', ['latest'])[0]
+        self.server.get_image(f'{image}:{tag}')
+        self._json({'status': 'Downloaded newer image'})
+
+    def tag(self, name):
+        image = self.server.get_image(name)
+        with self.server.lock:
+            image['RepoTags'].append(f'{self.query["repo"][0]}:{self.query.get("tag", ["latest"])[0]}')
+        self._empty(201)
+
+    def build(self):
+        time.sleep(self.server.build_latency)
+        labels = json.loads(self.query.get('labels', ['{}'])[0])
+        image = self.server.add_image(self.query.get('t', []), labels)
+
+        body = b''.join(json.dumps(line).encode() + b'\r\n' for line in [
+            {'stream': 'Step 1/1 : FROM base\n'},
+            {'aux': {'ID': image['Id']}},
+            {'stream': f'Successfully built {image["Id"].split(":")[-1][:12]}\n'},
+        ])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def create(self):
+        config = json.loads(self.body or b'{}')
+        container_id = self.server.new_id()
+        with self.server.lock:
+            self.server.containers[container_id] = {
+                'Id': container_id,
+                'Image': config.get('Image'),
+                'Config': config,
+                'State': {'Status': 'created', 'Running': False},
+                'HostConfig': config.get('HostConfig', {}),
+            }
+        self._json({'Id': container_id, 'Warnings': []}, status=201)
+
+    def _container(self, id):
+        with self.server.lock:
+            return self.server.containers.get(id)
+
+    def inspect_container(self, id):
+        container = self._container(id)
+        if container is None:
+            self._json({'message': f'No such container: {id}'}, status=404)
+        else:
+            self._json(container)
+
+    def start(self, id):
+        self._container(id)['State'] = {'Status': 'running', 'Running': True}
+        self._empty()
+
+    def attach(self, id):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+        # `docker-py` reads the stream from the socket once it has read the
+        # headers, so don't let the first frames arrive with them, where they
+        # would be buffered (and lost). Clients busy with many containers take
+        # longer to get there.
+        time.sleep(self.server.attach_delay)
+
+        for frame in self.server.log_frames():
+            self.wfile.write(frame)
+        self.wfile.flush()
+        self.close_connection = True
+
+    def wait(self, id):
+        self._container(id)['State'] = {'Status': 'exited', 'Running': False}
+        self._json({'StatusCode': self.server.exit_code, 'Error': None})
+
+    def remove(self, id):
+        with self.server.lock:
+            self.server.containers.pop(id, None)
+        self._empty()
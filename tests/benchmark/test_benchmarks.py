@@ -0,0 +1,170 @@
+"""
+Benchmarks for the plugin's hot paths, run against a fake docker daemon (see
+`fake_docker`), so that they measure the plugin and not docker.
+
+Run them with `tox -e benchmark`, which saves the results in `.benchmarks` and
+compares them with the last saved run.
+"""
+
+import asyncio
+import concurrent.futures
+import types
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from tox_in_docker import aio, main, plugin, timing, util
+
+BASE = 'python:3.11-slim'
+
+
+def _venv(envname: str = 'py311', docker_image: str = None):
+    """
+    Get just enough of a `tox.venv.VirtualEnv` for the plugin, which has
+    already decided to run it in docker
+    """
+
+    option = types.SimpleNamespace(
+        docker_workers=None, docker_async=None, docker_pool_size=None, docker_buildkit=None,
+        docker_batch=None, docker_warm_pool=None, docker_image_cache=None)
+    envconfig = types.SimpleNamespace(
+        envname=envname, docker_image=docker_image, docker_build_dir=None,
+        docker_build_base_arg=None, config=types.SimpleNamespace(option=option))
+    setattr(envconfig, plugin.RUN_DECISION_ATTR, plugin.RunDecision(True, 'benchmark'))
+    return types.SimpleNamespace(envconfig=envconfig)
+
+
+def test_get_default_image(benchmark):
+    envnames = ['py', 'py3', 'py39', 'py310', 'py311', 'pypy39']
+    benchmark(lambda: [util.get_default_image(envname) for envname in envnames])
+
+
+def test_build_testing_image_cold(benchmark, docker_host):
+    """
+    A build, with nothing cached
+    """
+
+    def setup():
+        docker_host.reset()
+        main.clear_build_cache()
+
+    benchmark.pedantic(main.build_testing_image, args=(BASE,), setup=setup, rounds=20)
+    assert docker_host.requests['POST /build'] == 1
+
+
+def test_build_testing_image_label_hit(benchmark, docker_host):
+    """
+    A later run finding the image an earlier one built
+    """
+
+    main.build_testing_image(BASE)
+
+    benchmark.pedantic(
+        main.build_testing_image, args=(BASE,), setup=main.clear_build_cache, rounds=50)
+    assert docker_host.requests['POST /build'] == 1
+
+
+def test_build_testing_image_memoized(benchmark, docker_host):
+    """
+    Another environment in the same run needing the same image
+    """
+
+    main.build_testing_image(BASE)
+    benchmark(main.build_testing_image, BASE)
+
+
+def test_runtest_pre(benchmark, docker_host):
+    """
+    The per-environment overhead of preparing to run in docker, once the
+    image has been built
+    """
+
+    main.build_testing_image(BASE)
+
+    def setup():
+        return (_venv(),), {}
+
+    benchmark.pedantic(plugin.tox_runtest_pre, setup=setup, rounds=50)
+
+
+@pytest.mark.parametrize('log_lines', [100, 10_000, 100_000])
+def test_run_tests_log_throughput(benchmark, docker_host, log_lines):
+    """
+    Running an environment which writes `log_lines` lines
+    """
+
+    docker_host.log_lines = log_lines
+    image = main.build_testing_image(BASE).id
+    lines = []
+
+    def run():
+        lines.clear()
+        container = main.run_tests(
+            _venv(), image, remove_container=False, output=lines.append,
+            timings=timing.Timings())
+        container.remove()
+
+    benchmark.pedantic(run, rounds=5, iterations=1)
+    assert len(lines) == log_lines
+    benchmark.extra_info['lines_per_round'] = log_lines
+
+
+def test_run_tests_latency(benchmark, docker_host):
+    """
+    The per-environment overhead of running in docker, with a daemon which
+    takes 5ms to answer each request
+    """
+
+    docker_host.latency = 0.005
+    docker_host.log_lines = 10
+    image = main.build_testing_image(BASE).id
+
+    def run():
+        main.run_tests(_venv(), image, remove_container=False, output=lambda line: None).remove()
+
+    try:
+        benchmark.pedantic(run, rounds=10, iterations=1)
+    finally:
+        docker_host.latency = 0.0
+
+
+@pytest.mark.parametrize('driver', ['threads', 'async'])
+def test_run_many_envs(benchmark, docker_host, driver):
+    """
+    Running 50 environments at once, each in a thread (as `--docker_workers`
+    does) or all from one event loop (as `--docker_async` does), with a daemon
+    which takes 5ms to answer each request
+    """
+
+    docker_host.latency = 0.005
+    docker_host.log_lines = 100
+    docker_host.attach_delay = 0.05
+    image = main.build_testing_image(BASE).id
+    venvs = [_venv(f'py{idx}') for idx in range(50)]
+
+    def run_threads():
+        def run(venv):
+            main.run_tests(venv, image, remove_container=False, output=lambda line: None).remove()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(venvs)) as executor:
+            list(executor.map(run, venvs))
+
+    async def run_async():
+        client = aio.AsyncDockerClient()
+
+        async def run(venv):
+            container_id = await aio.run_tests(venv, image, client, output=lambda line: None)
+            await client.remove(container_id)
+
+        await asyncio.gather(*(run(venv) for venv in venvs))
+
+    try:
+        if driver == 'threads':
+            main.get_client(len(venvs))
+            benchmark.pedantic(run_threads, rounds=5, iterations=1)
+        else:
+            benchmark.pedantic(lambda: asyncio.run(run_async()), rounds=5, iterations=1)
+    finally:
+        docker_host.latency = 0.0
+        docker_host.attach_delay = 0.005
@@ -0,0 +1,186 @@
+import asyncio
+import contextlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import unittest
+import unittest.mock as mock
+
+import docker.errors
+
+import tox_in_docker.aio
+import tox_in_docker.logs
+from tox_in_docker import resources
+
+CONTAINER_ID = 'c0ffee'
+
+
+class FakeDaemon:
+    """
+    Just enough of the Engine API on a unix socket to run a container, which
+    writes `frames` when attached to and exits with `exit_code`. If `hang`,
+    it never exits, and if `fail_start`, it can't be started.
+    """
+
+    def __init__(self, path: str, frames: list, exit_code: int = 0, hang: bool = False,
+                 fail_start: bool = False):
+        self.path = path
+        self.frames = frames
+        self.exit_code = exit_code
+        self.hang = hang
+        self.fail_start = fail_start
+        self.requests = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._handle, self.path)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        method, target, _ = (await reader.readline()).decode().split()
+        length = 0
+        while (line := (await reader.readline()).strip()):
+            name, _, value = line.decode().partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        body = await reader.readexactly(length) if length else b''
+        path = target.split('?')[0].split('/', 2)[2]
+        self.requests.append((method, path))
+
+        if path == 'containers/create':
+            self._respond(writer, 201, {'Id': CONTAINER_ID, 'Config': json.loads(body)})
+        elif path.endswith('/attach'):
+            writer.write(b'HTTP/1.1 101 UPGRADED\r\nConnection: Upgrade\r\nUpgrade: tcp\r\n\r\n')
+            for stream, data in self.frames:
+                writer.write(struct.pack('>BxxxL', stream, len(data)) + data)
+        elif path.endswith('/start') and self.fail_start:
+            self._respond(writer, 500, {'message': 'cannot start container'})
+        elif path.endswith('/wait'):
+            if self.hang:
+                await asyncio.Event().wait()
+            self._respond(writer, 200, {'StatusCode': self.exit_code})
+        elif path.endswith('/start') or method == 'DELETE':
+            self._respond(writer, 204)
+        else:
+            self._respond(writer, 404, {'message': f'No such thing: {path}'})
+
+        await writer.drain()
+        writer.close()
+
+    def _respond(self, writer, status: int, data: dict = None) -> None:
+        body = json.dumps(data).encode() if data is not None else b''
+        writer.write(f'HTTP/1.1 {status} X\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+
+
+class TestAsyncDockerClient(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.daemon = FakeDaemon(os.path.join(self.tmp_dir.name, 'docker.sock'), frames=[
+            (1, b'first li'), (1, b'ne\nsecond\n'), (2, b'oops\n')])
+        await self.daemon.start()
+        self.client = tox_in_docker.aio.AsyncDockerClient(f'unix://{self.daemon.path}')
+
+    async def asyncTearDown(self):
+        await self.daemon.stop()
+
+    async def test_run_container(self):
+        lines = []
+        log_stream = tox_in_docker.logs.LogStream(lines.append)
+
+        container_id, status = await tox_in_docker.aio.run_container(
+            self.client, {'Image': 'spam'}, log_stream)
+
+        self.assertEqual((container_id, status), (CONTAINER_ID, 0))
+        self.assertEqual(lines, ['first line', 'second', 'oops'])
+        self.assertEqual(log_stream.tail(tox_in_docker.logs.STDERR), 'oops')
+        # Attached before it's started, so none of its output is missed
+        self.assertEqual([path for _, path in self.daemon.requests], [
+            'containers/create', f'containers/{CONTAINER_ID}/attach',
+            f'containers/{CONTAINER_ID}/start', f'containers/{CONTAINER_ID}/wait'])
+
+    async def test_cancel_removes_container(self):
+        self.daemon.hang = True
+        log_stream = tox_in_docker.logs.LogStream(lambda line: None)
+
+        task = asyncio.create_task(tox_in_docker.aio.run_container(
+            self.client, {'Image': 'spam'}, log_stream))
+        while ('POST', f'containers/{CONTAINER_ID}/wait') not in self.daemon.requests:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(self.daemon.requests[-1], ('DELETE', f'containers/{CONTAINER_ID}'))
+
+    async def test_failed_start_removes_container(self):
+        self.daemon.fail_start = True
+        log_stream = tox_in_docker.logs.LogStream(lambda line: None)
+
+        with self.assertRaises(docker.errors.APIError):
+            await tox_in_docker.aio.run_container(self.client, {'Image': 'spam'}, log_stream)
+
+        # The caller never gets its ID, so it's removed here
+        self.assertEqual(self.daemon.requests[-1], ('DELETE', f'containers/{CONTAINER_ID}'))
+
+    async def test_error(self):
+        with self.assertRaises(docker.errors.NotFound) as ctx:
+            await self.client.request('GET', '/images/spam/json')
+
+        self.assertEqual(ctx.exception.explanation, 'No such thing: images/spam/json')
+
+    async def test_run_tests_failure(self):
+        self.daemon.exit_code = 2
+        venv_mock = mock.Mock()
+        venv_mock.envconfig.envname = 'py311'
+
+        with self.assertRaises(docker.errors.ContainerError) as ctx:
+            await tox_in_docker.aio.run_tests(
+                venv_mock, 'spam', self.client, output=lambda line: None)
+
+        self.assertEqual(ctx.exception.container, CONTAINER_ID)
+        self.assertEqual(ctx.exception.exit_status, 2)
+        self.assertEqual(ctx.exception.stderr, b'oops')
+
+
+class TestContainerOptions(unittest.IsolatedAsyncioTestCase):
+
+    async def _get_options(self, limits: resources.Limits) -> dict:
+        async with tox_in_docker.aio.container_options(limits) as options:
+            return options
+
+    async def test_lease_doesnt_block(self):
+        other_lease_taken = threading.Event()
+
+        @contextlib.contextmanager
+        def lease_cpus(count):
+            # Waits for another lease, taken once the event loop runs again
+            yield '0' if other_lease_taken.wait(5) else None
+
+        limits = resources.Limits(cpuset=resources.CPUSET_AUTO)
+        with mock.patch('tox_in_docker.resources.lease_cpus', lease_cpus):
+            task = asyncio.ensure_future(self._get_options(limits))
+            asyncio.get_running_loop().call_soon(other_lease_taken.set)
+            options = await task
+
+        self.assertEqual(options['cpuset_cpus'], '0')
+
+
+class TestCreateConfig(unittest.TestCase):
+
+    def test_run_options(self):
+        config = tox_in_docker.aio.get_create_config(
+            'spam', ['-e', 'py311'], user='1000', environment={'SPAM': 'eggs'},
+            volumes={'/src': {'bind': '/working_dir', 'mode': 'rw'}},
+            tmpfs={'/working_dir': 'rw,exec'})
+
+        self.assertEqual(config['Cmd'], ['-e', 'py311'])
+        self.assertEqual(config['Env'], ['SPAM=eggs'])
+        self.assertEqual(config['HostConfig']['Binds'], ['/src:/working_dir:rw'])
+        self.assertEqual(config['HostConfig']['Tmpfs'], {'/working_dir': 'rw,exec'})
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import docker.errors
+
+from tox_in_docker import image_cache
+
+KEY = 'f00d'
+
+
+class TestTarballCache(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache = os.path.join(cache_dir.name, 'images')
+        self.client_mock = mock.Mock()
+        self.image_mock = mock.Mock()
+        self.image_mock.save.return_value = iter([b'layer', b'tar'])
+
+    def test_miss(self):
+        self.assertIsNone(image_cache.load(self.client_mock, self.cache, image_cache.CONTENT, KEY))
+        self.client_mock.images.load.assert_not_called()
+
+    def test_saved_then_loaded(self):
+        image_cache.save(self.client_mock, self.cache, image_cache.CONTENT, KEY, self.image_mock)
+
+        path = os.path.join(self.cache, f'{image_cache.CONTENT}-{KEY}.tar')
+        with open(path, 'rb') as tarball:
+            self.assertEqual(tarball.read(), b'layertar')
+        self.assertEqual(os.listdir(self.cache), [os.path.basename(path)])
+
+        loaded = mock.Mock()
+        self.client_mock.images.load.return_value = [loaded]
+        self.assertIs(image_cache.load(self.client_mock, self.cache, image_cache.CONTENT, KEY), loaded)
+        # Keyed by kind as well
+        self.assertIsNone(image_cache.load(self.client_mock, self.cache, image_cache.CONTEXT, KEY))
+
+    def test_failed_save_is_cleaned_up(self):
+        self.image_mock.save.side_effect = docker.errors.APIError('no space left')
+
+        with mock.patch('tox.reporter.warning') as warning_mock:
+            image_cache.save(self.client_mock, self.cache, image_cache.CONTENT, KEY, self.image_mock)
+
+        warning_mock.assert_called_once()
+        self.assertEqual(os.listdir(self.cache), [])
+
+    def test_no_cache(self):
+        self.assertIsNone(image_cache.load(self.client_mock, None, image_cache.CONTENT, KEY))
+        image_cache.save(self.client_mock, None, image_cache.CONTENT, KEY, self.image_mock)
+        self.image_mock.save.assert_not_called()
+
+
+class TestRegistryCache(unittest.TestCase):
+
+    CACHE = f'{image_cache.REGISTRY_PREFIX}localhost:5000/tid'
+
+    def setUp(self):
+        self.client_mock = mock.Mock()
+
+    def test_pulled(self):
+        res = image_cache.load(self.client_mock, self.CACHE, image_cache.CONTEXT, KEY)
+
+        self.assertIs(res, self.client_mock.images.pull.return_value)
+        self.client_mock.images.pull.assert_called_once_with('localhost:5000/tid', tag=f'context-{KEY}')
+
+    def test_not_in_registry(self):
+        self.client_mock.images.pull.side_effect = docker.errors.NotFound('manifest unknown')
+
+        self.assertIsNone(image_cache.load(self.client_mock, self.CACHE, image_cache.CONTEXT, KEY))
+
+    def test_pushed(self):
+        image_mock = mock.Mock()
+        self.client_mock.api.push.return_value = iter([{'status': 'Pushed'}])
+
+        image_cache.save(self.client_mock, self.CACHE, image_cache.CONTENT, KEY, image_mock)
+
+        image_mock.tag.assert_called_once_with('localhost:5000/tid', tag=f'content-{KEY}')
+        self.client_mock.api.push.assert_called_once_with(
+            'localhost:5000/tid', tag=f'content-{KEY}', stream=True, decode=True)
+
+    def test_push_error_is_a_warning(self):
+        self.client_mock.api.push.return_value = iter([{'error': 'denied'}])
+
+        with mock.patch('tox.reporter.warning') as warning_mock:
+            image_cache.save(self.client_mock, self.CACHE, image_cache.CONTENT, KEY, mock.Mock())
+
+        self.assertIn('denied', warning_mock.call_args.args[0])
@@ -0,0 +1,51 @@
+import os
+import stat
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import tox_in_docker.main
+from tox_in_docker import locks
+
+
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        os.chmod(tmp_dir.name, 0o755)
+        self.lock_dir = os.path.join(tmp_dir.name, 'locks')
+        patch = mock.patch('tox_in_docker.locks.LOCK_DIR', self.lock_dir)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_private_dir(self):
+        with locks.file_lock('spam.lock'):
+            pass
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.lock_dir).st_mode), 0o700)
+        self.assertTrue(os.path.isfile(os.path.join(self.lock_dir, 'spam.lock')))
+
+    def test_refuses_link(self):
+        target = os.path.join(os.path.dirname(self.lock_dir), 'target')
+        os.mkdir(target, 0o700)
+        os.symlink(target, self.lock_dir)
+
+        with self.assertRaises(PermissionError):
+            locks.file_lock('spam.lock')
+        self.assertEqual(os.listdir(target), [])
+
+    def test_refuses_dir_others_may_write_to(self):
+        os.mkdir(self.lock_dir)
+        os.chmod(self.lock_dir, 0o777)
+
+        with self.assertRaises(PermissionError):
+            locks.file_lock('spam.lock')
+
+    def test_build_lock_without_lock_file(self):
+        os.mkdir(self.lock_dir)
+        os.chmod(self.lock_dir, 0o777)
+
+        with tox_in_docker.main.build_lock('python:3.11'):
+            # Still held between threads
+            self.assertTrue(tox_in_docker.main._BUILD_LOCKS['python:3.11'].locked())
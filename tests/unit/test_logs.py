@@ -0,0 +1,76 @@
+import unittest
+
+import tox_in_docker.logs
+
+
+class TestLogStream(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = []
+        self.stream = tox_in_docker.logs.LogStream(self.lines.append, tail_lines=3)
+
+    def test_lines_split_across_chunks(self):
+        self.stream.feed(tox_in_docker.logs.STDOUT, b'first li')
+        self.assertEqual(self.lines, [])
+
+        self.stream.feed(tox_in_docker.logs.STDOUT, b'ne\r\nsecond\n')
+        self.assertEqual(self.lines, ['first line', 'second'])
+
+    def test_multibyte_character_split_across_chunks(self):
+        data = 'café ✓\n'.encode()
+        for i in range(len(data)):
+            self.stream.feed(tox_in_docker.logs.STDOUT, data[i:i + 1])
+
+        self.assertEqual(self.lines, ['café ✓'])
+
+    def test_invalid_bytes_replaced(self):
+        self.stream.feed(tox_in_docker.logs.STDOUT, b'bad \xff byte\n')
+        self.assertEqual(self.lines, ['bad � byte'])
+
+    def test_streams_kept_apart(self):
+        self.stream.feed_demuxed([
+            (b'out ', None),
+            (None, b'err\n'),
+            (b'line\n', None),
+        ])
+
+        self.assertEqual(self.lines, ['err', 'out line'])
+        self.assertEqual(self.stream.tail(tox_in_docker.logs.STDERR), 'err')
+        self.assertEqual(self.stream.tail(tox_in_docker.logs.STDOUT), 'out line')
+
+    def test_tail_bounded(self):
+        self.stream.feed(tox_in_docker.logs.STDERR, b''.join(b'%d\n' % i for i in range(10)))
+
+        self.assertEqual(len(self.lines), 10)
+        self.assertEqual(self.stream.tail(), '7\n8\n9')
+
+    def test_close_flushes_partial_lines(self):
+        self.stream.feed(tox_in_docker.logs.STDERR, b'no newline')
+        self.assertEqual(self.lines, [])
+
+        self.stream.close()
+        self.assertEqual(self.lines, ['no newline'])
+        self.assertEqual(self.stream.tail(), 'no newline')
+
+
+class TestSpooledLines(unittest.TestCase):
+
+    def test_read_back_in_order(self):
+        for max_size in [16, tox_in_docker.logs.DEFAULT_SPOOL_SIZE]:
+            with self.subTest(max_size=max_size):
+                lines = tox_in_docker.logs.SpooledLines(max_size)
+                self.addCleanup(lines.close)
+                for line in ['one', '\nRunning env py39\n', 'café', '']:
+                    lines.append(line)
+
+                self.assertEqual(list(lines), ['one', '\nRunning env py39\n', 'café', ''])
+
+    def test_spooled_to_disk(self):
+        lines = tox_in_docker.logs.SpooledLines(1024)
+        self.addCleanup(lines.close)
+        for idx in range(1000):
+            lines.append(f'line {idx}')
+
+        # Past the limit, so it's no longer in memory
+        self.assertTrue(lines._file._rolled)
+        self.assertEqual(list(lines)[-1], 'line 999')
@@ -1,12 +1,17 @@
+import json
+import os
 from pathlib import Path
+import subprocess
+import tempfile
 import unittest
 import unittest.mock as mock
 
+import docker.errors
 import tox
 
 import tox_in_docker.main
 
-from .util import AnyDict, AnyInt, AnyList, AnyMock
+from .util import AnyDict, AnyList, AnyMock, AnyStr
 
 ENV_NAME = 'my_env'
 IMAGE_TAG = 'my_image:oldest'
@@ -30,6 +35,9 @@ class CommandMatcher(list):
 class Test_Launch(unittest.TestCase):
 
     def setUp(self):
+        tox_in_docker.main.close_client()
+        self.addCleanup(tox_in_docker.main.close_client)
+
         # For some reason was having difficulty with this as a decorator
         self.open_mock = mock.mock_open()
 
@@ -80,10 +88,11 @@ class Test_Launch(unittest.TestCase):
                 str(Path().absolute()): {'bind': '/testing-ro', 'mode': 'ro'}
             },
             command=['-e', AnyMock],
+            environment={},
             stream=True,
             stderr=True,
             stdout=True,
-            user=AnyInt,
+            user=AnyStr,
             remove=True,
             detach=True
         )
@@ -106,10 +115,637 @@ class Test_Launch(unittest.TestCase):
                     str(Path().absolute()): {'bind': '/testing-ro', 'mode': 'ro'}
                 },
                 command=['-e', venv_mock.envconfig.envname],
+                environment={},
                 stream=True,
                 stderr=True,
                 stdout=True,
-                user=AnyInt,
+                user=AnyStr,
                 remove=True,
                 detach=True
             )
+
+    @mock.patch('tox.reporter.verbosity', return_value=tox.reporter.Verbosity.DEBUG)
+    @mock.patch('tox.reporter.info')
+    @mock.patch('tox.reporter.verbosity1')
+    def test_messages_through_output(self, verbosity1_mock, info_mock, _verbosity_mock,
+                                     _temporary_directory_mock):
+        lines = []
+        venv_mock = mock.Mock(spec=tox.venv.VirtualEnv())
+        venv_mock.envconfig.envname = 'py311'
+
+        tox_in_docker.main.run_tests(venv_mock, image=IMAGE_TAG, output=lines.append)
+
+        # Kept with the environment's output, which may be buffered
+        self.assertIn(f'\nRunning env py311 in `{IMAGE_TAG}`!\n', lines)
+        self.assertTrue(any(line.startswith('docker run command: ') for line in lines))
+        verbosity1_mock.assert_not_called()
+        info_mock.assert_not_called()
+
+
+class TestScratch(unittest.TestCase):
+
+    def setUp(self):
+        self.client_mock = mock.Mock()
+        self.container_mock = self.client_mock.containers.run.return_value
+        self.container_mock.attach.return_value = iter([])
+        self.container_mock.wait.return_value = {'StatusCode': 0}
+        self.venv_mock = mock.Mock(spec=tox.venv.VirtualEnv())
+        self.venv_mock.envconfig.envname = ENV_NAME
+
+    def test_options(self):
+        self.assertEqual(tox_in_docker.main.get_scratch_options('bind'), {})
+        self.assertEqual(
+            tox_in_docker.main.get_scratch_options('tmpfs', '1k'),
+            {'tmpfs': {'/working_dir': 'rw,exec,mode=1777,size=1024'}})
+
+        mount, = tox_in_docker.main.get_scratch_options('volume')['mounts']
+        self.assertEqual(mount['Target'], '/working_dir')
+        self.assertEqual(mount['Type'], 'volume')
+
+        with self.assertRaises(ValueError):
+            tox_in_docker.main.get_scratch_options('ramdisk')
+
+    def test_tmpfs_only_mounts_artifacts(self):
+        with tempfile.TemporaryDirectory() as artifacts_dir:
+            def run(**kwargs):
+                # The entrypoint writes the log to the artifacts mount
+                host_dir, = [src for src, mount in kwargs['volumes'].items()
+                             if mount['bind'] == tox_in_docker.main.ARTIFACTS_MOUNT]
+                Path(host_dir, tox_in_docker.main.LOG_FILENAME).write_text('log\n')
+                return self.container_mock
+            self.client_mock.containers.run.side_effect = run
+
+            tox_in_docker.main.run_tests(
+                self.venv_mock, IMAGE_TAG, docker_client=self.client_mock, scratch='tmpfs',
+                scratch_size='1g', artifacts_dir=artifacts_dir)
+
+            kwargs = self.client_mock.containers.run.call_args.kwargs
+            self.assertNotIn('/working_dir', [mount['bind'] for mount in kwargs['volumes'].values()])
+            self.assertEqual(kwargs['tmpfs'], {'/working_dir': f'rw,exec,mode=1777,size={1024 ** 3}'})
+            self.assertEqual(
+                Path(artifacts_dir, tox_in_docker.main.LOG_FILENAME).read_text(), 'log\n')
+
+
+class TestArtifacts(unittest.TestCase):
+
+    def setUp(self):
+        self.source_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.source_dir.cleanup)
+        self.dest_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dest_dir.cleanup)
+
+        source = Path(self.source_dir.name)
+        source.joinpath('.tox').mkdir()
+        source.joinpath('.tox', '.coverage.py39').write_text('coverage')
+        source.joinpath('reports', 'html').mkdir(parents=True)
+        source.joinpath('reports', 'html', 'index.html').write_text('<html/>')
+        source.joinpath('src.py').write_text('# not an artifact')
+
+    def test_copies_matches_only(self):
+        copied = tox_in_docker.main.copy_artifacts(
+            self.source_dir.name, ['.tox/.coverage.*', 'reports/**/*.html', 'missing/*'],
+            self.dest_dir.name)
+
+        self.assertEqual(copied, ['.tox/.coverage.py39', 'reports/html/index.html'])
+        dest = Path(self.dest_dir.name)
+        self.assertEqual(dest.joinpath('.tox', '.coverage.py39').read_text(), 'coverage')
+        self.assertTrue(dest.joinpath('reports', 'html', 'index.html').is_file())
+        self.assertFalse(dest.joinpath('src.py').exists())
+
+    def test_copies_directories(self):
+        tox_in_docker.main.copy_artifacts(self.source_dir.name, ['reports'], self.dest_dir.name)
+
+        self.assertTrue(Path(self.dest_dir.name, 'reports', 'html', 'index.html').is_file())
+
+    def test_skips_matches_outside_source(self):
+        secret = Path(self.dest_dir.name, 'secret')
+        secret.mkdir()
+        secret.joinpath('key').write_text('secret')
+        Path(self.source_dir.name, 'key').symlink_to(secret / 'key')
+
+        with mock.patch('tox.reporter.warning') as warning_mock:
+            copied = tox_in_docker.main.copy_artifacts(
+                self.source_dir.name, [f'../{Path(self.dest_dir.name).name}/secret/*', 'key'],
+                os.path.join(self.dest_dir.name, 'out'))
+
+        self.assertEqual(copied, [])
+        self.assertEqual(warning_mock.call_count, 2)
+
+    def test_patterns_passed_to_entrypoint(self):
+        client_mock = mock.Mock()
+        client_mock.containers.run.return_value.attach.return_value = iter([])
+        client_mock.containers.run.return_value.wait.return_value = {'StatusCode': 0}
+        venv_mock = mock.Mock(spec=tox.venv.VirtualEnv())
+
+        tox_in_docker.main.run_tests(
+            venv_mock, IMAGE_TAG, docker_client=client_mock, scratch='volume',
+            artifacts=['.tox/.coverage.*', 'junit.xml'])
+
+        self.assertEqual(
+            client_mock.containers.run.call_args.kwargs['environment'],
+            {tox_in_docker.main.ARTIFACTS_ENV: '.tox/.coverage.*\njunit.xml'})
+
+    def test_warm_source_volume_mounts_artifacts(self):
+        source_volume = {'tid-src': {'bind': tox_in_docker.main.MOUNTED_WORKING_DIR, 'mode': 'rw'}}
+
+        options = tox_in_docker.main.get_container_options(
+            self.source_dir.name, source_volume, artifacts=['.tox/.coverage.*'])
+
+        # The host working dir would be hidden by the source volume
+        self.assertEqual(options['volumes'][self.source_dir.name],
+                         {'bind': tox_in_docker.main.ARTIFACTS_MOUNT, 'mode': 'rw'})
+        self.assertEqual(options['volumes']['tid-src'], source_volume['tid-src'])
+        self.assertEqual(options['environment'],
+                         {tox_in_docker.main.ARTIFACTS_ENV: '.tox/.coverage.*'})
+
+    def test_copied_to_project_root(self):
+        client_mock = mock.Mock()
+        client_mock.containers.run.return_value.attach.return_value = iter([])
+        client_mock.containers.run.return_value.wait.return_value = {'StatusCode': 0}
+        venv_mock = mock.Mock(spec=tox.venv.VirtualEnv())
+        venv_mock.envconfig.config.toxinidir = self.dest_dir.name
+
+        with mock.patch('tempfile.TemporaryDirectory') as temporary_directory_mock:
+            temporary_directory_mock.return_value.__enter__.return_value = self.source_dir.name
+            tox_in_docker.main.run_tests(
+                venv_mock, IMAGE_TAG, docker_client=client_mock, artifacts=['.tox/.coverage.*'])
+
+        # Not the current dir, which needn't be the project's (`tox -c`)
+        self.assertTrue(Path(self.dest_dir.name, '.tox', '.coverage.py39').is_file())
+
+
+class TestBuildTestingImage(unittest.TestCase):
+
+    def setUp(self):
+        tox_in_docker.main.clear_build_cache()
+        self.addCleanup(tox_in_docker.main.clear_build_cache)
+
+        self.client_mock = mock.Mock()
+        self.client_mock.images.get.return_value.id = 'sha256:base'
+        self.client_mock.images.get.return_value.labels = {}
+        self.built_image_mock = mock.Mock()
+        self.client_mock.images.build.return_value = (self.built_image_mock, iter([]))
+
+    def test_content_key_changes_with_base(self):
+        key = tox_in_docker.main.get_content_key('python:3.9-slim', 'sha256:base')
+
+        self.assertEqual(key, tox_in_docker.main.get_content_key('python:3.9-slim', 'sha256:base'))
+        self.assertNotEqual(key, tox_in_docker.main.get_content_key('python:3.9-slim', 'sha256:other'))
+        self.assertNotEqual(key, tox_in_docker.main.get_content_key('python:3.10-slim', 'sha256:base'))
+
+    def test_reuses_labelled_image(self):
+        existing_mock = mock.Mock(tags=[])
+        self.client_mock.images.list.return_value = [existing_mock]
+
+        res = tox_in_docker.main.build_testing_image(IMAGE_TAG, self.client_mock)
+
+        self.assertIs(res, existing_mock)
+        self.client_mock.images.build.assert_not_called()
+        existing_mock.tag.assert_called_once_with(AnyStr)
+
+    def test_base_is_testing_image(self):
+        base_mock = self.client_mock.images.get.return_value
+        base_mock.labels = {tox_in_docker.main.CONTENT_KEY_LABEL: 'key'}
+
+        res = tox_in_docker.main.build_testing_image(IMAGE_TAG, self.client_mock)
+
+        self.assertIs(res, base_mock)
+        self.client_mock.images.build.assert_not_called()
+        # Found from its labels alone
+        self.client_mock.containers.run.assert_not_called()
+        self.client_mock.containers.create.assert_not_called()
+
+    def test_builds_on_miss(self):
+        self.client_mock.images.list.return_value = []
+
+        res = tox_in_docker.main.build_testing_image(IMAGE_TAG, self.client_mock)
+
+        self.assertIs(res, self.built_image_mock)
+        key = tox_in_docker.main.get_content_key(IMAGE_TAG, 'sha256:base')
+        self.client_mock.images.list.assert_called_once_with(
+            filters={'label': f'{tox_in_docker.main.CONTENT_KEY_LABEL}={key}'})
+        self.client_mock.images.build.assert_called_once_with(
+            path=AnyStr,
+            labels={tox_in_docker.main.CONTENT_KEY_LABEL: key},
+            tag=AnyStr)
+
+    @mock.patch('tox_in_docker.image_cache.load')
+    @mock.patch('tox_in_docker.image_cache.save')
+    def test_image_cache(self, save_mock, load_mock):
+        self.client_mock.images.list.return_value = []
+        key = tox_in_docker.main.get_content_key(IMAGE_TAG, 'sha256:base')
+
+        with self.subTest('miss'):
+            load_mock.return_value = None
+            res = tox_in_docker.main.build_testing_image(IMAGE_TAG, self.client_mock, image_cache='/cache')
+
+            self.assertIs(res, self.built_image_mock)
+            load_mock.assert_called_once_with(self.client_mock, '/cache', 'content', key)
+            save_mock.assert_called_once_with(self.client_mock, '/cache', 'content', key, res)
+
+        tox_in_docker.main.clear_build_cache()
+        self.client_mock.images.build.reset_mock()
+        save_mock.reset_mock()
+
+        with self.subTest('hit'):
+            load_mock.return_value = cached_mock = mock.Mock(tags=[])
+            res = tox_in_docker.main.build_testing_image(IMAGE_TAG, self.client_mock, image_cache='/cache')
+
+            self.assertIs(res, cached_mock)
+            self.client_mock.images.build.assert_not_called()
+            save_mock.assert_not_called()
+
+    def test_built_once_per_process(self):
+        self.client_mock.images.list.return_value = []
+
+        first = tox_in_docker.main.build_testing_image(IMAGE_TAG, self.client_mock)
+        second = tox_in_docker.main.build_testing_image(IMAGE_TAG, self.client_mock)
+
+        self.assertIs(first, second)
+        self.client_mock.images.build.assert_called_once()
+
+    @mock.patch('subprocess.run')
+    def test_builds_with_buildkit(self, run_mock):
+        self.client_mock.images.list.return_value = []
+
+        res = tox_in_docker.main.build_testing_image(IMAGE_TAG, self.client_mock, buildkit=True)
+
+        self.assertIs(res, self.client_mock.images.get.return_value)
+        self.client_mock.images.build.assert_not_called()
+        command = run_mock.call_args.args[0]
+        key = tox_in_docker.main.get_content_key(IMAGE_TAG, 'sha256:base', buildkit=True)
+        self.assertEqual(command[:2], ['docker', 'build'])
+        self.assertIn(f'{tox_in_docker.main.CONTENT_KEY_LABEL}={key}', command)
+        self.assertEqual(run_mock.call_args.kwargs['env']['DOCKER_BUILDKIT'], '1')
+
+    @mock.patch('subprocess.run')
+    def test_buildkit_failure(self, run_mock):
+        run_mock.side_effect = subprocess.CalledProcessError(1, ['docker'], stderr='no space left')
+
+        with self.assertRaises(docker.errors.BuildError):
+            tox_in_docker.main.build_with_buildkit(self.client_mock, '/build', 'spam:latest')
+
+    def test_pulls_missing_base(self):
+        self.client_mock.images.get.side_effect = docker.errors.ImageNotFound('nope')
+        self.client_mock.images.pull.return_value.id = 'sha256:pulled'
+        self.client_mock.images.pull.return_value.labels = {}
+        self.client_mock.images.list.return_value = []
+
+        tox_in_docker.main.build_testing_image(IMAGE_TAG, self.client_mock)
+
+        self.client_mock.images.pull.assert_called_once_with(IMAGE_TAG)
+        key = tox_in_docker.main.get_content_key(IMAGE_TAG, 'sha256:pulled')
+        self.client_mock.images.build.assert_called_once_with(
+            path=AnyStr,
+            labels={tox_in_docker.main.CONTENT_KEY_LABEL: key},
+            tag=AnyStr)
+
+
+class TestBuildContext(unittest.TestCase):
+
+    def setUp(self):
+        self.context_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.context_dir.cleanup)
+        self.context = Path(self.context_dir.name)
+        self.context.joinpath('Dockerfile').write_text('FROM python:3.9-slim\n')
+        self.context.joinpath('.dockerignore').write_text('# build output\nbuild\n')
+        self.context.joinpath('build').mkdir()
+
+        self.client_mock = mock.Mock()
+        self.built_image_mock = mock.Mock()
+        self.client_mock.images.build.return_value = (self.built_image_mock, iter([]))
+
+    def _key(self, buildargs=None):
+        return tox_in_docker.main.get_context_key(self.context_dir.name, buildargs)
+
+    def test_key_follows_context(self):
+        key = self._key()
+
+        self.context.joinpath('build', 'output').write_text('ignored')
+        self.assertEqual(key, self._key())
+
+        self.assertNotEqual(key, self._key({'BASE': 'python:3.10-slim'}))
+
+        self.context.joinpath('Dockerfile').write_text('FROM python:3.10-slim\n')
+        self.assertNotEqual(key, self._key())
+
+    def test_reuses_labelled_image(self):
+        existing_mock = mock.Mock(tags=['spam:latest'])
+        self.client_mock.images.list.return_value = [existing_mock]
+
+        res = tox_in_docker.main.build_context(self.client_mock, self.context_dir.name, 'spam:latest')
+
+        self.assertIs(res, existing_mock)
+        self.client_mock.images.list.assert_called_once_with(
+            filters={'label': f'{tox_in_docker.main.CONTEXT_KEY_LABEL}={self._key()}'})
+        self.client_mock.images.build.assert_not_called()
+        existing_mock.tag.assert_not_called()
+
+    def test_builds_on_miss(self):
+        self.client_mock.images.list.return_value = []
+
+        res = tox_in_docker.main.build_context(
+            self.client_mock, self.context_dir.name, 'spam:latest', {'BASE': 'python:3.9-slim'})
+
+        self.assertIs(res, self.built_image_mock)
+        self.client_mock.images.build.assert_called_once_with(
+            buildargs={'BASE': 'python:3.9-slim'},
+            path=self.context_dir.name,
+            labels={tox_in_docker.main.CONTEXT_KEY_LABEL: self._key({'BASE': 'python:3.9-slim'})},
+            tag='spam:latest')
+
+
+class TestSharedContainer(unittest.TestCase):
+
+    def setUp(self):
+        self.client_mock = mock.Mock()
+        self.container_mock = self.client_mock.containers.run.return_value
+        self.container_mock.logs.return_value = iter(
+            [b'syncing\n', tox_in_docker.main.READY_MARKER.encode(), b'\n'])
+        self.client_mock.api.exec_create.return_value = {'Id': 'exec-id'}
+        self.client_mock.api.exec_start.return_value = iter(
+            [(b'tox output\n', None), (None, b'tox err'), (None, b'or\n')])
+
+        self.shared = tox_in_docker.main.SharedContainer(IMAGE_TAG, self.client_mock)
+        self.addCleanup(self.shared.close)
+
+    def test_started_once(self):
+        self.client_mock.api.exec_inspect.return_value = {'ExitCode': 0}
+
+        self.shared.run_env('py39')
+        self.shared.run_env('py310')
+
+        self.client_mock.containers.run.assert_called_once_with(
+            image=IMAGE_TAG,
+            volumes=AnyDict,
+            command=[tox_in_docker.main.IDLE_ARG, str(tox_in_docker.main.DEFAULT_IDLE_TTL)],
+            environment={},
+            labels={
+                tox_in_docker.main.PROJECT_LABEL: AnyStr,
+                tox_in_docker.main.ENV_LABEL: tox_in_docker.main.SHARED_ENV,
+            },
+            user=AnyStr,
+            auto_remove=True,
+            detach=True)
+        self.client_mock.api.exec_create.assert_called_with(
+            self.container_mock.id,
+            [tox_in_docker.main.IMAGE_ENTRYPOINT_PATH, tox_in_docker.main.EXEC_ARG, '-e', 'py310'],
+            user=AnyStr,
+            environment={})
+
+    def test_failed_env_raises(self):
+        self.client_mock.api.exec_inspect.return_value = {'ExitCode': 2}
+
+        with self.assertRaises(docker.errors.ContainerError) as ctx:
+            self.shared.run_env('py39')
+
+        self.assertEqual(ctx.exception.exit_status, 2)
+        self.assertEqual(ctx.exception.stderr, b'tox error')
+
+    def test_container_exits_before_ready(self):
+        self.container_mock.logs.side_effect = [iter([b'oh no\n']), b'error']
+        self.container_mock.wait.return_value = {'StatusCode': 1}
+
+        with self.assertRaises(docker.errors.ContainerError):
+            self.shared.start()
+
+        self.container_mock.remove.assert_called_once_with(force=True)
+        self.assertIsNone(self.shared.container)
+
+    def test_restarted_after_failed_start(self):
+        self.container_mock.logs.side_effect = [
+            iter([b'oh no\n']), iter([tox_in_docker.main.READY_MARKER.encode(), b'\n'])]
+        self.container_mock.wait.return_value = {'StatusCode': 1}
+        self.client_mock.api.exec_inspect.return_value = {'ExitCode': 0}
+
+        with self.assertRaises(docker.errors.ContainerError):
+            self.shared.run_env('py39')
+        self.shared.run_env('py310')
+
+        self.assertEqual(self.client_mock.containers.run.call_count, 2)
+        self.client_mock.api.exec_create.assert_called_once()
+
+    def test_removed_itself_before_ready(self):
+        self.container_mock.logs.side_effect = [iter([b'oh no\n']), b'error']
+        self.container_mock.wait.side_effect = docker.errors.NotFound('gone')
+        self.container_mock.remove.side_effect = docker.errors.NotFound('gone')
+
+        with self.assertRaises(docker.errors.ContainerError) as ctx:
+            self.shared.start()
+
+        self.assertEqual(ctx.exception.exit_status, -1)
+        self.assertIsNone(self.shared.container)
+
+    def test_close_removes_container(self):
+        self.shared.start()
+        self.shared.close()
+
+        self.container_mock.remove.assert_called_once_with(force=True)
+
+
+class TestPipCache(unittest.TestCase):
+
+    def setUp(self):
+        tox_in_docker.main._WHEEL_TAGS.clear()
+        self.addCleanup(tox_in_docker.main._WHEEL_TAGS.clear)
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.tags_path = os.path.join(cache_dir.name, 'tox-in-docker', 'wheel-tags.json')
+        patch = mock.patch('tox_in_docker.main.WHEEL_TAGS_PATH', self.tags_path)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.client_mock = mock.Mock()
+        self.client_mock.containers.run.return_value = b'cp311-cp311-manylinux_2_36_x86_64\n'
+
+    def _image(self, env):
+        return mock.Mock(id='sha256:0123456789abcdef', attrs={
+            'Config': {'Env': env}, 'Os': 'linux', 'Architecture': 'arm64', 'Variant': 'v8'})
+
+    def test_key(self):
+        for env, expected in [
+                (['PATH=/usr/bin', 'PYTHON_VERSION=3.11.4'],
+                 'cpython-3.11-cp311-manylinux_2_36_x86_64'),
+                (['PYPY_VERSION=7.3.12', 'PYTHON_VERSION=3.9'],
+                 'pypy-7.3-cp311-manylinux_2_36_x86_64'),
+                (['PATH=/usr/bin'], '0123456789ab')]:
+            with self.subTest(env=env):
+                self.assertEqual(
+                    tox_in_docker.main.get_pip_cache_key(self._image(env), self.client_mock),
+                    expected)
+
+    def test_key_by_platform(self):
+        # e.g. alpine images, which can't use wheels built against glibc
+        self.client_mock.containers.run.return_value = b'cp311-cp311-musllinux_1_2_x86_64\n'
+        image = self._image(['PYTHON_VERSION=3.11.4'])
+
+        self.assertEqual(tox_in_docker.main.get_pip_cache_key(image, self.client_mock),
+                         'cpython-3.11-cp311-musllinux_1_2_x86_64')
+        # Only looked up once per image
+        tox_in_docker.main.get_pip_cache_key(image, self.client_mock)
+        self.client_mock.containers.run.assert_called_once()
+
+    def test_tag_kept_between_runs(self):
+        image = self._image(['PYTHON_VERSION=3.11.4'])
+        tox_in_docker.main.get_pip_cache_key(image, self.client_mock)
+
+        # As in a later tox run
+        tox_in_docker.main._WHEEL_TAGS.clear()
+        self.client_mock.containers.run.reset_mock()
+
+        self.assertEqual(tox_in_docker.main.get_pip_cache_key(image, self.client_mock),
+                         'cpython-3.11-cp311-manylinux_2_36_x86_64')
+        self.client_mock.containers.run.assert_not_called()
+
+    def test_saved_tags_limited(self):
+        with mock.patch('tox_in_docker.main.WHEEL_TAGS_LIMIT', 2):
+            for image_id in ['sha256:a', 'sha256:b', 'sha256:c']:
+                tox_in_docker.main.get_wheel_tag(mock.Mock(id=image_id), self.client_mock)
+
+        with open(self.tags_path) as tags_file:
+            self.assertEqual(list(json.load(tags_file)), ['sha256:b', 'sha256:c'])
+
+    def test_key_without_pip(self):
+        self.client_mock.containers.run.side_effect = docker.errors.ContainerError(
+            'c0ffee', 1, 'python', 'spam', b'No module named pip')
+
+        self.assertEqual(
+            tox_in_docker.main.get_pip_cache_key(self._image(['PYTHON_VERSION=3.11.4']),
+                                                 self.client_mock),
+            'cpython-3.11-linux-arm64-v8')
+
+    def test_volume(self):
+        self.client_mock.images.get.return_value = self._image(['PYTHON_VERSION=3.11.4'])
+
+        res = tox_in_docker.main.get_pip_cache_volumes('sha256:abc', 'volume', self.client_mock)
+
+        self.assertEqual(res, {'tox-in-docker-pip-cpython-3.11-cp311-manylinux_2_36_x86_64': {
+            'bind': '/pip-cache', 'mode': 'rw'}})
+
+    def test_host_dir(self):
+        self.client_mock.images.get.return_value = self._image(['PYTHON_VERSION=3.11.4'])
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            res = tox_in_docker.main.get_pip_cache_volumes('sha256:abc', cache_dir,
+                                                           self.client_mock)
+
+            source = os.path.join(cache_dir, 'cpython-3.11-cp311-manylinux_2_36_x86_64')
+            self.assertTrue(os.path.isdir(source))
+        self.assertEqual(res, {source: {'bind': '/pip-cache', 'mode': 'rw'}})
+
+    def test_environment(self):
+        self.assertEqual(tox_in_docker.main.get_pip_cache_environment(),
+                         {'PIP_CACHE_DIR': '/pip-cache'})
+        self.assertEqual(tox_in_docker.main.get_pip_cache_environment('2m'),
+                         {'PIP_CACHE_DIR': '/pip-cache', 'TID_PIP_CACHE_MAX_KB': '2048'})
+
+
+class TestEnvdirVolumes(unittest.TestCase):
+
+    @mock.patch('os.getcwd', return_value='/src/my project')
+    def test_volume_per_env_and_image(self, getcwd_mock):
+        client_mock = mock.Mock()
+        stale_mock = mock.Mock()
+        stale_mock.name = 'stale'
+        client_mock.volumes.list.return_value = [stale_mock]
+
+        res = tox_in_docker.main.get_envdir_volumes('sha256:0123456789abcdef', client_mock, 'py39')
+
+        project = tox_in_docker.main.get_project_key()
+        self.assertTrue(project.startswith('my project-'))
+        name = f'tox-in-docker-envdir-my-project-{project.split("-")[-1]}-py39-0123456789ab'
+        self.assertEqual(res, {name: {'bind': '/working_dir/.tox', 'mode': 'rw'}})
+        client_mock.volumes.create.assert_called_once_with(
+            name=name,
+            labels={tox_in_docker.main.PROJECT_LABEL: project, tox_in_docker.main.ENV_LABEL: 'py39'})
+        stale_mock.remove.assert_called_once_with()
+
+    def test_volume_in_use_is_kept(self):
+        client_mock = mock.Mock()
+        in_use_mock = mock.Mock()
+        in_use_mock.remove.side_effect = docker.errors.APIError('in use')
+        client_mock.volumes.list.return_value = [in_use_mock]
+
+        res = tox_in_docker.main.get_envdir_volumes('sha256:0123456789abcdef', client_mock)
+
+        self.assertEqual(len(res), 1)
+        self.assertIn('-shared-', next(iter(res)))
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_commit_removes_stale_snapshots(self):
+        client_mock = mock.Mock()
+        container_mock = mock.Mock()
+        container_mock.commit.return_value.id = 'sha256:new'
+        client_mock.images.list.return_value = [mock.Mock(id='sha256:new'), mock.Mock(id='sha256:old')]
+
+        res = tox_in_docker.main.commit_snapshot(client_mock, container_mock, 'key', 'py39')
+
+        self.assertIs(res, container_mock.commit.return_value)
+        labels = container_mock.commit.call_args.kwargs['conf']['Labels']
+        self.assertEqual(labels[tox_in_docker.main.SNAPSHOT_KEY_LABEL], 'key')
+        self.assertEqual(labels[tox_in_docker.main.ENV_LABEL], 'py39')
+        # A snapshot mustn't be mistaken for the testing image it was run in
+        self.assertEqual(labels[tox_in_docker.main.CONTENT_KEY_LABEL], '')
+        client_mock.images.remove.assert_called_once_with('sha256:old')
+
+    def test_key(self):
+        key = tox_in_docker.main.get_snapshot_key('sha256:abc', 'py39', ['numpy'])
+
+        self.assertNotEqual(key, tox_in_docker.main.get_snapshot_key('sha256:def', 'py39', ['numpy']))
+        self.assertNotEqual(key, tox_in_docker.main.get_snapshot_key('sha256:abc', 'py39', ['scipy']))
+
+
+class TestSourceVolumes(unittest.TestCase):
+
+    def test_replaces_working_dir(self):
+        client_mock = mock.Mock()
+
+        source = tox_in_docker.main.get_source_volumes(client_mock, 'py39')
+        volumes = tox_in_docker.main._get_volumes('/tmp/working', source)
+
+        self.assertNotIn('/tmp/working', volumes)
+        name, = source
+        self.assertTrue(name.startswith('tox-in-docker-src-'))
+        self.assertTrue(name.endswith('-py39'))
+        self.assertEqual(volumes[name], {'bind': '/working_dir', 'mode': 'rw'})
+        client_mock.volumes.create.assert_called_once_with(name=name, labels=AnyDict)
+
+    def test_working_dir_kept_otherwise(self):
+        volumes = tox_in_docker.main._get_volumes('/tmp/working', {'vol': {'bind': '/elsewhere', 'mode': 'rw'}})
+
+        self.assertEqual(volumes['/tmp/working'], {'bind': '/working_dir', 'mode': 'rw'})
+        self.assertIn('vol', volumes)
+
+
+class TestRenderDockerfile(unittest.TestCase):
+
+    def test_entrypoint_copied_last(self):
+        for buildkit in [False, True]:
+            with self.subTest(buildkit=buildkit):
+                dockerfile = tox_in_docker.main.render_dockerfile('python:3.9-slim', buildkit)
+                lines = [line for line in dockerfile.splitlines() if line and not line.startswith('#')]
+
+                self.assertEqual(lines[0], 'FROM python:3.9-slim AS tooling')
+                instructions = [line.split()[0] for line in lines if not line.startswith(' ')]
+                # Nothing but metadata after the entrypoint
+                after_copy = instructions[instructions.index('COPY') + 1:]
+                self.assertEqual(after_copy, ['WORKDIR', 'ENTRYPOINT'])
+
+    @mock.patch('os.getgid', return_value=2000)
+    @mock.patch('os.getuid', return_value=1000)
+    def test_user_agnostic(self, _getuid, _getgid):
+        dockerfile = tox_in_docker.main.render_dockerfile('python:3.9-slim')
+
+        # The same image serves every user, who is only known at run time
+        self.assertNotIn('1000', dockerfile)
+        self.assertNotIn('useradd', dockerfile)
+        self.assertEqual(tox_in_docker.main.get_user(), '1000:2000')
+
+    def test_cache_mounts_only_with_buildkit(self):
+        self.assertNotIn('--mount', tox_in_docker.main.render_dockerfile('python:3.9-slim'))
+
+        dockerfile = tox_in_docker.main.render_dockerfile('python:3.9-slim', buildkit=True)
+        self.assertTrue(dockerfile.startswith('# syntax=docker/dockerfile:1\n'))
+        self.assertIn('--mount=type=cache,target=/var/cache/apt', dockerfile)
+        self.assertIn('--mount=type=cache,target=/root/.cache/pip', dockerfile)
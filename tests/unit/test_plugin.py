@@ -1,14 +1,18 @@
 import collections
 import functools
+import json
+import pathlib
+import tempfile
 import unittest
 from unittest import mock
 
 import docker
 import tox
+import tox.exception
 
-from tox_in_docker import main, plugin
+from tox_in_docker import main, plugin, pool, resources, shards
 
-from .util import AnyStr
+from .util import AnyMock, AnyStr
 
 
 def _get_mocks(count:int) -> list:
@@ -53,6 +57,9 @@ class TestCase(unittest.TestCase):
         return properties
 
     def setUp(self) -> None:
+        main.close_client()
+        self.addCleanup(main.close_client)
+
         self.config_mock = mock.Mock(spec=tox.config.Config(*_get_mocks(5)))
         self.envconfig_mock = mock.Mock(
             spec=tox.config.TestenvConfig('py', self.config_mock, *_get_mocks(2)))
@@ -66,6 +73,16 @@ class TestCase(unittest.TestCase):
 
         # Pre configure some values
         self._set_build_dir(None)
+        self.config_mock.option.configure_mock(
+            docker_batch=None, docker_workers=None, docker_async=None, docker_pool_size=None,
+            docker_buildkit=None, docker_warm_pool=None, docker_warm_pool_ttl=None,
+            docker_timings_json=None, docker_prepare=False, docker_image_cache=None)
+        self.envconfig_mock.configure_mock(docker_pip_cache=None, docker_reuse_envdir=False,
+            docker_sync=None, docker_snapshot=False, docker_scratch=None, docker_scratch_size=None,
+            envlogdir='/tox/py/log', docker_artifacts=[], docker_shards=None, docker_cpus=None,
+            docker_cpuset=None, docker_memory=None, docker_shm_size=None, docker_ulimits=[],
+            install_command=['python', '-m', 'pip', 'install', '{opts}', '{packages}'],
+            setenv=mock.Mock(definitions={}))
 
 
     def _set_build_dir(self, build_dir: str) -> None:
@@ -108,8 +125,9 @@ class TestRuntestPre(TestCase):
     @mock.patch('tox_in_docker.util.get_default_image')
     @mock.patch('tox_in_docker.main.build_testing_image',
                 spec=main.build_testing_image)
+    @mock.patch('tox_in_docker.main.get_context_key', return_value='context-key')
     def test_build_from_build_dir(
-        self, build_image_mock: mock.Mock, get_image_mock:mock.Mock,
+        self, get_context_key_mock, build_image_mock: mock.Mock, get_image_mock:mock.Mock,
         get_hostname_mock, getcwd_mock) -> None:
 
         build_dir = '/test/dir/please/ignore'
@@ -122,10 +140,14 @@ class TestRuntestPre(TestCase):
         self.envconfig_mock.docker_image = None
 
 
+        self.client_mock.images.list.return_value = []
+
         plugin.tox_runtest_pre(self.venv_mock)
+        get_context_key_mock.assert_called_once_with(build_dir, {'BASE': get_image_mock.return_value})
         self.build_mock.assert_called_once_with(
             buildargs={'BASE': get_image_mock.return_value},
             path=build_dir,
+            labels={main.CONTEXT_KEY_LABEL: 'context-key'},
             tag=f'tid-{get_hostname_mock.return_value.lower()}-{cwd}:latest'
         )
 
@@ -134,35 +156,699 @@ class TestRuntestPre(TestCase):
 
 
 
-class TestDocker(TestCase):
+class TestRuntestBatch(TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        do_run_in_docker_patch = mock.patch('tox_in_docker.plugin.do_run_in_docker', return_value=True)
+        do_run_in_docker_patch.start()
+        self.addCleanup(do_run_in_docker_patch.stop)
+
+        shared_patch = mock.patch('tox_in_docker.main.SharedContainer', spec=main.SharedContainer)
+        self.shared_mock = shared_patch.start()
+        self.addCleanup(shared_patch.stop)
+
+        run_tests_patch = mock.patch('tox_in_docker.main.run_tests')
+        self.run_tests_mock = run_tests_patch.start()
+        self.addCleanup(run_tests_patch.stop)
+
+        client_constructor_patch = mock.patch('docker.client.from_env')
+        client_constructor_patch.start()
+        self.addCleanup(client_constructor_patch.stop)
+
+        self.addCleanup(plugin.tox_cleanup, None)
+
+        self.config_mock.option.docker_batch = True
+        self.envconfig_mock.docker_image = 'sha256:shared'
+
+    def test_envs_share_container(self) -> None:
+        for envname in ['py39', 'py39-extra']:
+            self.envconfig_mock.envname = envname
+            self.assertTrue(plugin.tox_runtest(self.venv_mock, False))
+
+        self.shared_mock.assert_called_once_with(
+            'sha256:shared', AnyMock, ttl=main.DEFAULT_IDLE_TTL, extra_volumes={}, environment={})
+        self.shared_mock.return_value.run_env.assert_has_calls(
+            [mock.call('py39', timings=mock.ANY), mock.call('py39-extra', timings=mock.ANY)])
+        self.run_tests_mock.assert_not_called()
+
+        plugin.tox_cleanup(None)
+        self.shared_mock.return_value.close.assert_called_once_with()
+
+    def test_failure_is_per_env(self) -> None:
+        self.envconfig_mock.envname = 'py39'
+        self.shared_mock.return_value.run_env.side_effect = docker.errors.ContainerError(
+            mock.Mock(), 1, ['-e', 'py39'], 'sha256:shared', b'nope')
+
+        self.assertFalse(plugin.tox_runtest(self.venv_mock, False))
+        self.assertEqual(self.venv_mock.status, 'commands failed')
+        self.shared_mock.return_value.close.assert_not_called()
+
+
+class TestRuntestSnapshot(TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        do_run_in_docker_patch = mock.patch('tox_in_docker.plugin.do_run_in_docker', return_value=True)
+        do_run_in_docker_patch.start()
+        self.addCleanup(do_run_in_docker_patch.stop)
+
+        run_tests_patch = mock.patch('tox_in_docker.main.run_tests')
+        self.run_tests_mock = run_tests_patch.start()
+        self.addCleanup(run_tests_patch.stop)
+
+        commit_patch = mock.patch('tox_in_docker.main.commit_snapshot')
+        self.commit_mock = commit_patch.start()
+        self.addCleanup(commit_patch.stop)
+
+        client_constructor_patch = mock.patch('docker.client.from_env')
+        self.client_mock = client_constructor_patch.start().return_value
+        self.addCleanup(client_constructor_patch.stop)
+
+        self.envconfig_mock.configure_mock(
+            docker_snapshot=True, docker_image='sha256:image', envname='py39', deps=['numpy'],
+            extras=[], basepython='python3.9')
+        self.run_options = {'environment': {main.WORKDIR_ENV: main.SNAPSHOT_WORKDIR}}
+        self.key = main.get_snapshot_key(
+            'sha256:image', 'py39', plugin.get_snapshot_setup(self.venv_mock, self.run_options))
+        self.commit_mock.return_value.id = 'sha256:snapshot'
+
+    def test_snapshot_taken(self) -> None:
+        self.client_mock.images.list.return_value = []
+        setup_container, run_container = mock.Mock(), mock.Mock()
+        self.run_tests_mock.side_effect = [setup_container, run_container]
+
+        self.assertTrue(plugin.tox_runtest(self.venv_mock, False))
+
+        # Set up without running the commands, so they can't change the snapshot
+        setup, run = self.run_tests_mock.call_args_list
+        self.assertEqual(setup, mock.call(
+            self.venv_mock, 'sha256:image', docker_client=self.client_mock, remove_container=False,
+            output=None, timings=mock.ANY, tox_args=['--notest'], scratch=main.SCRATCH_BIND,
+            scratch_size=None, artifacts_dir='/tox/py/log', artifacts=None,
+            limits=resources.Limits(ulimits=[]), extra_volumes={},
+            environment={main.WORKDIR_ENV: main.SNAPSHOT_WORKDIR}))
+        self.commit_mock.assert_called_once_with(
+            self.client_mock, setup_container, self.key, 'py39')
+        self.assertEqual(run, mock.call(
+            self.venv_mock, 'sha256:snapshot', docker_client=self.client_mock,
+            remove_container=False, output=None, timings=mock.ANY, scratch=main.SCRATCH_BIND,
+            scratch_size=None, artifacts_dir='/tox/py/log', artifacts=[],
+            limits=resources.Limits(ulimits=[]), extra_volumes={},
+            environment={main.WORKDIR_ENV: main.SNAPSHOT_WORKDIR}))
+        setup_container.remove.assert_called_once_with(v=True)
+        run_container.remove.assert_called_once_with(v=True)
+
+    def test_not_taken_if_setup_failed(self) -> None:
+        self.client_mock.images.list.return_value = []
+        self.run_tests_mock.side_effect = docker.errors.ContainerError(
+            mock.Mock(), 1, ['-e', 'py39'], 'sha256:image', b'no numpy for you')
+
+        self.assertFalse(plugin.tox_runtest(self.venv_mock, False))
+        self.commit_mock.assert_not_called()
+        self.run_tests_mock.assert_called_once()
+
+    def test_failed_setup_removed_once(self) -> None:
+        self.client_mock.images.list.return_value = []
+        setup_container = mock.Mock()
+        setup_container.remove.side_effect = [None, docker.errors.NotFound('no such container')]
+        self.run_tests_mock.side_effect = docker.errors.ContainerError(
+            setup_container, 1, ['-e', 'py39'], 'sha256:image', b'no numpy for you')
+
+        # Fails the env, rather than tox
+        self.assertFalse(plugin.tox_runtest(self.venv_mock, False))
+        self.assertEqual(self.venv_mock.status, 'commands failed')
+        setup_container.remove.assert_called_once_with(v=True)
+
+    def test_failed_commit_only_warns(self) -> None:
+        self.client_mock.images.list.return_value = []
+        self.commit_mock.side_effect = docker.errors.APIError('disk full')
+
+        with mock.patch('tox.reporter.warning') as warning_mock:
+            self.assertTrue(plugin.tox_runtest(self.venv_mock, False))
+
+        warning_mock.assert_called_once()
+        self.assertEqual(self.run_tests_mock.call_args.args[1], 'sha256:image')
+
+    def test_started_from_snapshot(self) -> None:
+        self.client_mock.images.list.return_value = [mock.Mock(id='sha256:snapshot')]
+
+        self.assertTrue(plugin.tox_runtest(self.venv_mock, False))
+
+        self.client_mock.images.list.assert_called_once_with(
+            filters={'label': f'{main.SNAPSHOT_KEY_LABEL}={self.key}'})
+        self.run_tests_mock.assert_called_once()
+        self.assertEqual(self.run_tests_mock.call_args.args[1], 'sha256:snapshot')
+        self.commit_mock.assert_not_called()
+
+    def test_key_follows_install_options(self) -> None:
+        setup = plugin.get_snapshot_setup(self.venv_mock, self.run_options)
+
+        # A new hash seed every run doesn't make a new snapshot
+        self.envconfig_mock.setenv.definitions = {'PYTHONHASHSEED': '1234'}
+        self.assertEqual(setup, plugin.get_snapshot_setup(self.venv_mock, self.run_options))
+
+        for name, value in [
+                ('install_command', ['pip', 'install', '--pre', '{packages}']),
+                ('setenv', mock.Mock(definitions={'PIP_INDEX_URL': 'https://pypi.example'}))]:
+            with self.subTest(name):
+                with mock.patch.object(self.envconfig_mock, name, value):
+                    self.assertNotEqual(
+                        setup, plugin.get_snapshot_setup(self.venv_mock, self.run_options))
+
+        with self.subTest('run options'):
+            self.assertNotEqual(setup, plugin.get_snapshot_setup(self.venv_mock, {'environment': {
+                **self.run_options['environment'], 'PIP_CACHE_DIR': main.PIP_CACHE_MOUNT}}))
+
+    def test_key_follows_requirements(self) -> None:
+        with tempfile.TemporaryDirectory() as toxinidir:
+            self.config_mock.toxinidir = toxinidir
+            self.envconfig_mock.deps = ['-r requirements.txt']
+            requirements = pathlib.Path(toxinidir, 'requirements.txt')
+
+            requirements.write_text('numpy==1.0\n')
+            setup = plugin.get_snapshot_setup(self.venv_mock)
+            requirements.write_text('numpy==2.0\n')
+
+            self.assertNotEqual(setup, plugin.get_snapshot_setup(self.venv_mock))
+
+
+class TestRuntestShards(TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        do_run_in_docker_patch = mock.patch('tox_in_docker.plugin.do_run_in_docker', return_value=True)
+        do_run_in_docker_patch.start()
+        self.addCleanup(do_run_in_docker_patch.stop)
+
+        run_tests_patch = mock.patch('tox_in_docker.main.run_tests', side_effect=self._run_tests)
+        self.run_tests_mock = run_tests_patch.start()
+        self.addCleanup(run_tests_patch.stop)
+
+        commit_patch = mock.patch('tox_in_docker.main.commit_snapshot')
+        self.commit_mock = commit_patch.start()
+        self.commit_mock.return_value.id = 'sha256:snapshot'
+        self.addCleanup(commit_patch.stop)
+
+        client_constructor_patch = mock.patch('docker.client.from_env')
+        self.client_mock = client_constructor_patch.start().return_value
+        self.client_mock.images.list.return_value = []
+        self.addCleanup(client_constructor_patch.stop)
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.envlogdir = pathlib.Path(tmp_dir.name, 'log')
 
-    @mock.patch('tox_in_docker.main.build_testing_image')
-    def test_ensure_installed(self, build_image_mock) -> None:
-        try:
-            mock_client = mock.Mock(spec=docker.client.DockerClient())
+        self.envconfig_mock.configure_mock(
+            docker_shards='2', docker_image='sha256:image', envname='py39', deps=[], extras=[],
+            basepython='python3.9', envlogdir=self.envlogdir, docker_snapshot=False)
+        self.envconfig_mock._reader.getstring.return_value = 'pytest {posargs:tests}'
+        self.config_mock.toxinidir = tmp_dir.name
+        self.config_mock.option.args = ['tests/test_a.py', 'tests/test_b.py', 'tests/test_c.py']
+        self.failing = None
 
-        # if docker isn't running/available, this will occur
-        except docker.errors.DockerException:
-            # ToDo spec this when cannot connect to docker server
-            mock_client = mock.Mock()
+    def _run_tests(self, venv, image, output, environment, tox_args=None, **kwargs):
+        posargs = environment.get(main.POSARGS_ENV)
+        output(f'ran {posargs}')
+        if posargs is not None and posargs == self.failing:
+            raise docker.errors.ContainerError(mock.Mock(), 1, [], image, b'')
+        return mock.Mock()
+
+    def test_set_up_once_then_split(self) -> None:
+        self.assertTrue(plugin.tox_runtest(self.venv_mock, False))
+
+        setup, *shard_runs = self.run_tests_mock.call_args_list
+        self.assertEqual(setup.args[1], 'sha256:image')
+        self.assertEqual(setup.kwargs['tox_args'], ['--notest'])
+        self.assertEqual(setup.kwargs['environment'], {main.WORKDIR_ENV: main.SNAPSHOT_WORKDIR})
+
+        self.assertEqual(len(shard_runs), 2)
+        posargs = []
+        for run in shard_runs:
+            self.assertEqual(run.args[1], 'sha256:snapshot')
+            posargs.extend(run.kwargs['environment'][main.POSARGS_ENV].split('\n'))
+        self.assertCountEqual(posargs, self.config_mock.option.args)
+
+        durations = json.loads(self.envlogdir.joinpath(shards.DURATIONS_FILENAME).read_text())
+        self.assertCountEqual(durations, self.config_mock.option.args)
+
+        # Only taken for the shards
+        self.client_mock.images.remove.assert_called_once_with('sha256:snapshot')
+
+    def test_artifacts_per_shard(self) -> None:
+        self.envconfig_mock.docker_artifacts = ['.coverage']
+
+        plugin.tox_runtest(self.venv_mock, False)
+
+        _setup, *shard_runs = self.run_tests_mock.call_args_list
+        self.assertEqual(
+            sorted(run.kwargs['artifacts_dest'] for run in shard_runs),
+            [str(self.envlogdir / 'shard-0'), str(self.envlogdir / 'shard-1')])
+        for run in shard_runs:
+            self.assertEqual(run.kwargs['artifacts_dir'], run.kwargs['artifacts_dest'])
+
+    def test_kept_snapshot(self) -> None:
+        self.envconfig_mock.docker_snapshot = True
+
+        plugin.tox_runtest(self.venv_mock, False)
+
+        self.client_mock.images.remove.assert_not_called()
+
+    def test_commands_without_posargs(self) -> None:
+        self.envconfig_mock._reader.getstring.return_value = 'pytest tests'
+
+        with mock.patch('tox.reporter.warning') as warning_mock:
+            plugin.tox_runtest(self.venv_mock, False)
+
+        warning_mock.assert_called_once()
+        self.assertIn('{posargs}', warning_mock.call_args.args[0])
+
+    def test_failed_shard_fails_env(self) -> None:
+        self.client_mock.images.list.return_value = [mock.Mock(id='sha256:snapshot')]
+        self.failing = 'tests/test_b.py'
+
+        with mock.patch('tox.reporter.line') as line_mock:
+            self.assertFalse(plugin.tox_runtest(self.venv_mock, False))
+
+        # Set up already, and the other shard still ran
+        self.assertEqual(self.run_tests_mock.call_count, 2)
+        self.commit_mock.assert_not_called()
+        line_mock.assert_any_call('ran tests/test_b.py')
+        self.assertEqual(self.venv_mock.status, 'commands failed')
+
+    def test_invalid_count(self) -> None:
+        self.envconfig_mock.docker_shards = 'lots'
+
+        with self.assertRaises(tox.exception.ConfigError):
+            plugin.tox_runtest(self.venv_mock, False)
+
+
+class TestArtifacts(TestCase):
+
+    def test_valid(self) -> None:
+        self.envconfig_mock.docker_artifacts = ['.coverage.*', 'reports/**/*.xml']
+
+        self.assertEqual(plugin.get_artifacts(self.envconfig_mock),
+                         ['.coverage.*', 'reports/**/*.xml'])
+
+    def test_outside_working_dir(self) -> None:
+        for pattern in ['', ' ', '/etc/passwd', '../secret/*', 'reports/../../secret']:
+            with self.subTest(pattern=pattern):
+                self.envconfig_mock.docker_artifacts = [pattern]
+
+                with self.assertRaises(tox.exception.ConfigError):
+                    plugin.get_artifacts(self.envconfig_mock)
+
+
+class TestLimits(TestCase):
+
+    def test_valid(self) -> None:
+        self.envconfig_mock.configure_mock(docker_cpus='1.5', docker_ulimits=['nofile=1024'])
+
+        self.assertEqual(plugin.get_limits(self.envconfig_mock),
+                         resources.Limits(cpus='1.5', ulimits=['nofile=1024']))
+
+    def test_invalid(self) -> None:
+        for cpus, ulimits in [('lots', []), ('-1', []), ('nan', []), (None, ['nofile'])]:
+            with self.subTest(cpus=cpus, ulimits=ulimits):
+                self.envconfig_mock.configure_mock(docker_cpus=cpus, docker_ulimits=ulimits)
+
+                with self.assertRaises(tox.exception.ConfigError):
+                    plugin.get_limits(self.envconfig_mock)
+
+
+class TestRuntestPool(TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        do_run_in_docker_patch = mock.patch('tox_in_docker.plugin.do_run_in_docker', return_value=True)
+        do_run_in_docker_patch.start()
+        self.addCleanup(do_run_in_docker_patch.stop)
+
+        pool_patch = mock.patch('tox_in_docker.pool.ContainerPool', spec=pool.ContainerPool)
+        self.pool_mock = pool_patch.start()
+        self.addCleanup(pool_patch.stop)
+
+        client_constructor_patch = mock.patch('docker.client.from_env')
+        client_constructor_patch.start()
+        self.addCleanup(client_constructor_patch.stop)
 
-        docker_image = 'vogsphere:42'
+        self.config_mock.option.docker_warm_pool = 2
+        self.envconfig_mock.docker_image = 'sha256:warm'
+        self.envconfig_mock.envname = 'py311'
 
-        with self.subTest('image needs tox'):
-            mock_client.containers.run.configure_mock(
-                side_effect=((docker.errors.APIError(
-                    'some message I guess'), True)))
+    def test_runs_in_pool(self) -> None:
+        self.assertTrue(plugin.tox_runtest(self.venv_mock, False))
 
-            res = plugin._ensure_tox_installed(mock_client, docker_image)
-            self.assertIs(res, build_image_mock.return_value.tags[0])
+        self.pool_mock.assert_called_once_with(
+            'sha256:warm', 'py311', AnyMock, size=2, ttl=pool.DEFAULT_TTL,
+            extra_volumes={}, environment={})
+        self.pool_mock.return_value.run_env.assert_called_once_with(
+            timings=plugin.get_timings(self.envconfig_mock))
 
-        mock_client.reset_mock()
-        with self.subTest('image already has tox'):
-            mock_client.containers.run.reset_mock()
-            mock_client.containers.run.configure_mock(return_value=True, side_effect=None)
+    def test_failure(self) -> None:
+        self.pool_mock.return_value.run_env.side_effect = docker.errors.ContainerError(
+            mock.Mock(), 1, ['-e', 'py311'], 'sha256:warm', b'nope')
+
+        self.assertFalse(plugin.tox_runtest(self.venv_mock, False))
+        self.assertEqual(self.venv_mock.status, 'commands failed')
+
+
+class TestRuntestPost(TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.config_mock.option.docker_timings_json = None
+        self.envconfig_mock.envname = 'py39'
+        self.venv_mock.run_image = 'sha256:image'
+
+    def test_not_in_docker(self) -> None:
+        self.venv_mock.run_image = None
+
+        plugin.tox_runtest_post(self.venv_mock)
+        self.assertEqual(self.envconfig_mock.envname, 'py39')
+
+    def test_timings_in_name(self) -> None:
+        plugin.get_timings(self.envconfig_mock).durations = {'build': 1.25, 'commands': 4.0}
+
+        plugin.tox_runtest_post(self.venv_mock)
+        self.assertEqual(self.envconfig_mock.envname, 'py39 (in docker: build 1.2s, commands 4.0s)')
+
+    @mock.patch('tox_in_docker.timing.write_json')
+    def test_timings_json(self, write_json_mock) -> None:
+        self.config_mock.option.docker_timings_json = 'timings.json'
+
+        plugin.tox_runtest_post(self.venv_mock)
+        write_json_mock.assert_called_once_with(
+            'timings.json', {'py39': plugin.get_timings(self.envconfig_mock)})
+
+
+class TestRuntestScheduled(TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        do_run_in_docker_patch = mock.patch('tox_in_docker.plugin.do_run_in_docker', return_value=True)
+        do_run_in_docker_patch.start()
+        self.addCleanup(do_run_in_docker_patch.stop)
+
+        client_constructor_patch = mock.patch('docker.client.from_env')
+        client_constructor_patch.start()
+        self.addCleanup(client_constructor_patch.stop)
+
+        prepare_patch = mock.patch('tox_in_docker.plugin.prepare_image', side_effect=lambda venv, client: f'sha256:{venv.envconfig.envname}')
+        self.prepare_mock = prepare_patch.start()
+        self.addCleanup(prepare_patch.stop)
+
+        self.addCleanup(plugin.tox_cleanup, None)
+
+        self.config_mock.option.docker_workers = 2
+        self.config_mock.envlist = ['py39', 'py310']
+        self.config_mock.envconfigs = {}
+        for envname in self.config_mock.envlist:
+            envconfig = mock.Mock(
+                envname=envname, config=self.config_mock, docker_pip_cache=None, docker_reuse_envdir=False,
+            docker_sync=None, docker_snapshot=False, docker_scratch=None, docker_shards=None,
+            docker_cpus=None, docker_cpuset=None, docker_memory=None, docker_shm_size=None,
+            docker_ulimits=[], docker_artifacts=[])
+            self.config_mock.envconfigs[envname] = envconfig
+
+    def _run(self, envname: str):
+        venv = mock.Mock(envconfig=self.config_mock.envconfigs[envname], status=0)
+        plugin.tox_runtest_pre(venv)
+        return venv, plugin.tox_runtest(venv, False)
+
+    @mock.patch('tox_in_docker.main.run_tests')
+    def test_runs_all_envs(self, run_tests_mock) -> None:
+        def run_tests(venv, image, output, **kwargs):
+            output(f'ran {venv.envconfig.envname}')
+            return mock.Mock()
+        run_tests_mock.side_effect = run_tests
+
+        with mock.patch('tox.reporter.line') as line_mock:
+            for envname in self.config_mock.envlist:
+                venv, res = self._run(envname)
+                self.assertTrue(res)
+                self.assertEqual(venv.run_image, f'sha256:{envname}')
+
+        # Each env is prepared once, by its job
+        self.assertEqual(self.prepare_mock.call_count, 2)
+        line_mock.assert_has_calls([mock.call('ran py39'), mock.call('ran py310')])
+
+    @mock.patch('tox_in_docker.main.run_tests')
+    def test_failure_is_per_env(self, run_tests_mock) -> None:
+        def run_tests(venv, image, output, **kwargs):
+            if venv.envconfig.envname == 'py39':
+                raise docker.errors.ContainerError(mock.Mock(), 1, [], image, b'')
+            return mock.Mock()
+        run_tests_mock.side_effect = run_tests
+
+        venv, res = self._run('py39')
+        self.assertFalse(res)
+        self.assertEqual(venv.status, 'commands failed')
+
+        venv, res = self._run('py310')
+        self.assertTrue(res)
+        self.assertEqual(venv.status, 0)
+
+    @mock.patch('tox_in_docker.aio.AsyncDockerClient')
+    @mock.patch('tox_in_docker.aio.run_tests')
+    def test_async(self, run_tests_mock, client_mock) -> None:
+        self.config_mock.option.docker_async = True
+        self.config_mock.option.docker_workers = None
+
+        async def run_tests(venv, image, client, output, **kwargs):
+            output(f'ran {venv.envconfig.envname}')
+            if venv.envconfig.envname == 'py39':
+                raise docker.errors.ContainerError(f'{image}-container', 1, [], image, b'')
+            return f'{image}-container'
+        run_tests_mock.side_effect = run_tests
+        client_mock.return_value.remove = mock.AsyncMock()
+
+        with mock.patch('tox.reporter.line') as line_mock:
+            venv, res = self._run('py39')
+            self.assertFalse(res)
+            venv, res = self._run('py310')
+            self.assertTrue(res)
+
+        line_mock.assert_has_calls([mock.call('ran py39'), mock.call('ran py310')])
+        # Both containers are removed, whether or not they failed
+        client_mock.return_value.remove.assert_has_awaits([
+            mock.call('sha256:py39-container', v=True), mock.call('sha256:py310-container', v=True)],
+            any_order=True)
+
+    @mock.patch('tox_in_docker.main.commit_snapshot')
+    @mock.patch('tox_in_docker.main.run_tests')
+    @mock.patch('tox_in_docker.aio.AsyncDockerClient')
+    @mock.patch('tox_in_docker.aio.run_tests')
+    def test_async_failed_snapshot_setup(self, aio_run_tests_mock, client_mock, run_tests_mock,
+                                         commit_mock) -> None:
+        self.config_mock.option.docker_async = True
+        self.config_mock.option.docker_workers = None
+        self.config_mock.envconfigs['py39'].configure_mock(
+            docker_snapshot=True, deps=[], extras=[], basepython='python3.9', install_command=[],
+            setenv=mock.Mock(definitions={}))
+        docker.client.from_env.return_value.images.list.return_value = []
+        setup_container = mock.Mock()
+        setup_container.remove.side_effect = [None, docker.errors.NotFound('no such container')]
+        run_tests_mock.side_effect = docker.errors.ContainerError(
+            setup_container, 1, [], 'sha256:py39', b'')
+        aio_run_tests_mock.return_value = 'sha256:py310-container'
+        client_mock.return_value.remove = mock.AsyncMock()
+
+        venv, res = self._run('py39')
+
+        self.assertFalse(res)
+        self.assertEqual(venv.status, 'commands failed')
+        setup_container.remove.assert_called_once_with(v=True)
+        # Only the other env got as far as running its commands
+        self.assertEqual(
+            [call.args[1] for call in aio_run_tests_mock.call_args_list], ['sha256:py310'])
+        client_mock.return_value.remove.assert_awaited_once_with('sha256:py310-container', v=True)
+        commit_mock.assert_not_called()
+
+
+class TestPrepare(TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        do_run_in_docker_patch = mock.patch(
+            'tox_in_docker.plugin.do_run_in_docker',
+            side_effect=lambda envconfig: envconfig.envname != 'lint')
+        do_run_in_docker_patch.start()
+        self.addCleanup(do_run_in_docker_patch.stop)
+
+        client_constructor_patch = mock.patch('docker.client.from_env')
+        client_constructor_patch.start()
+        self.addCleanup(client_constructor_patch.stop)
+
+        self.config_mock.envlist = ['py39', 'py310', 'lint']
+        self.config_mock.envconfigs = dict(
+            (envname, mock.Mock(envname=envname, config=self.config_mock))
+            for envname in self.config_mock.envlist)
+
+    @mock.patch('tox_in_docker.plugin.prepare_image')
+    def test_prepares_in_docker_envs(self, prepare_mock) -> None:
+        prepare_mock.side_effect = lambda venv, client: f'sha256:{venv.envconfig.envname}'
+
+        self.assertEqual(plugin.prepare_images(self.config_mock), 0)
+
+        prepared = sorted(call.args[0].envconfig.envname for call in prepare_mock.call_args_list)
+        self.assertEqual(prepared, ['py310', 'py39'])
+
+    @mock.patch('tox_in_docker.plugin.prepare_image')
+    def test_failures_counted(self, prepare_mock) -> None:
+        prepare_mock.side_effect = docker.errors.BuildError('nope', [])
+
+        self.assertEqual(plugin.prepare_images(self.config_mock), 2)
+
+    @mock.patch('tox_in_docker.plugin.prepare_images', return_value=1)
+    def test_configure_exits(self, prepare_images_mock) -> None:
+        plugin.tox_configure(self.config_mock)
+        prepare_images_mock.assert_not_called()
+
+        self.config_mock.option.docker_prepare = True
+        with self.assertRaises(SystemExit) as ctx:
+            plugin.tox_configure(self.config_mock)
+        self.assertEqual(ctx.exception.code, 1)
+
+
+class TestRunOptions(TestCase):
+
+    @mock.patch('tox_in_docker.main.get_pip_cache_volumes', return_value={'vol': {}})
+    def test_pip_cache(self, volumes_mock) -> None:
+        client_mock = mock.Mock()
+
+        for pip_cache, expected in [
+                (None, None), ('false', None), ('None', None),
+                ('true', 'volume'), ('volume', 'volume'), ('~/pip', '~/pip')]:
+            with self.subTest(pip_cache=pip_cache):
+                volumes_mock.reset_mock()
+                self.envconfig_mock.docker_pip_cache = pip_cache
+                self.envconfig_mock.docker_pip_cache_size = '1k'
+
+                res = plugin.get_run_options(self.venv_mock, 'sha256:abc', client_mock)
+
+                if expected is None:
+                    self.assertEqual(res, {'extra_volumes': {}, 'environment': {}})
+                    volumes_mock.assert_not_called()
+                else:
+                    volumes_mock.assert_called_once_with('sha256:abc', expected, client_mock)
+                    self.assertEqual(res, {
+                        'extra_volumes': {'vol': {}},
+                        'environment': {'PIP_CACHE_DIR': '/pip-cache', 'TID_PIP_CACHE_MAX_KB': '1'}})
+
+
+    @mock.patch('tox_in_docker.main.get_envdir_volumes', return_value={'envdir': {}})
+    def test_reuse_envdir(self, volumes_mock) -> None:
+        client_mock = mock.Mock()
+        self.envconfig_mock.docker_reuse_envdir = True
+        self.envconfig_mock.envname = 'py39'
+
+        with self.subTest('own container'):
+            res = plugin.get_run_options(self.venv_mock, 'sha256:abc', client_mock)
+            volumes_mock.assert_called_once_with('sha256:abc', client_mock, 'py39')
+            self.assertEqual(res['extra_volumes'], {'envdir': {}})
+
+        volumes_mock.reset_mock()
+        with self.subTest('shared container'):
+            plugin.get_run_options(self.venv_mock, 'sha256:abc', client_mock, shared=True)
+            volumes_mock.assert_called_once_with('sha256:abc', client_mock, None)
+
+    @mock.patch('tox_in_docker.main.get_source_volumes', return_value={'src': {}})
+    def test_warm_sync(self, volumes_mock) -> None:
+        client_mock = mock.Mock()
+        self.envconfig_mock.envname = 'py39'
+
+        for sync in ['warm', 'Warm-Checksum']:
+            with self.subTest(sync=sync):
+                volumes_mock.reset_mock()
+                self.envconfig_mock.docker_sync = sync
+
+                res = plugin.get_run_options(self.venv_mock, 'sha256:abc', client_mock)
+
+                volumes_mock.assert_called_once_with(client_mock, 'py39')
+                self.assertEqual(res['extra_volumes'], {'src': {}})
+                self.assertEqual(res['environment'], {'TID_SYNC': sync.lower()})
+
+        volumes_mock.reset_mock()
+        with self.subTest(sync='git'):
+            self.envconfig_mock.docker_sync = 'git'
+            res = plugin.get_run_options(self.venv_mock, 'sha256:abc', client_mock)
+            volumes_mock.assert_not_called()
+
+    @mock.patch('tox_in_docker.main.get_source_volumes', return_value={'src': {}})
+    def test_warm_sync_with_scratch(self, volumes_mock) -> None:
+        self.envconfig_mock.docker_sync = 'warm'
+
+        for scratch in ['tmpfs', 'Volume']:
+            with self.subTest(scratch=scratch):
+                self.envconfig_mock.docker_scratch = scratch
+
+                # Both would be mounted as the working dir
+                with self.assertRaises(tox.exception.ConfigError):
+                    plugin.get_run_options(self.venv_mock, 'sha256:abc', mock.Mock())
+
+        with self.subTest(scratch='bind'):
+            self.envconfig_mock.docker_scratch = 'bind'
+            res = plugin.get_run_options(self.venv_mock, 'sha256:abc', mock.Mock())
+            self.assertEqual(res['extra_volumes'], {'src': {}})
+
+    @mock.patch('tox_in_docker.main.get_source_volumes', return_value={'src': {}})
+    def test_warm_sync_in_pool(self, volumes_mock) -> None:
+        self.envconfig_mock.docker_sync = 'warm-checksum'
+        self.config_mock.option.docker_warm_pool = 2
+
+        res = plugin.get_run_options(self.venv_mock, 'sha256:abc', mock.Mock())
+
+        # Each container is warm already, and the volume would be shared
+        volumes_mock.assert_not_called()
+        self.assertEqual(res['environment'], {'TID_SYNC': 'warm-checksum'})
+
+    @mock.patch('tox_in_docker.main.get_source_volumes', return_value={'src': {}})
+    def test_warm_sync_with_shards(self, volumes_mock) -> None:
+        self.envconfig_mock.configure_mock(docker_sync='warm', docker_shards='2')
+
+        # The shards would share the volume
+        with self.assertRaises(tox.exception.ConfigError):
+            plugin.get_run_options(self.venv_mock, 'sha256:abc', mock.Mock())
+
+        # Not sharded in a shared container
+        res = plugin.get_run_options(self.venv_mock, 'sha256:abc', mock.Mock(), shared=True)
+        self.assertEqual(res['extra_volumes'], {'src': {}})
+
+
+class TestClient(TestCase):
+
+    @mock.patch('docker.client.from_env')
+    def test_shared_between_hooks(self, from_env_mock) -> None:
+        first = plugin.get_client(self.config_mock)
+        second = plugin.get_client(self.config_mock)
+
+        self.assertIs(first, second)
+        from_env_mock.assert_called_once_with(max_pool_size=main.DEFAULT_POOL_SIZE)
+
+        plugin.tox_cleanup(None)
+        first.close.assert_called_once_with()
+
+    @mock.patch('docker.client.from_env')
+    def test_pool_size(self, from_env_mock) -> None:
+        for pool_size, workers, expected in [(None, 32, 32), (None, 2, main.DEFAULT_POOL_SIZE), (4, 32, 4)]:
+            with self.subTest(pool_size=pool_size, workers=workers):
+                main.close_client()
+                from_env_mock.reset_mock()
+                self.config_mock.option.docker_pool_size = pool_size
+                self.config_mock.option.docker_workers = workers
+
+                plugin.get_client(self.config_mock)
+
+                from_env_mock.assert_called_once_with(max_pool_size=expected)
 
-            res = plugin._ensure_tox_installed(mock_client, docker_image)
-            self.assertEqual(res, docker_image)
 
 class TestDoRunInDocker(TestCase):
 
@@ -203,6 +889,8 @@ class TestDoRunInDocker(TestCase):
 
         for case in cases:
             with self.subTest(Case):
+                # The decision is only made once per environment
+                self.envconfig_mock.docker_run_decision = None
                 self.config_mock.option.in_docker = case.cli_in_d
                 self.envconfig_mock.in_docker = case.ini_in_d
 
@@ -246,6 +934,33 @@ class TestDoRunInDocker(TestCase):
             self.assertTrue(res)
 
 
+    def test_decision_made_once_per_env(self) -> None:
+        hook_caller_mock = self.config_mock.pluginmanager.subset_hook_caller.return_value
+        hook_caller_mock.configure_mock(return_value=None)
+        self.config_mock.option.configure_mock(always_in_docker=False, in_docker=True)
+        self.envconfig_mock.configure_mock(always_in_docker=False, in_docker=True)
+
+        for _ in range(3):
+            self.assertTrue(plugin.do_run_in_docker(venv=self.venv_mock))
+
+        hook_caller_mock.assert_called_once_with(envconfig=self.envconfig_mock, skip_tid=True)
+
+        decision = self.envconfig_mock.docker_run_decision
+        self.assertEqual(decision, plugin.get_run_decision(envconfig=self.envconfig_mock))
+        self.assertTrue(decision.in_docker)
+        self.assertIn('no local Python', decision.reason)
+
+    def test_reason_for_local_python(self) -> None:
+        hook_caller_mock = self.config_mock.pluginmanager.subset_hook_caller.return_value
+        hook_caller_mock.configure_mock(return_value='/usr/bin/python3')
+        self.config_mock.option.configure_mock(always_in_docker=False, in_docker=True)
+        self.envconfig_mock.configure_mock(always_in_docker=False, in_docker=True)
+
+        decision = plugin.get_run_decision(envconfig=self.envconfig_mock)
+
+        self.assertFalse(decision.in_docker)
+        self.assertIn('/usr/bin/python3', decision.reason)
+
     def test_config_use(self) -> None:
         pypath = '/usr/bin/python3'
         for always_in_docker, in_docker, found_exe, expected in [
@@ -0,0 +1,135 @@
+import unittest
+import unittest.mock as mock
+
+import docker.errors
+
+import tox_in_docker.main
+import tox_in_docker.pool
+
+from .util import AnyDict, AnyStr
+
+IMAGE_ID = 'sha256:warm'
+ENV_NAME = 'py311'
+
+
+class TestContainerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.client_mock = mock.Mock()
+        self.pool = tox_in_docker.pool.ContainerPool(IMAGE_ID, ENV_NAME, self.client_mock, size=1)
+
+        # Commands run with `docker exec`, and whether they succeed
+        self.execs = []
+        self.claimable = set()
+        self.client_mock.api.exec_create.side_effect = self._exec_create
+        self.client_mock.api.exec_start.return_value = iter([(b'tox output\n', None)])
+        self.client_mock.api.exec_inspect.side_effect = self._exec_inspect
+
+        self.client_mock.containers.list.return_value = []
+        self.new_container = self.client_mock.containers.run.return_value
+        self.new_container.id = 'new'
+
+    def _exec_create(self, container_id, command, **kwargs):
+        self.execs.append((container_id, command))
+        return {'Id': len(self.execs) - 1}
+
+    def _exec_inspect(self, exec_id):
+        container_id, command = self.execs[exec_id]
+        if 'mkdir' in ' '.join(command) and container_id not in self.claimable:
+            return {'ExitCode': 1}
+        return {'ExitCode': 0}
+
+    def _container(self, container_id, key=None, status='running'):
+        container = mock.Mock(id=container_id, status=status)
+        container.labels = {tox_in_docker.pool.POOL_KEY_LABEL: key or self.pool.labels[
+            tox_in_docker.pool.POOL_KEY_LABEL]}
+        return container
+
+    def test_reuses_warm_container(self):
+        warm = self._container('warm')
+        spare = self._container('spare')
+        self.client_mock.containers.list.return_value = [warm, spare]
+        self.claimable.add('warm')
+
+        self.pool.run_env()
+
+        # The spare is still there for the next run, so none are started
+        self.client_mock.containers.run.assert_not_called()
+        commands = [command for container_id, command in self.execs if container_id == 'warm']
+        self.assertEqual(commands[1], [tox_in_docker.main.IMAGE_ENTRYPOINT_PATH, tox_in_docker.main.RESYNC_ARG])
+        self.assertEqual(commands[2], [tox_in_docker.main.IMAGE_ENTRYPOINT_PATH,
+                                       tox_in_docker.main.EXEC_ARG, '-e', ENV_NAME])
+        self.assertIn('rmdir', ' '.join(commands[-1]))
+
+    def test_starts_container_and_tops_up(self):
+        busy = self._container('busy')
+        self.client_mock.containers.list.return_value = [busy]
+        self.new_container.logs.return_value = iter([tox_in_docker.main.READY_MARKER.encode(), b'\n'])
+        # Not claimable until it is ready
+        self.new_container.logs.side_effect = lambda **kwargs: self.claimable.add('new') or iter(
+            [tox_in_docker.main.READY_MARKER.encode(), b'\n'])
+
+        self.pool.run_env()
+
+        # One to run in, and one kept ready for the next run
+        self.assertEqual(self.client_mock.containers.run.call_count, 2)
+        self.client_mock.containers.run.assert_called_with(
+            image=IMAGE_ID,
+            volumes=AnyDict,
+            command=[tox_in_docker.main.POOL_ARG, str(tox_in_docker.pool.DEFAULT_TTL)],
+            environment={tox_in_docker.main.SYNC_ENV: tox_in_docker.main.SYNC_WARM},
+            labels=self.pool.labels,
+            user=AnyStr,
+            auto_remove=True,
+            detach=True)
+        volumes = self.client_mock.containers.run.call_args.kwargs['volumes']
+        self.assertNotIn(tox_in_docker.main.MOUNTED_WORKING_DIR,
+                         [mount['bind'] for mount in volumes.values()])
+
+    def test_stale_containers_reaped(self):
+        stale = self._container('stale', key='old')
+        stopped = self._container('stopped', status='exited')
+        warm = self._container('warm')
+        self.client_mock.containers.list.return_value = [stale, stopped, warm]
+
+        self.assertEqual(self.pool.reap(), [warm])
+        stale.remove.assert_called_once_with(force=True)
+        stopped.remove.assert_not_called()
+
+    def test_key_changes_with_options(self):
+        other = tox_in_docker.pool.ContainerPool(
+            IMAGE_ID, ENV_NAME, self.client_mock, environment={'PIP_CACHE_DIR': '/pip-cache'})
+
+        self.assertNotEqual(other.labels[tox_in_docker.pool.POOL_KEY_LABEL],
+                            self.pool.labels[tox_in_docker.pool.POOL_KEY_LABEL])
+
+    def test_failed_env_raises_and_releases(self):
+        warm = self._container('warm')
+        self.client_mock.containers.list.return_value = [warm]
+        self.claimable.add('warm')
+        self.client_mock.api.exec_inspect.side_effect = lambda exec_id: {
+            'ExitCode': 2 if tox_in_docker.main.EXEC_ARG in self.execs[exec_id][1] else 0}
+
+        with self.assertRaises(docker.errors.ContainerError) as ctx:
+            self.pool.run_env()
+
+        self.assertEqual(ctx.exception.exit_status, 2)
+        self.assertIn('rmdir', ' '.join(self.execs[-1][1]))
+
+    def test_failed_release_keeps_env_error(self):
+        warm = self._container('warm')
+        self.client_mock.containers.list.return_value = [warm]
+        self.claimable.add('warm')
+
+        def exec_inspect(exec_id):
+            command = ' '.join(self.execs[exec_id][1])
+            if 'rmdir' in command:
+                raise docker.errors.APIError('container is not running')
+            return {'ExitCode': 2 if tox_in_docker.main.EXEC_ARG in command else 0}
+        self.client_mock.api.exec_inspect.side_effect = exec_inspect
+
+        with self.assertRaises(docker.errors.ContainerError) as ctx:
+            self.pool.run_env()
+
+        self.assertEqual(ctx.exception.exit_status, 2)
+        warm.remove.assert_called_once_with(force=True)
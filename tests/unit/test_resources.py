@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import docker.types
+
+from tox_in_docker import resources
+
+
+class TestContainerOptions(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.lock_dir = os.path.join(tmp_dir.name, 'locks')
+        for patch in [mock.patch('tox_in_docker.locks.LOCK_DIR', self.lock_dir),
+                      mock.patch('tox_in_docker.resources.get_cpus', return_value=[0, 1, 2, 3])]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_limits(self):
+        limits = resources.Limits(cpus='1.5', cpuset='0-1', memory='2g', shm_size='512m',
+                                  ulimits=['nofile=1024:2048', 'nproc=512'])
+
+        with resources.container_options(limits) as options:
+            self.assertEqual(options, {
+                'nano_cpus': 1_500_000_000,
+                'cpuset_cpus': '0-1',
+                'mem_limit': '2g',
+                'memswap_limit': '2g',
+                'shm_size': '512m',
+                'ulimits': [docker.types.Ulimit(name='nofile', soft=1024, hard=2048),
+                            docker.types.Ulimit(name='nproc', soft=512, hard=512)],
+            })
+
+    def test_no_limits(self):
+        with resources.container_options() as options:
+            self.assertEqual(options, {})
+
+    def test_invalid_ulimit(self):
+        with self.assertRaises(ValueError):
+            with resources.container_options(resources.Limits(ulimits=['nofile'])):
+                pass
+
+    def test_invalid_cpus(self):
+        for cpus in ['lots', '0', '-1', 'nan']:
+            with self.subTest(cpus=cpus):
+                with self.assertRaises(ValueError):
+                    with resources.container_options(resources.Limits(cpus=cpus)):
+                        pass
+
+    def test_auto_cpusets_are_disjoint(self):
+        limits = resources.Limits(cpus='2', cpuset=resources.CPUSET_AUTO)
+
+        with resources.container_options(limits) as first, \
+                resources.container_options(limits) as second:
+            self.assertEqual(first['cpuset_cpus'], '0,1')
+            self.assertEqual(second['cpuset_cpus'], '2,3')
+
+            # None left, so it isn't pinned
+            with resources.container_options(limits) as third:
+                self.assertNotIn('cpuset_cpus', third)
+                self.assertEqual(third['nano_cpus'], 2_000_000_000)
+
+        # Released once the containers are done
+        with resources.container_options(limits) as again:
+            self.assertEqual(again['cpuset_cpus'], '0,1')
+
+    def test_auto_cpuset_without_lock_files(self):
+        # Someone else's
+        os.mkdir(self.lock_dir)
+        os.chmod(self.lock_dir, 0o777)
+
+        with resources.container_options(resources.Limits(cpuset=resources.CPUSET_AUTO)) \
+                as options:
+            self.assertNotIn('cpuset_cpus', options)
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import unittest
+
+from tox_in_docker import scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = scheduler.Scheduler(2)
+        self.addCleanup(self.scheduler.shutdown)
+
+    def test_output_is_buffered_per_job(self):
+        def job(name, output):
+            output(f'{name} one')
+            output(f'{name} two')
+            return name
+
+        for name in ['spam', 'eggs']:
+            self.scheduler.submit(name, job, name)
+
+        for name in ['spam', 'eggs']:
+            res = self.scheduler.wait(name)
+            self.assertEqual(res.future.result(), name)
+            self.assertEqual(list(res.output), [f'{name} one', f'{name} two'])
+
+    def test_bounded_workers(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def job(output):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            release.wait(5)
+            with lock:
+                running.pop()
+
+        for idx in range(4):
+            self.scheduler.submit(str(idx), job)
+        release.set()
+        for idx in range(4):
+            self.scheduler.wait(str(idx))
+
+        self.assertLessEqual(max(peak), 2)
+
+    def test_exception_kept_on_job(self):
+        def job(output):
+            raise ValueError('nope')
+
+        self.scheduler.submit('spam', job)
+
+        self.assertIn('spam', self.scheduler)
+        self.assertNotIn('eggs', self.scheduler)
+        self.assertIsInstance(self.scheduler.wait('spam').future.exception(), ValueError)
+
+
+class TestAsyncScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = scheduler.AsyncScheduler(2)
+        self.addCleanup(self.scheduler.shutdown)
+
+    def test_output_is_buffered_per_job(self):
+        async def job(name, output):
+            output(f'{name} one')
+            await asyncio.sleep(0)
+            output(f'{name} two')
+            return name
+
+        for name in ['spam', 'eggs']:
+            self.scheduler.submit(name, job, name)
+
+        for name in ['spam', 'eggs']:
+            res = self.scheduler.wait(name)
+            self.assertEqual(res.future.result(), name)
+            self.assertEqual(list(res.output), [f'{name} one', f'{name} two'])
+
+    def test_bounded_workers(self):
+        running = []
+        peak = []
+
+        async def job(output):
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        for idx in range(4):
+            self.scheduler.submit(str(idx), job)
+        for idx in range(4):
+            self.scheduler.wait(str(idx))
+
+        self.assertEqual(max(peak), 2)
+
+    def test_shutdown_cancels_running_jobs(self):
+        cleaned_up = threading.Event()
+        started = threading.Event()
+
+        async def job(output):
+            try:
+                started.set()
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cleaned_up.set()
+                raise
+
+        self.scheduler.submit('spam', job)
+        started.wait(5)
+        self.scheduler.shutdown()
+
+        self.assertTrue(cleaned_up.is_set())
@@ -0,0 +1,52 @@
+import pathlib
+import tempfile
+import unittest
+
+from tox_in_docker import shards
+
+
+class TestSplit(unittest.TestCase):
+
+    def test_balanced_by_duration(self):
+        durations = {'slow': 10.0, 'medium': 6.0, 'fast': 3.0, 'faster': 1.0}
+
+        split = shards.split(list(durations), 2, durations)
+
+        self.assertEqual(split, [['slow'], ['medium', 'fast', 'faster']])
+
+    def test_unknown_items_take_the_average(self):
+        split = shards.split(['slow', 'new', 'fast'], 2, {'slow': 8.0, 'fast': 2.0})
+
+        self.assertEqual(split, [['slow'], ['new', 'fast']])
+
+    def test_no_more_shards_than_items(self):
+        self.assertEqual(shards.split(['only'], 4), [['only']])
+        self.assertEqual(shards.split([], 4), [])
+
+
+class TestItems(unittest.TestCase):
+
+    def test_posargs_first(self):
+        self.assertEqual(shards.get_test_items('/nowhere', ['tests/test_a.py::test_x']),
+                         ['tests/test_a.py::test_x'])
+
+    def test_test_files(self):
+        with tempfile.TemporaryDirectory() as root:
+            tests_dir = pathlib.Path(root, 'tests', 'unit')
+            tests_dir.mkdir(parents=True)
+            for name in ['test_a.py', 'b_test.py', 'util.py']:
+                tests_dir.joinpath(name).touch()
+
+            self.assertEqual(shards.get_test_items(root),
+                             ['tests/unit/b_test.py', 'tests/unit/test_a.py'])
+
+
+class TestDurations(unittest.TestCase):
+
+    def test_shard_time_shared_between_items(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = str(pathlib.Path(log_dir, 'py39', shards.DURATIONS_FILENAME))
+
+            shards.save_durations(path, [['a', 'b'], ['c']], [4.0, 3.0])
+
+            self.assertEqual(shards.load_durations(path), {'a': 2.0, 'b': 2.0, 'c': 3.0})
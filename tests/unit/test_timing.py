@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import tox_in_docker.timing
+
+
+class TestTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = tox_in_docker.timing.Timings()
+
+    @mock.patch('time.perf_counter', side_effect=[1.0, 3.5, 4.0, 4.5])
+    def test_phases_add_up(self, _perf_counter_mock):
+        with self.timings.phase(tox_in_docker.timing.BUILD):
+            pass
+        with self.timings.phase(tox_in_docker.timing.BUILD):
+            pass
+
+        self.assertEqual(self.timings.durations, {tox_in_docker.timing.BUILD: 3.0})
+        self.assertEqual(self.timings.summary(), 'build 3.0s')
+        self.assertEqual(self.timings.as_dict(), {'build': 3.0, 'total': 3.0})
+
+    def test_output_filter(self):
+        lines = []
+        output = self.timings.output_filter('py39', lines.append)
+
+        for line in [
+                f'{tox_in_docker.timing.PHASE_MARKER} {tox_in_docker.timing.SYNC}',
+                'py39 create: /working_dir/.tox/py39',
+                'py39 installdeps: pytest',
+                'py310 run-test: commands[0] | pytest',
+                'py39 run-test: commands[0] | pytest',
+                '1 passed']:
+            output(line)
+        self.timings.stop()
+
+        self.assertEqual(list(self.timings.durations), ['sync', 'setup', 'commands'])
+        self.assertEqual(lines[0], 'py39 create: /working_dir/.tox/py39')
+        self.assertEqual(len(lines), 5)
+
+    def test_stop_without_phase(self):
+        self.timings.stop()
+        self.assertEqual(self.timings.durations, {})
+
+
+class TestWriteJson(unittest.TestCase):
+
+    def test_merges_report(self):
+        timings = tox_in_docker.timing.Timings()
+        timings.durations = {'build': 1.0}
+
+        with tempfile.TemporaryDirectory() as report_dir:
+            path = os.path.join(report_dir, 'timings.json')
+            tox_in_docker.timing.write_json(path, {'py39': timings})
+            tox_in_docker.timing.write_json(path, {'py310': timings})
+
+            with open(path) as report_file:
+                report = json.load(report_file)
+
+        self.assertEqual(report, {
+            'py39': {'build': 1.0, 'total': 1.0},
+            'py310': {'build': 1.0, 'total': 1.0},
+        })
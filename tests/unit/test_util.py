@@ -44,3 +44,24 @@ class TestGetDefaultImages(unittest.TestCase):
         for jython in ['jy', 'jython', 'jy27', 'jy2', 'jy3']:
             with self.assertRaises(util.NoJythonSupport):
                 util.get_default_image(jython)
+
+
+class TestParseSize(unittest.TestCase):
+
+    def test_sizes(self):
+        for size, expected in [('512', 512), ('1k', 1024), ('2M', 2 * 1024 ** 2),
+                               ('1.5g', int(1.5 * 1024 ** 3)), ('3gb', 3 * 1024 ** 3)]:
+            with self.subTest(size=size):
+                self.assertEqual(util.parse_size(size), expected)
+
+    def test_invalid(self):
+        for size in ['', 'lots', '2x']:
+            with self.subTest(size=size), self.assertRaises(ValueError):
+                util.parse_size(size)
+
+
+class TestDockerSafeName(unittest.TestCase):
+
+    def test_names(self):
+        self.assertEqual(util.docker_safe_name('tid-my project/py39'), 'tid-my-project-py39')
+        self.assertEqual(util.docker_safe_name('.tox'), 'x.tox')